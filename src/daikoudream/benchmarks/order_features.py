@@ -0,0 +1,106 @@
+"""
+Benchmark of worker startup and of building the order board features.
+
+Run from src/daikoudream:
+
+    python benchmarks/order_features.py [--orders N] [--repeat R]
+
+Startup is timed in fresh interpreters: `django.setup()` plus importing
+find_daikou.views as workers do now, and on top of that loading the GEOS and
+GDAL bindings as they used to (through the `django.contrib.gis` app and the
+`Point` import in views). Feature building is timed for N orders with the plain
+points `create_order_features` uses now and, when GEOS can be loaded, with the
+GEOS points it used before.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'daikoudream.settings')
+
+STARTUP = '''
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import find_daikou.views
+after = time.perf_counter() - start
+loaded = any(m.startswith(('django.contrib.gis.geos', 'django.contrib.gis.gdal')) for m in sys.modules)
+if {with_geometry}:
+    import django.contrib.gis.admin
+    import django.contrib.gis.geos
+print(json.dumps({{'now': after, 'before': time.perf_counter() - start, 'geometry_loaded': loaded}}))
+'''
+
+
+def time_startup(with_geometry: bool, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP.format(with_geometry=with_geometry)],
+            cwd=BASE_DIR, check=True, capture_output=True, text=True,
+        ).stdout
+        runs.append(json.loads(output))
+    return {
+        'now': min(run['now'] for run in runs),
+        'before': min(run['before'] for run in runs),
+        'geometry_loaded': runs[0]['geometry_loaded'],
+    }
+
+
+def geos_order_features(orders):
+    """create_order_features as it was, with a GEOS Point per pickup and dropoff."""
+    from django.contrib.gis.geos import Point
+    from find_daikou.views import create_point_feature
+
+    features = []
+    for order in orders:
+        features.append(create_point_feature(Point(order.pickup_latitude, order.pickup_longitude), order.id, 'pickup'))
+        features.append(create_point_feature(Point(order.dropoff_latitude, order.dropoff_longitude), order.id, 'dropoff'))
+    return features
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        startup = time_startup(True, args.repeat)
+    except subprocess.CalledProcessError:
+        startup = dict(time_startup(False, args.repeat), before=None)
+    print(f"startup, views imported:     {startup['now'] * 1000:8.1f} ms"
+          f" (GEOS/GDAL loaded: {'yes' if startup['geometry_loaded'] else 'no'})")
+    if startup['before'] is not None:
+        print(f"startup, with GEOS/GDAL:     {startup['before'] * 1000:8.1f} ms")
+    else:
+        print("startup, with GEOS/GDAL:     GEOS/GDAL not available")
+
+    import django
+    django.setup()
+    from find_daikou.models import Order
+    from find_daikou.views import create_order_features
+
+    orders = [
+        Order(id=i, pickup_latitude=35.0 + i * 1e-5, pickup_longitude=139.0 + i * 1e-5,
+              dropoff_latitude=35.5 + i * 1e-5, dropoff_longitude=139.5 + i * 1e-5)
+        for i in range(args.orders)
+    ]
+    now = min(timeit.repeat(lambda: create_order_features(orders), number=1, repeat=args.repeat))
+    print(f"{args.orders} orders, plain points: {now * 1000:8.1f} ms")
+    try:
+        before = min(timeit.repeat(lambda: geos_order_features(orders), number=1, repeat=args.repeat))
+    except Exception as e:
+        print(f"{args.orders} orders, GEOS points:   GEOS not available ({e.__class__.__name__})")
+    else:
+        print(f"{args.orders} orders, GEOS points:   {before * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
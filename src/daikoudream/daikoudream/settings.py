@@ -40,7 +40,6 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'django.contrib.gis',
 ]
 
 MIDDLEWARE = [
@@ -51,6 +50,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'find_daikou.middleware.BackpressureMiddleware',
+    'find_daikou.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'daikoudream.urls'
@@ -99,6 +100,30 @@ DATABASES = {
 if 'test' in sys.argv or 'test_coverage' in sys.argv: #Covers regular testing and django-coverage
     DATABASES['default']['ENGINE'] = 'django.db.backends.sqlite3'
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Tiles and the driver feed change log live here. Point this at a shared
+# backend (memcached, redis) when running more than one process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Memoized distances (find_daikou.distances), kept apart so that their many
+    # long-lived entries do not evict the keys above. Like the default cache,
+    # it is only shared between processes on a shared backend.
+    'distances': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'distances',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -119,6 +144,21 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = 'find_daikou.CustomUser'
 
+# Users and their customer or driver profile are served from the cache
+# (find_daikou.auth). ModelBackend stays listed so sessions created before
+# it was added remain valid.
+AUTHENTICATION_BACKENDS = [
+    'find_daikou.auth.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+DAIKOU_AUTH_CACHE_TIMEOUT = 30
+
+# Sessions are read from the cache and only written through to the database.
+# 'django.contrib.sessions.backends.signed_cookies' avoids the database
+# altogether, at the cost of sessions that cannot be revoked server side.
+# https://docs.djangoproject.com/en/3.2/topics/http/sessions/#configuring-the-session-engine
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
@@ -145,3 +185,165 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
+
+# Vector tiles (find_daikou.tiles)
+DAIKOU_TILE_MIN_ZOOM = 0
+DAIKOU_TILE_MAX_ZOOM = 16
+# Seconds an encoded tile may stay in the cache backend. Tiles are dropped as
+# soon as an order inside them changes, but with a per-process cache
+# (the default LocMemCache) other workers only notice on expiry.
+DAIKOU_TILE_CACHE_TIMEOUT = 60
+# Seconds clients may reuse a tile before revalidating it with its ETag.
+DAIKOU_TILE_MAX_AGE = 5
+
+# Driver feed (find_daikou.feed, find_daikou.wire)
+# Seconds between two polls of the driver feed by the map.
+DAIKOU_FEED_POLL_INTERVAL = 5
+# Number of driver changes, and seconds, a client can fall behind the feed and
+# still be sent only what changed instead of a full snapshot.
+DAIKOU_FEED_LOG_SIZE = 1000
+DAIKOU_FEED_LOG_TIMEOUT = 300
+# Seconds between two rebuilds of the shared full snapshot of the feed
+# (find_daikou.snapshot). Every poll within that window gets the same bytes.
+DAIKOU_SNAPSHOT_INTERVAL = 1.0
+
+# Load shedding of the map polling endpoints (find_daikou.middleware)
+# Polls in flight in one process, or average seconds per database query,
+# past which polls get stale data and a longer poll interval...
+DAIKOU_SHED_DEGRADED_POLLS = 20
+DAIKOU_SHED_DEGRADED_DB_LATENCY = 0.2
+# ...and past which polls without stale data at hand are rejected with a 503.
+DAIKOU_SHED_OVERLOADED_POLLS = 50
+DAIKOU_SHED_OVERLOADED_DB_LATENCY = 1.0
+# Factor the poll interval is stretched by while degraded or overloaded.
+DAIKOU_SHED_POLL_BACKOFF = 4
+# Seconds rejected clients are asked to wait before retrying.
+DAIKOU_SHED_RETRY_AFTER = 10
+
+# Write-behind buffer of driver positions (find_daikou.positions)
+# Seconds between two flushes of buffered positions to the database, or None
+# to only flush on size and at exit.
+DAIKOU_POSITION_FLUSH_INTERVAL = 5
+# Number of buffered drivers that triggers an early flush.
+DAIKOU_POSITION_FLUSH_SIZE = 500
+
+# Geographic zones (find_daikou.zones)
+# Zone name -> (min_lon, min_lat, max_lon, max_lat). The first zone containing
+# a point wins.
+DAIKOU_ZONES = {
+    'tokyo': (138.9, 35.4, 140.0, 36.0),
+    'osaka': (135.0, 34.3, 135.8, 35.0),
+}
+# Size in degrees of the grid cells that serve as zones outside DAIKOU_ZONES.
+DAIKOU_ZONE_GRID_SIZE = 1.0
+# Drivers are shown the open orders of the zones within this many km of them,
+# not only of their own zone (see find_daikou.zones.board_zones).
+DAIKOU_BOARD_MARGIN_KM = 2
+# Seconds dispatch waits for a zone's lock before giving up.
+DAIKOU_ZONE_LOCK_WAIT = 5
+# Seconds after which a zone's dispatch lock expires should its holder die.
+DAIKOU_ZONE_LOCK_TIMEOUT = 30
+
+# Dispatch worker pool (find_daikou.dispatch, `manage.py dispatch`)
+# Seconds a worker's lease on a zone, and its heartbeat, stay valid.
+DAIKOU_DISPATCH_LEASE = 15
+# Seconds between two dispatch passes of a worker.
+DAIKOU_DISPATCH_INTERVAL = 1
+# Most orders of a zone assigned in one pass.
+DAIKOU_DISPATCH_BATCH_SIZE = 100
+# Average driving speed used to estimate pickup times, in km/h.
+DAIKOU_DISPATCH_SPEED_KMH = 30
+
+# Request profiler (find_daikou.profiling)
+# Profile one in this many requests, or none if 0. Staff can always ask for a
+# profile with an X-Daikou-Profile header or a ?profile= query parameter.
+DAIKOU_PROFILE_SAMPLE_RATE = 0
+# 'sampling' or 'cprofile'.
+DAIKOU_PROFILER = 'sampling'
+# Seconds between two stack samples of the sampling profiler.
+DAIKOU_PROFILE_SAMPLE_INTERVAL = 0.001
+# Where profiles are saved, and how many of the newest are kept.
+DAIKOU_PROFILE_DIR = BASE_DIR / 'profiles'
+DAIKOU_PROFILE_KEEP = 100
+
+# Index page and order board (find_daikou.views)
+# Seconds the role-specific part of the index page stays in the cache.
+DAIKOU_INDEX_FRAGMENT_TIMEOUT = 300
+# Seconds browsers may reuse the open orders GeoJSON without revalidating it.
+DAIKOU_ORDER_FEATURES_MAX_AGE = 5
+# Seconds the encoded order board of a zone may stay in the cache backend. It
+# is dropped as soon as an order of the zone changes in this process, but
+# writes from other processes (dispatch workers, the job runner, other web
+# workers) are only noticed on expiry with a per-process cache.
+DAIKOU_ORDER_FEATURES_CACHE_TIMEOUT = 60
+
+# Background job queue (find_daikou.jobs, `manage.py run_jobs`)
+# Run jobs in the enqueueing process right after commit, instead of in workers.
+DAIKOU_JOBS_EAGER = False
+# Seconds an idle worker waits before looking for jobs again.
+DAIKOU_JOB_POLL_INTERVAL = 1
+# Seconds after which a running job is considered lost with its worker, and queued again.
+DAIKOU_JOB_TIMEOUT = 300
+# Longest wait before retrying a failed job, in seconds.
+DAIKOU_JOB_MAX_BACKOFF = 3600
+# Seconds finished jobs (and their idempotency keys) are kept.
+DAIKOU_JOB_KEEP = 86400
+
+# Seconds a customer's list of cars stays in the cache. Saving or deleting a
+# car drops it right away.
+DAIKOU_CAR_CACHE_TIMEOUT = 3600
+
+# Default and largest number of rows on a page of the JSON API.
+DAIKOU_API_PAGE_SIZE = 50
+DAIKOU_API_MAX_PAGE_SIZE = 200
+
+# Demand and supply heatmap: the side of a cell in degrees, the window of
+# pickup times demand is counted over in seconds, and the most cells a view
+# may span.
+DAIKOU_HEATMAP_CELL_SIZE = 0.01
+DAIKOU_HEATMAP_WINDOW = 900
+DAIKOU_HEATMAP_MAX_CELLS = 10000
+# Seconds between two deletions of the empty heatmap cells by the job workers
+# (the `prune_heatmap` job, started by `manage.py run_jobs`).
+DAIKOU_HEATMAP_PRUNE_INTERVAL = 3600
+
+# Seconds the order rollups stay behind, so that orders still being saved
+# are picked up by the next run instead of being missed.
+DAIKOU_ROLLUP_LAG = 60
+# Seconds between two runs of the order rollups by the job workers (the
+# `rollup_orders` job, started by `manage.py run_jobs`).
+DAIKOU_ROLLUP_INTERVAL = 300
+
+# Points of a route closer than this many pixels to the simplified line, at
+# the zoom level it is shown at, are dropped before sending it to the map.
+DAIKOU_ROUTE_TOLERANCE_PIXELS = 1
+
+# Distance cache: points are rounded to this many decimals (3 is about 100 m)
+# before looking up the distance between them, which is kept in a per-process
+# LRU of at most DAIKOU_DISTANCE_LRU_SIZE pairs and in the DAIKOU_DISTANCE_CACHE
+# cache for DAIKOU_DISTANCE_CACHE_TIMEOUT seconds.
+DAIKOU_DISTANCE_CACHE = 'distances'
+DAIKOU_DISTANCE_PRECISION = 3
+DAIKOU_DISTANCE_LRU_SIZE = 10000
+DAIKOU_DISTANCE_CACHE_TIMEOUT = 86400
+
+# Orders are held off the board and out of dispatch until this many seconds
+# before their pickup time (see find_daikou.scheduler).
+DAIKOU_PICKUP_LEAD_TIME = 1800
+# Seconds between two rescans of the held orders by a dispatch worker, behind
+# the release jobs.
+DAIKOU_SCHEDULER_REFRESH_INTERVAL = 60
+
+# Free drivers near a departure point are counted within each of these radii
+# (km), from an in-memory grid of cells this many degrees wide.
+DAIKOU_NEARBY_RADII_KM = (1, 3, 5)
+DAIKOU_NEARBY_CELL_SIZE = 0.02
+
+# Seconds between two full reloads of the in-memory fleet state of a process;
+# in between, it follows the driver feed log (see find_daikou.fleet).
+DAIKOU_FLEET_RELOAD_INTERVAL = 60
+
+# Bulk bookings: the most rides per request, and how far ahead (in seconds)
+# they may be booked.
+DAIKOU_BULK_BOOKING_MAX_ROWS = 500
+DAIKOU_BOOKING_HORIZON = 7 * 86400
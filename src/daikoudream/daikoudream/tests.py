@@ -1,13 +1,45 @@
+import gzip
+import importlib
 import json
+import marshal
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest.mock import patch
 
 from django.core.exceptions import ValidationError
-from django.test import TestCase, Client, RequestFactory
-from datetime import datetime, timedelta, timezone
+from django.test import TestCase, Client, RequestFactory, override_settings
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.utils import timezone
 from django.urls import reverse
-from find_daikou.models import CustomUser, Customer, Car, Driver, Order
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from find_daikou.models import CustomUser, Customer, Car, Driver, Order, DemandCell, DispatchWorker, Job, OrderRollup, SupplyCell, ZoneLease, customer_cars
 from find_daikou.forms import RegistrationForm
-from find_daikou.views import index
+from find_daikou.views import index, create_order_features
+from find_daikou import auth, bookings, dispatch, distances, feed, fleet, heatmap, jobs, middleware, nearby, positions, profiling, rollups, routes, scheduler, simulation, snapshot, tasks, tiles, wire, zones
+
+
+def create_order(username=None, *, customer=None, car=None, pickup=(0.1, 0.2), dropoff=None, pickup_time=None,
+                 **values):
+    # An order picking up at `pickup` and dropping off at `dropoff` (the pickup by default)
+    # at `pickup_time` (now by default), for a new customer named `username` and a new car
+    # unless they are given.
+    if customer is None:
+        username = username or f'ordercustomer{CustomUser.objects.count()}'
+        customer = Customer.objects.create(user=CustomUser.objects.create(username=username))
+    if car is None:
+        car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=customer)
+    dropoff = dropoff or pickup
+    return Order.objects.create(customer=customer, car=car, pickup_latitude=pickup[0], pickup_longitude=pickup[1],
+                                dropoff_latitude=dropoff[0], dropoff_longitude=dropoff[1],
+                                pickup_time=pickup_time or timezone.now(), **values)
+
 
 class RegisterViewTest(TestCase):
     def test_register_view_returns_200_status_code(self):
@@ -289,3 +321,1676 @@ class OrderModelTestCase(TestCase):
         self.user1.delete()
         self.user2.delete()
         self.user3.delete()
+
+class VectorTileTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='tiledriver', password='password')
+        Driver.objects.create(user=self.user, is_available=True, latitude=35.6812, longitude=139.7671)
+        customer = Customer.objects.create(user=CustomUser.objects.create(username='tilecustomer'))
+        car = Car.objects.create(make='Honda', model='Fit', year=2020, customer=customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = Order.objects.create(customer=customer, car=car, pickup_time=timezone.now(),
+                                              pickup_latitude=35.6812, pickup_longitude=139.7671,
+                                              dropoff_latitude=35.0, dropoff_longitude=135.0)
+        self.z = 12
+        self.x, self.y = tiles.tile_for_point(139.7671, 35.6812, self.z)
+        self.url = reverse('vector_tile', args=['orders', self.z, self.x, self.y])
+        self.client.login(username='tiledriver', password='password')
+
+    def test_tile_for_point(self):
+        self.assertEqual(tiles.tile_for_point(0.0, 0.0, 1), (1, 1))
+        self.assertEqual(tiles.tile_for_point(-179.9, 85.0, 1), (0, 0))
+
+    def test_encode_point_layer(self):
+        layer = tiles.encode_layer('orders', [(7, 0.0, 0.0, {'type': 'pickup'})], 1, 1, 1)
+        # Version 2, the layer name, and a point in the top left corner of the tile.
+        self.assertTrue(layer.startswith(b'\x78\x02\x0a\x06orders'))
+        self.assertIn(b'\x22\x03\x09\x00\x00', layer)
+
+    def test_orders_tile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn(b'pickup', response.content)
+        self.assertNotIn(b'dropoff', response.content)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_tile_invalidated_when_order_is_taken(self):
+        self.assertIn(b'pickup', self.client.get(self.url).content)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.complete_order()
+        self.assertNotIn(b'pickup', self.client.get(self.url).content)
+
+    def test_orders_tile_requires_driver(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_layer(self):
+        for layer in ('drivers', 'cars'):
+            response = self.client.get(reverse('vector_tile', args=[layer, self.z, self.x, self.y]))
+            self.assertEqual(response.status_code, 404)
+
+@override_settings(DAIKOU_SNAPSHOT_INTERVAL=0)
+class FleetWireFormatTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.drivers = []
+        for i in range(20):
+            user = CustomUser.objects.create(username=f'wiredriver{i}')
+            self.drivers.append(Driver.objects.create(user=user, is_available=True,
+                                                      latitude=35.0 + i / 100, longitude=139.0 + i / 100))
+        self.url = reverse('driverlist')
+
+    def get_frame(self, **params):
+        response = self.client.get(self.url, params, HTTP_ACCEPT=wire.CONTENT_TYPE)
+        self.assertEqual(response['Content-Type'], wire.CONTENT_TYPE)
+        return response, wire.unpack_frame(response.content)
+
+    def test_pack_unpack_roundtrip(self):
+        data = wire.pack_frame([(2, wire.to_fixed(-33.8688), wire.to_fixed(151.2093))], 7, assigned=2)
+        frame = wire.unpack_frame(data)
+        self.assertEqual(frame['version'], 7)
+        self.assertEqual(frame['assigned'], 2)
+        self.assertEqual(frame['drivers'], [{'id': 2, 'latitude': -33.8688, 'longitude': 151.2093,
+                                             'flags': wire.FLAG_ASSIGNED}])
+
+    def test_full_frame_is_much_smaller_than_json(self):
+        response, frame = self.get_frame()
+        self.assertEqual(frame['type'], 'full')
+        self.assertEqual(len(frame['drivers']), 20)
+        json_size = len(self.client.get(self.url).content)
+        self.assertLess(len(response.content) * 10, json_size)
+
+    def test_delta_frame(self):
+        _, full = self.get_frame()
+        self.assertEqual(full['base'], 0)
+        moved = self.drivers[3]
+        moved.latitude = 36.0
+        gone = self.drivers[5]
+        gone.is_available = False
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.save()
+            gone.save()
+
+        _, delta = self.get_frame(since=full['version'])
+        self.assertEqual(delta['type'], 'delta')
+        self.assertEqual(delta['base'], full['version'])
+        self.assertEqual([d['id'] for d in delta['drivers']], [moved.id])
+        self.assertEqual(delta['drivers'][0]['latitude'], 36.0)
+        self.assertEqual(delta['removed'], [gone.id])
+
+    def test_unknown_version_gets_full_frame(self):
+        _, frame = self.get_frame(since=12345)
+        self.assertEqual(frame['type'], 'full')
+        self.assertEqual(len(frame['drivers']), 20)
+
+@override_settings(DAIKOU_SNAPSHOT_INTERVAL=0)
+class DriverFeedDeltaTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('driverlist')
+        self.drivers = []
+        for i in range(5):
+            user = CustomUser.objects.create(username=f'deltadriver{i}')
+            self.drivers.append(Driver.objects.create(user=user, is_available=True, latitude=35.0, longitude=139.0 + i))
+
+    def test_since_returns_only_changes(self):
+        full = self.client.get(self.url).json()
+        self.assertEqual(len(full['features']), 5)
+
+        self.drivers[0].longitude = 130.0
+        self.drivers[1].is_available = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.drivers[0].save()
+            self.drivers[1].save()
+            user = CustomUser.objects.create(username='newdriver')
+            new_driver = Driver.objects.create(user=user, is_available=True, latitude=34.0, longitude=135.0)
+
+        delta = self.client.get(self.url, {'since': full['version']}).json()
+        self.assertEqual(delta['since'], full['version'])
+        self.assertEqual({f['id'] for f in delta['features']}, {self.drivers[0].id, new_driver.id})
+        self.assertEqual(delta['removed'], [self.drivers[1].id])
+        # GeoJSON order, as in full snapshots
+        moved = next(f for f in delta['features'] if f['id'] == self.drivers[0].id)
+        self.assertEqual(moved['geometry']['coordinates'], [130.0, 35.0])
+        self.assertEqual(next(f for f in full['features'] if f['id'] == self.drivers[1].id)['geometry']['coordinates'],
+                         [140.0, 35.0])
+
+        unchanged = self.client.get(self.url, {'since': delta['version']}).json()
+        self.assertEqual(unchanged['version'], delta['version'])
+        self.assertEqual(unchanged['features'], [])
+
+    def test_saving_without_changes_is_not_logged(self):
+        version = feed.current_version()
+        driver = Driver.objects.get(id=self.drivers[2].id)
+        with self.captureOnCommitCallbacks(execute=True):
+            driver.save()
+        self.assertEqual(feed.current_version(), version)
+
+    def test_falls_back_to_snapshot_outside_log(self):
+        version = feed.current_version()
+        with self.settings(DAIKOU_FEED_LOG_SIZE=2):
+            for i in range(3):
+                self.drivers[3].longitude = 100.0 + i
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.drivers[3].save()
+            self.assertIsNone(feed.changes_since(version))
+            response = self.client.get(self.url, {'since': version}).json()
+        self.assertNotIn('since', response)
+        self.assertEqual(len(response['features']), 5)
+
+class FleetSnapshotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('driverlist')
+        self.customer_user = CustomUser.objects.create_user(username='snapcustomer', password='password')
+        self.customer = Customer.objects.create(user=self.customer_user)
+        self.car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=self.customer)
+        self.drivers = []
+        for i in range(3):
+            user = CustomUser.objects.create(username=f'snapdriver{i}')
+            self.drivers.append(Driver.objects.create(user=user, is_available=True, latitude=35.0, longitude=139.0 + i))
+
+    def test_rebuilds_at_most_once_per_interval(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return snapshot.build_fleet_snapshot()
+
+        publisher = snapshot.SnapshotPublisher('test-fleet', build)
+        with self.settings(DAIKOU_SNAPSHOT_INTERVAL=60):
+            first = publisher.get()
+            for _ in range(10):
+                self.assertIs(publisher.get(), first)
+        self.assertEqual(len(builds), 1)
+        with self.settings(DAIKOU_SNAPSHOT_INTERVAL=0):
+            publisher.get()
+        self.assertEqual(len(builds), 2)
+
+    def test_shared_snapshot_is_gzipped(self):
+        with self.settings(DAIKOU_SNAPSHOT_INTERVAL=0):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(len(data['features']), 3)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_assigned_driver_overlay(self):
+        Order.objects.create(customer=self.customer, car=self.car, driver=self.drivers[1],
+                             pickup_latitude=35.0, pickup_longitude=139.0,
+                             dropoff_latitude=35.1, dropoff_longitude=139.1,
+                             pickup_time=timezone.now())
+        self.client.login(username='snapcustomer', password='password')
+        with self.settings(DAIKOU_SNAPSHOT_INTERVAL=0):
+            data = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip').json()
+            frame = wire.unpack_frame(self.client.get(self.url, HTTP_ACCEPT=wire.CONTENT_TYPE).content)
+        assigned = {f['id']: f['properties']['is_assigned'] for f in data['features']}
+        self.assertEqual(assigned, {self.drivers[0].id: False, self.drivers[1].id: True, self.drivers[2].id: False})
+        self.assertEqual(frame['assigned'], self.drivers[1].id)
+        self.assertEqual([d['flags'] for d in frame['drivers']], [0, wire.FLAG_ASSIGNED, 0])
+
+class BackpressureTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        snapshot.fleet_publisher._snapshot = None
+        self.user = CustomUser.objects.create_user(username='shedcustomer', password='password')
+        self.customer = Customer.objects.create(user=self.user)
+        self.car = Car.objects.create(make='Mazda', model='Demio', year=2015, customer=self.customer)
+        driver_user = CustomUser.objects.create(username='sheddriver')
+        self.driver = Driver.objects.create(user=driver_user, is_available=True, latitude=35.0, longitude=139.0)
+
+    def test_normal_poll_interval_hint(self):
+        response = self.client.get(reverse('driverlist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Poll-Interval'], '5')
+
+    @override_settings(DAIKOU_SHED_DEGRADED_POLLS=0)
+    def test_degraded_serves_stale_snapshot(self):
+        with self.settings(DAIKOU_SHED_DEGRADED_POLLS=20):
+            self.client.get(reverse('driverlist'))
+        self.driver.is_available = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.driver.save()
+
+        response = self.client.get(reverse('driverlist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Poll-Interval'], '20')
+        self.assertEqual(len(response.json()['features']), 1)
+
+    @override_settings(DAIKOU_SHED_OVERLOADED_POLLS=0)
+    def test_overloaded_rejects_polls_without_stale_data(self):
+        response = self.client.get(reverse('driverlist'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '10')
+
+    @override_settings(DAIKOU_SHED_OVERLOADED_POLLS=0)
+    def test_overloaded_serves_cached_order_board(self):
+        CustomUser.objects.filter(id=self.driver.user_id).update(password=self.user.password)
+        self.client.login(username='sheddriver', password='password')
+        self.assertEqual(self.client.get(reverse('order_features')).status_code, 503)
+        with self.settings(DAIKOU_SHED_OVERLOADED_POLLS=50):
+            self.client.get(reverse('order_features'))
+        response = self.client.get(reverse('order_features'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Poll-Interval'], '20')
+        # Page loads are not polls
+        self.assertEqual(self.client.get(reverse('index')).status_code, 200)
+
+    @override_settings(DAIKOU_SHED_OVERLOADED_POLLS=0)
+    def test_booking_is_never_shed(self):
+        self.client.login(username='shedcustomer', password='password')
+        response = self.client.get(reverse('call_driver'), {
+            'time': '2030-01-01T20:00', 'departure': '139.0,35.0', 'arrival': '139.1,35.1', 'car': self.car.id,
+        })
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+        self.assertTrue(Order.objects.filter(customer=self.customer).exists())
+
+    def test_db_latency_raises_level(self):
+        monitor = middleware.LoadMonitor()
+        self.assertEqual(monitor.level(), middleware.NORMAL)
+        monitor.record_query(0.5)
+        self.assertEqual(monitor.level(), middleware.DEGRADED)
+        monitor.record_query(5.0)
+        self.assertEqual(monitor.level(), middleware.OVERLOADED)
+
+class CachedAuthTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='authcustomer', password='password')
+        self.customer = Customer.objects.create(user=self.user)
+        self.backend = auth.CachedModelBackend()
+
+    def test_cached_user_and_profile_need_no_queries(self):
+        self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.customer, self.customer)
+            self.assertFalse(hasattr(user, 'driver'))
+
+    @override_settings(DAIKOU_SNAPSHOT_INTERVAL=60)
+    def test_authenticated_poll_has_no_auth_queries(self):
+        self.client.login(username='authcustomer', password='password')
+        self.client.get(reverse('driverlist'))
+        # Only the lookup of the customer's order remains.
+        with self.assertNumQueries(1):
+            self.client.get(reverse('driverlist'))
+
+    def test_modify_user_invalidates_cache(self):
+        self.client.login(username='authcustomer', password='password')
+        self.backend.get_user(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('modify_user'), {'first_name': 'Hanako', 'address': 'Tokyo', 'phone': '42'})
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'Hanako')
+
+    def test_logout_invalidates_cache(self):
+        self.client.login(username='authcustomer', password='password')
+        self.backend.get_user(self.user.pk)
+        self.client.post(reverse('logout'))
+        self.assertIsNone(cache.get(auth.user_cache_key(self.user.pk)))
+
+@override_settings(DAIKOU_POSITION_FLUSH_INTERVAL=None, DAIKOU_SNAPSHOT_INTERVAL=0)
+class PositionBufferTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='movingdriver', password='password')
+        self.driver = Driver.objects.create(user=self.user, is_available=True, latitude=35.0, longitude=139.0)
+        self.client.login(username='movingdriver', password='password')
+
+    def tearDown(self):
+        positions.buffer.discard(self.driver.id)
+
+    def move(self, latitude, longitude):
+        response = self.client.post(reverse('update_position'), {'latitude': latitude, 'longitude': longitude})
+        self.assertEqual(response.json(), {'success': True})
+
+    def test_buffered_position_is_visible_before_flush(self):
+        self.move(35.5, 139.5)
+        self.move(35.6, 139.6)
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.latitude, self.driver.longitude), (35.0, 139.0))
+
+        feature = self.client.get(reverse('driverlist')).json()['features'][0]
+        self.assertEqual(feature['geometry']['coordinates'], [139.6, 35.6])
+
+    def test_flush_writes_latest_position(self):
+        self.move(35.5, 139.5)
+        self.move(35.6, 139.6)
+        self.assertEqual(positions.buffer.flush(), 1)
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.latitude, self.driver.longitude), (35.6, 139.6))
+        self.assertIsNone(positions.buffer.get(self.driver.id))
+
+    @override_settings(DAIKOU_POSITION_FLUSH_SIZE=1)
+    def test_flush_on_size(self):
+        self.move(36.0, 140.0)
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.latitude, self.driver.longitude), (36.0, 140.0))
+
+    def test_direct_write_discards_buffered_position(self):
+        self.move(35.5, 139.5)
+        self.client.post(reverse('modify_user'), {'latitude': 34.0, 'longitude': 135.0})
+        self.assertIsNone(positions.buffer.get(self.driver.id))
+        positions.buffer.flush()
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.latitude, self.driver.longitude), (34.0, 135.0))
+
+    def test_rejects_non_drivers(self):
+        CustomUser.objects.create_user(username='walker', password='password')
+        self.client.login(username='walker', password='password')
+        response = self.client.post(reverse('update_position'), {'latitude': 1, 'longitude': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_invalid_positions(self):
+        for latitude, longitude in (('nan', 139.0), (35.0, 'inf'), (91, 139.0), (35.0, -181)):
+            response = self.client.post(reverse('update_position'), {'latitude': latitude, 'longitude': longitude})
+            self.assertEqual(response.status_code, 400)
+        self.assertIsNone(positions.buffer.get(self.driver.id))
+        with self.assertRaises(ValueError):
+            positions.buffer.update(self.driver, float('nan'), 139.0)
+        self.assertIsNone(positions.buffer.get(self.driver.id))
+
+    def test_bad_row_does_not_block_flush(self):
+        other = Driver.objects.create(user=CustomUser.objects.create(username='otherdriver'), latitude=35.0, longitude=139.0)
+        self.move(35.5, 139.5)
+        # Slipped in some other way than `update`
+        with positions.buffer._lock:
+            positions.buffer._positions[other.id] = (float('nan'), 139.0)
+            positions.buffer._origins[other.id] = (35.0, 139.0)
+            positions.buffer._users[other.id] = other.user_id
+        with self.assertLogs('find_daikou.positions', 'WARNING') as logs:
+            self.assertEqual(positions.buffer.flush(), 1)
+        self.assertIn(f'of driver {other.id}', logs.output[0])
+        self.assertEqual(positions.buffer.pending(), {})
+        self.driver.refresh_from_db()
+        self.assertEqual((self.driver.latitude, self.driver.longitude), (35.5, 139.5))
+
+@override_settings(DAIKOU_ZONES={'tokyo': (139.0, 35.0, 140.0, 36.0)}, DAIKOU_ZONE_GRID_SIZE=1.0, DAIKOU_SNAPSHOT_INTERVAL=0)
+class ZoneTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer_user = CustomUser.objects.create_user(username='zonecustomer', password='password')
+        self.customer = Customer.objects.create(user=self.customer_user)
+        self.tokyo_user = CustomUser.objects.create_user(username='tokyodriver', password='password')
+        self.tokyo = Driver.objects.create(user=self.tokyo_user, is_available=True, latitude=35.6, longitude=139.7)
+        self.osaka = Driver.objects.create(user=CustomUser.objects.create(username='osakadriver'),
+                                           is_available=True, latitude=34.7, longitude=135.5)
+
+    def test_zone_for(self):
+        self.assertEqual(zones.zone_for(35.6, 139.7), 'tokyo')
+        self.assertEqual(zones.zone_for(34.7, 135.5), 'grid:34:135')
+        self.assertEqual(zones.zone_for(-33.9, 151.2), 'grid:-34:151')
+
+    def test_zone_follows_position(self):
+        self.assertEqual(self.tokyo.zone, 'tokyo')
+        self.assertEqual(self.osaka.zone, 'grid:34:135')
+        self.tokyo.latitude, self.tokyo.longitude = 34.7, 135.5
+        self.tokyo.save(update_fields=['latitude', 'longitude'])
+        self.assertEqual(Driver.objects.get(id=self.tokyo.id).zone, 'grid:34:135')
+        self.assertEqual(create_order(customer=self.customer, pickup=(35.6, 139.7)).zone, 'tokyo')
+
+    def test_feed_is_scoped_to_zone(self):
+        url = reverse('driverlist')
+        ids = lambda data: [f['id'] for f in data['features']]
+        self.assertEqual(ids(self.client.get(url, {'zone': 'tokyo'}).json()), [self.tokyo.id])
+        self.assertEqual(ids(self.client.get(url, {'zone': 'grid:34:135'}).json()), [self.osaka.id])
+        self.assertEqual(sorted(ids(self.client.get(url).json())), sorted([self.tokyo.id, self.osaka.id]))
+
+    def test_order_board_is_scoped_to_zone(self):
+        tokyo_order = create_order(customer=self.customer, pickup=(35.6, 139.7))
+        other = Customer.objects.create(user=CustomUser.objects.create(username='osakacustomer'))
+        create_order(customer=other, pickup=(34.7, 135.5))
+        self.client.login(username='tokyodriver', password='password')
+        features = self.client.get(reverse('order_features')).json()['features']
+        self.assertEqual({f['properties']['id'] for f in features}, {tokyo_order.id})
+
+    def test_board_zones(self):
+        self.assertEqual(zones.board_zones(35.6, 139.7), ['tokyo'])
+        # A few hundred metres from the western edge of tokyo.
+        self.assertEqual(zones.board_zones(35.6, 139.005), ['grid:35:138', 'tokyo'])
+        self.assertEqual(zones.board_zones(0, 0), [''])
+
+    def test_board_reaches_across_zone_edges(self):
+        across = create_order(customer=self.customer, pickup=(35.6, 138.995))
+        other = Customer.objects.create(user=CustomUser.objects.create(username='osakacustomer'))
+        osaka_order = create_order(customer=other, pickup=(34.7, 135.5))
+        self.tokyo.longitude = 139.005
+        self.tokyo.save()
+        self.client.login(username='tokyodriver', password='password')
+        features = self.client.get(reverse('order_features')).json()['features']
+        self.assertEqual({f['properties']['id'] for f in features}, {across.id})
+        board = self.client.get(reverse('api_v1:order_board')).json()['results']
+        self.assertEqual([order['id'] for order in board], [across.id])
+
+        # Until it reports a position, a driver sees every zone.
+        newcomer = CustomUser.objects.create_user(username='newdriver', password='password')
+        Driver.objects.create(user=newcomer, is_available=True)
+        self.client.login(username='newdriver', password='password')
+        features = self.client.get(reverse('order_features')).json()['features']
+        self.assertEqual({f['properties']['id'] for f in features}, {across.id, osaka_order.id})
+
+    def test_booking_through_the_map(self):
+        Car.objects.create(make='Toyota', model='Prius', year=2020, customer=self.customer)
+        self.client.login(username='zonecustomer', password='password')
+        # As the map sends them, longitude first
+        response = self.client.get(reverse('call_driver'), {
+            'time': timezone.now().isoformat(), 'departure': '139.77,35.68', 'arrival': '139.70,35.66',
+            'car': self.customer.cars.get().id,
+        })
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+        order = Order.objects.get(customer=self.customer)
+        self.assertEqual((order.pickup_latitude, order.pickup_longitude), (35.68, 139.77))
+        self.assertEqual((order.dropoff_latitude, order.dropoff_longitude), (35.66, 139.70))
+        self.assertEqual(order.zone, 'tokyo')
+
+        self.client.login(username='tokyodriver', password='password')
+        features = self.client.get(reverse('order_features')).json()['features']
+        self.assertEqual([(f['properties']['type'], f['geometry']['coordinates']) for f in features],
+                         [('pickup', [139.77, 35.68]), ('dropoff', [139.70, 35.66])])
+        suggestion = self.client.get(reverse('eta_suggestion'), {'order_id': order.id}).json()
+        self.assertLess(suggestion['km'], 20)
+
+    def test_zone_migration_assigns_zones(self):
+        migration = importlib.import_module('find_daikou.migrations.0015_driver_zone_order_zone')
+        order = create_order(customer=self.customer, pickup=(35.6, 139.7))
+        Order.objects.update(zone='')
+        Driver.objects.update(zone='')
+        migration.assign_zones(django_apps, None)
+        self.assertEqual(Order.objects.get(id=order.id).zone, 'tokyo')
+        self.assertEqual(dict(Driver.objects.values_list('id', 'zone')),
+                         {self.tokyo.id: 'tokyo', self.osaka.id: 'grid:34:135'})
+
+    def test_migration_puts_swapped_orders_right(self):
+        migration = importlib.import_module('find_daikou.migrations.0022_fix_swapped_order_coordinates')
+        swapped = create_order(customer=self.customer, pickup=(35.68, 139.77))
+        Order.objects.filter(id=swapped.id).update(pickup_latitude=139.77, pickup_longitude=35.68,
+                                                   dropoff_latitude=139.70, dropoff_longitude=35.66, zone='grid:139:35')
+        other = Customer.objects.create(user=CustomUser.objects.create(username='rightcustomer'))
+        right = create_order(customer=other, pickup=(34.7, 135.5))
+        migration.swap_coordinates(django_apps, None)
+        swapped.refresh_from_db()
+        self.assertEqual((swapped.pickup_latitude, swapped.pickup_longitude, swapped.dropoff_latitude,
+                          swapped.dropoff_longitude, swapped.zone), (35.68, 139.77, 35.66, 139.70, 'tokyo'))
+        self.assertEqual(Order.objects.values_list('pickup_latitude', 'zone').get(id=right.id), (34.7, 'grid:34:135'))
+
+    def test_booking_rejects_invalid_points(self):
+        Car.objects.create(make='Toyota', model='Prius', year=2020, customer=self.customer)
+        self.client.login(username='zonecustomer', password='password')
+        for departure in ('35.68', '139.77,95', 'nan,35.68'):
+            response = self.client.get(reverse('call_driver'), {
+                'time': timezone.now().isoformat(), 'departure': departure, 'arrival': '139.70,35.66',
+                'car': self.customer.cars.get().id,
+            })
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_zone_lock(self):
+        with zones.zone_lock('tokyo'):
+            with self.assertRaises(zones.ZoneLockTimeout):
+                with zones.zone_lock('tokyo', timeout=0):
+                    pass
+            with zones.zone_lock('grid:34:135', timeout=0):
+                pass
+        with zones.zone_lock('tokyo', timeout=0):
+            pass
+
+    def test_expired_zone_lock_holder_keeps_the_next_lock(self):
+        with zones.zone_lock('tokyo'):
+            # Expired while held, and taken by someone else.
+            cache.delete('zone-lock:tokyo')
+            cache.add('zone-lock:tokyo', 'other')
+        self.assertEqual(cache.get('zone-lock:tokyo'), 'other')
+
+    def test_confirm_order_waits_for_zone_lock(self):
+        order = create_order(customer=self.customer, pickup=(35.6, 139.7))
+        self.client.login(username='tokyodriver', password='password')
+        url = reverse('confirm_order') + f'?order_id={order.id}&time_to_pickup=5'
+        with zones.zone_lock('tokyo'), self.settings(DAIKOU_ZONE_LOCK_WAIT=0):
+            self.assertEqual(self.client.get(url).status_code, 503)
+        self.client.get(url)
+        order.refresh_from_db()
+        self.assertEqual(order.driver, self.tokyo)
+
+@override_settings(DAIKOU_ZONES={'tokyo': (139.0, 35.0, 140.0, 36.0), 'osaka': (135.0, 34.0, 136.0, 35.0)})
+class DispatchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.drivers = {}
+        for name, latitude, longitude in [('near', 35.60, 139.70), ('far', 35.90, 139.95), ('kansai', 34.70, 135.50)]:
+            user = CustomUser.objects.create(username=f'{name}driver')
+            self.drivers[name] = Driver.objects.create(user=user, is_available=True, latitude=latitude, longitude=longitude)
+
+    def test_lease_has_one_owner(self):
+        self.assertTrue(dispatch.acquire_lease('tokyo', 'a'))
+        self.assertFalse(dispatch.acquire_lease('tokyo', 'b'))
+        self.assertTrue(dispatch.acquire_lease('tokyo', 'a'))
+        ZoneLease.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(dispatch.acquire_lease('tokyo', 'b'))
+        self.assertEqual(ZoneLease.objects.get(zone='tokyo').owner, 'b')
+
+    def test_dispatch_assigns_nearest_driver(self):
+        first = create_order('first', pickup=(35.61, 139.71))
+        second = create_order('second', pickup=(35.62, 139.72))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(dispatch.dispatch_zone('tokyo'), 2)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.driver, self.drivers['near'])
+        self.assertEqual(second.driver, self.drivers['far'])
+        self.assertIsNotNone(first.eta)
+        self.assertEqual(dispatch.dispatch_zone('tokyo'), 0)
+
+    def test_workers_share_zones_and_take_over_dead_ones(self):
+        create_order('tokyo', pickup=(35.61, 139.71))
+        create_order('osaka', pickup=(34.71, 135.51))
+        a, b = dispatch.Worker('a'), dispatch.Worker('b')
+        a.heartbeat()
+        b.heartbeat()
+        self.assertEqual(len(dispatch.rebalance('a')), 1)
+        self.assertEqual(len(dispatch.rebalance('b')), 1)
+        self.assertEqual(ZoneLease.objects.values('owner').distinct().count(), 2)
+
+        # b dies: its heartbeat and lease run out, and a takes over.
+        DispatchWorker.objects.filter(name='b').update(heartbeat_at=timezone.now() - timedelta(minutes=1))
+        ZoneLease.objects.filter(owner='b').update(expires_at=timezone.now() - timedelta(seconds=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(a.run_once(), 2)
+        self.assertEqual(DispatchWorker.objects.get(name='a').orders_dispatched, 2)
+        self.assertFalse(Order.objects.filter(driver=None).exists())
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(DAIKOU_PROFILE_DIR=directory.name, DAIKOU_PROFILE_SAMPLE_RATE=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.staff = CustomUser.objects.create_user(username='staff', password='password', is_staff=True)
+        CustomUser.objects.create_user(username='visitor', password='password')
+
+    def test_staff_can_profile_a_request(self):
+        self.client.login(username='staff', password='password')
+        response = self.client.get(reverse('index'), {'profile': 'sampling'})
+        name = response[profiling.HEADER]
+        [profile] = profiling.list_profiles()
+        self.assertEqual(profile['name'], name)
+        self.assertEqual(profile['view'], 'index')
+        self.assertEqual(profile['mode'], profiling.SAMPLING)
+        self.assertEqual(profile['query_count'], len(profile['queries']))
+        self.assertIn(f'{name}.folded', profile['files'])
+
+        response = self.client.get(reverse('index'), HTTP_X_DAIKOU_PROFILE='cprofile')
+        stats = marshal.loads(profiling.profile_file(response[profiling.HEADER] + '.prof').read_bytes())
+        self.assertTrue(any(func[2] == 'index' for func in stats))
+
+    def test_others_cannot_ask_for_profiles(self):
+        self.client.login(username='visitor', password='password')
+        response = self.client.get(reverse('index'), {'profile': 'sampling'})
+        self.assertNotIn(profiling.HEADER, response)
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_sampled_requests_are_profiled(self):
+        with self.settings(DAIKOU_PROFILE_SAMPLE_RATE=1):
+            self.assertIn(profiling.HEADER, self.client.get(reverse('index')))
+
+    def test_admin_lists_and_serves_profiles(self):
+        self.client.login(username='staff', password='password')
+        name = self.client.get(reverse('index'), {'profile': '1'})[profiling.HEADER]
+        response = self.client.get(reverse('profile_list'))
+        self.assertContains(response, f'{name}.folded')
+        response = self.client.get(reverse('profile_download', args=[f'{name}.json']))
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['name'], name)
+        self.assertEqual(self.client.get(reverse('profile_download', args=['settings.py'])).status_code, 404)
+
+        self.client.login(username='visitor', password='password')
+        self.assertEqual(self.client.get(reverse('profile_list')).status_code, 302)
+
+    def test_keeps_newest_profiles(self):
+        with self.settings(DAIKOU_PROFILE_KEEP=2):
+            names = [profiling.save_profile({}, {'folded': b''}) for _ in range(3)]
+        self.assertEqual(len(profiling.list_profiles()), 2)
+        self.assertIsNone(profiling.profile_file(f'{min(names)}.folded'))
+
+class OrderFeaturesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('order_features')
+        self.driver_user = CustomUser.objects.create_user(username='boarddriver', password='password')
+        Driver.objects.create(user=self.driver_user, is_available=True, latitude=0.0, longitude=0.0)
+        self.client.login(username='boarddriver', password='password')
+
+    def create_order(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_order(name, dropoff=(0.3, 0.4))
+
+    def test_serves_open_orders(self):
+        order = self.create_order('boardcustomer')
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        features = json.loads(gzip.decompress(response.content))['features']
+        self.assertEqual([(f['properties']['id'], f['properties']['type'], f['geometry']['coordinates']) for f in features],
+                         [(order.id, 'pickup', [0.2, 0.1]), (order.id, 'dropoff', [0.4, 0.3])])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_new_orders_invalidate_the_board(self):
+        etag = self.client.get(self.url)['ETag']
+        self.create_order('boardcustomer')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['features']), 2)
+
+    def test_board_expires(self):
+        order = self.create_order('boardcustomer')
+        self.assertEqual(len(self.client.get(self.url).json()['features']), 2)
+        # Written by another process: no invalidation here
+        Order.objects.filter(id=order.id).update(pickup_latitude=0.5)
+        self.assertEqual(self.client.get(self.url).json()['features'][0]['geometry']['coordinates'], [0.2, 0.1])
+        with self.settings(DAIKOU_ORDER_FEATURES_CACHE_TIMEOUT=0):
+            cache.clear()
+            self.client.get(self.url)
+            Order.objects.filter(id=order.id).update(pickup_latitude=0.6)
+            self.assertEqual(self.client.get(self.url).json()['features'][0]['geometry']['coordinates'], [0.2, 0.6])
+
+    def test_only_drivers_see_orders(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_index_does_not_grow_with_orders(self):
+        empty = self.client.get(reverse('index')).content
+        for i in range(5):
+            self.create_order(f'boardcustomer{i}')
+        self.assertEqual(self.client.get(reverse('index')).content, empty)
+        self.assertIn('csrftoken', self.client.cookies)
+
+class OrderFeatureBuildingTestCase(TestCase):
+    def test_builds_features_without_geos(self):
+        order = Order(id=7, pickup_latitude=35.1, pickup_longitude=139.1, dropoff_latitude=35.2, dropoff_longitude=139.2)
+        features = create_order_features([order])
+        self.assertEqual([(f['properties']['type'], f['geometry']['coordinates']) for f in features],
+                         [('pickup', [139.1, 35.1]), ('dropoff', [139.2, 35.2])])
+        self.assertNotIn('django.contrib.gis.geos', sys.modules)
+
+job_calls = []
+
+@jobs.job('test_record', max_attempts=3, backoff=10)
+def record_job(value, fail=False):
+    job_calls.append(value)
+    if fail:
+        raise RuntimeError('failed')
+
+@jobs.job('test_batch', batch_size=10)
+def record_batch(payloads):
+    job_calls.append(sorted(payload['value'] for payload in payloads))
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        job_calls.clear()
+
+    def test_runs_higher_priority_first(self):
+        jobs.enqueue('test_record', {'value': 'low'})
+        jobs.enqueue('test_record', {'value': 'high'}, priority=10)
+        jobs.enqueue('test_record', {'value': 'later'}, delay=60)
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertEqual(job_calls, ['high', 'low'])
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_retries_with_backoff(self):
+        queued = jobs.enqueue('test_record', {'value': 1, 'fail': True})
+        with self.assertLogs('find_daikou.jobs', 'ERROR'):
+            jobs.run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.QUEUED, 1))
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(seconds=9))
+        self.assertIn('RuntimeError', queued.last_error)
+
+        for _ in range(2):
+            Job.objects.update(run_at=timezone.now())
+            with self.assertLogs('find_daikou.jobs', 'ERROR'):
+                jobs.run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.FAILED, 3))
+        self.assertEqual(job_calls, [1, 1, 1])
+
+    def test_batches_similar_jobs(self):
+        for value in range(3):
+            jobs.enqueue('test_batch', {'value': value}, batch_key='a')
+        jobs.enqueue('test_batch', {'value': 9}, batch_key='b')
+        self.assertEqual(jobs.run_pending(), 4)
+        self.assertEqual(sorted(job_calls), [[0, 1, 2], [9]])
+
+    def test_idempotency_key(self):
+        first = jobs.enqueue('test_record', {'value': 1}, idempotency_key='once')
+        second = jobs.enqueue('test_record', {'value': 2}, idempotency_key='once')
+        self.assertEqual(first.id, second.id)
+        jobs.run_pending()
+        self.assertEqual(job_calls, [1])
+
+    def test_requeues_jobs_of_dead_workers(self):
+        jobs.enqueue('test_record', {'value': 1})
+        jobs.claim('dead')
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+
+    @override_settings(DAIKOU_JOBS_EAGER=True)
+    def test_eager_jobs_run_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            jobs.enqueue('test_record', {'value': 1})
+            self.assertEqual(job_calls, [])
+        self.assertEqual(job_calls, [1])
+
+class CustomerCarCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='carowner', password='password')
+        self.customer = Customer.objects.create(user=self.user)
+        self.car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=self.customer)
+        self.client.login(username='carowner', password='password')
+
+    def car_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            result = func()
+        return result, [q['sql'] for q in queries if 'find_daikou_car' in q['sql']]
+
+    def book(self, car_id):
+        return self.client.get(reverse('call_driver'), {
+            'time': '2030-01-01T20:00', 'departure': '139.7,35.6', 'arrival': '139.8,35.7', 'car': car_id,
+        })
+
+    def test_booking_reads_cars_from_cache(self):
+        response, queries = self.car_queries(lambda: self.client.get(reverse('index')))
+        self.assertContains(response, 'Toyota Prius (2020)')
+        self.assertEqual(len(queries), 1)
+        response, queries = self.car_queries(lambda: self.book(self.car.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(queries, [])
+        self.assertEqual(Order.objects.get(customer=self.customer).car, self.car)
+
+    def test_adding_and_deleting_cars_invalidates(self):
+        self.assertEqual(len(customer_cars(self.customer.id)), 1)
+        self.client.post(reverse('add_car'), {'make': 'Honda', 'model': 'Fit', 'year': 2019})
+        self.assertEqual([car.make for car in customer_cars(self.customer.id)], ['Toyota', 'Honda'])
+        self.car.delete()
+        self.assertEqual([car.make for car in customer_cars(self.customer.id)], ['Honda'])
+
+    def test_cannot_book_someone_elses_car(self):
+        other = Customer.objects.create(user=CustomUser.objects.create(username='othercarowner'))
+        other_car = Car.objects.create(make='Honda', model='Fit', year=2019, customer=other)
+        self.assertEqual(self.book(other_car.id).status_code, 404)
+        self.assertFalse(Order.objects.exists())
+
+
+class ApiV1TestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.driver_user = CustomUser.objects.create_user(username='apidriver', password='password')
+        self.driver = Driver.objects.create(user=self.driver_user, is_available=True, latitude=35.6, longitude=139.7)
+        self.customer_user = CustomUser.objects.create_user(username='apicustomer', password='password')
+        self.customer = Customer.objects.create(user=self.customer_user)
+        self.car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=self.customer)
+
+    def get(self, name, **params):
+        return self.client.get(reverse(f'api_v1:{name}'), params)
+
+    def test_sparse_fields_only_query_what_they_need(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get('drivers', fields='id,latitude')
+        self.assertEqual(response.json(), {'results': [{'id': self.driver.id, 'latitude': 35.6}], 'next': None})
+        sql = ' '.join(q['sql'] for q in queries)
+        self.assertNotIn('"longitude"', sql)
+        self.assertNotIn('find_daikou_customuser', sql)
+        self.assertEqual(self.get('drivers', fields='name')['Content-Type'], 'application/json')
+        self.assertEqual(self.get('drivers', fields='name').json()['results'], [{'name': 'apidriver'}])
+        self.assertEqual(self.get('drivers', fields='password').status_code, 400)
+
+    def test_cursor_pagination(self):
+        for i in range(4):
+            user = CustomUser.objects.create(username=f'apipaged{i}')
+            Driver.objects.create(user=user, is_available=True, latitude=0.0, longitude=0.0)
+        seen, cursor = [], None
+        while True:
+            page = self.get('drivers', fields='id', limit=2, **({'cursor': cursor} if cursor else {})).json()
+            seen += [row['id'] for row in page['results']]
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted(Driver.objects.values_list('id', flat=True)))
+        self.assertEqual(self.get('drivers', cursor='!!').status_code, 400)
+        self.assertEqual(self.get('drivers', limit='0').status_code, 400)
+
+    def test_compressed_and_revalidated(self):
+        for i in range(10):
+            user = CustomUser.objects.create(username=f'apicompressed{i}')
+            Driver.objects.create(user=user, is_available=True, latitude=0.0, longitude=0.0)
+        response = self.client.get(reverse('api_v1:drivers'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))['results']), 11)
+        response = self.client.get(reverse('api_v1:drivers'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_order_board_is_for_drivers(self):
+        order = create_order()
+        self.driver.latitude, self.driver.longitude = 0.1, 0.2
+        self.driver.save()
+        self.assertEqual(self.get('order_board').status_code, 401)
+        self.client.login(username='apicustomer', password='password')
+        self.assertEqual(self.get('order_board').status_code, 403)
+        self.client.login(username='apidriver', password='password')
+        self.assertEqual(self.get('order_board', fields='id,status').json()['results'],
+                         [{'id': order.id, 'status': 'waiting'}])
+
+    def test_active_order_and_history(self):
+        done = create_order(customer=self.customer, car=self.car, completed=True)
+        self.client.login(username='apicustomer', password='password')
+        self.assertEqual(self.get('active_order').json(), {'order': None})
+        active = create_order(customer=self.customer, car=self.car, driver=self.driver, eta=timezone.now())
+        order = self.get('active_order', fields='id,status,driver,eta').json()['order']
+        self.assertEqual((order['id'], order['status'], order['driver']), (active.id, 'assigned', 'apidriver'))
+        self.assertIsNotNone(order['eta'])
+        history = self.get('order_history', fields='id,status').json()['results']
+        self.assertEqual(history, [{'id': active.id, 'status': 'assigned'}, {'id': done.id, 'status': 'completed'}])
+
+    def test_route_is_opt_in(self):
+        self.client.login(username='apicustomer', password='password')
+        create_order(customer=self.customer, car=self.car, completed=True, route=routes.encode([(35.0, 139.0), (35.1, 139.1)]))
+        order = self.get('order_history').json()['results'][0]
+        self.assertNotIn('route', order)
+        self.assertIn('status', order)
+        self.assertEqual(self.get('order_history', fields='id,route').json()['results'][0]['route'],
+                         routes.encode([(35.0, 139.0), (35.1, 139.1)]))
+
+    def test_cars(self):
+        self.client.login(username='apicustomer', password='password')
+        self.assertEqual(self.get('cars', fields='make,year').json()['results'], [{'make': 'Toyota', 'year': 2020}])
+
+
+@override_settings(DAIKOU_POSITION_FLUSH_INTERVAL=None, DAIKOU_SNAPSHOT_INTERVAL=0)
+class HeatmapTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.pickup_time = timezone.now()
+        self.driver_user = CustomUser.objects.create_user(username='heatdriver', password='password')
+        self.driver = Driver.objects.create(user=self.driver_user, is_available=True, latitude=35.005, longitude=139.005)
+
+    def tearDown(self):
+        positions.buffer.discard(self.driver.id)
+
+    def demand(self):
+        return {(x, y): pending for x, y, pending in DemandCell.objects.filter(
+            window=heatmap.window_for(self.pickup_time), pending__gt=0).values_list('x', 'y', 'pending')}
+
+    def supply(self):
+        return dict(((x, y), available) for x, y, available in
+                    SupplyCell.objects.filter(available__gt=0).values_list('x', 'y', 'available'))
+
+    def test_orders_count_while_waiting(self):
+        first = create_order('heatcustomer1', pickup=(35.005, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        second = create_order('heatcustomer2', pickup=(35.005, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        create_order('heatcustomer3', pickup=(35.015, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        self.assertEqual(self.demand(), {(13900, 3500): 2, (13900, 3501): 1})
+        first.assign_driver(self.driver)
+        second.complete_order()
+        self.assertEqual(self.demand(), {(13900, 3501): 1})
+        first.unassign_driver()
+        self.assertEqual(self.demand(), {(13900, 3500): 1, (13900, 3501): 1})
+        Order.objects.get(id=first.id).delete()
+        self.assertEqual(self.demand(), {(13900, 3501): 1})
+
+    def test_drivers_count_while_available(self):
+        self.assertEqual(self.supply(), {(13900, 3500): 1})
+        positions.buffer.update(self.driver, 35.025, 139.035)
+        positions.buffer.flush()
+        self.assertEqual(self.supply(), {(13903, 3502): 1})
+        driver = Driver.objects.get(id=self.driver.id)
+        driver.is_available = False
+        driver.save()
+        self.assertEqual(self.supply(), {})
+
+    def test_rebuild_matches_counters(self):
+        create_order('heatcustomer1', pickup=(35.005, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        create_order('heatcustomer2', pickup=(35.015, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        demand, supply = self.demand(), self.supply()
+        DemandCell.objects.update(pending=7)
+        self.assertEqual(heatmap.rebuild(), (2, 1))
+        self.assertEqual((self.demand(), self.supply()), (demand, supply))
+
+    def test_prune_deletes_empty_cells(self):
+        taken = create_order('heatcustomer1', pickup=(35.005, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        create_order('heatcustomer2', pickup=(35.015, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        taken.assign_driver(self.driver)
+        self.assertEqual(DemandCell.objects.count(), 2)
+        self.assertEqual(heatmap.prune(), (1, 0))
+        self.assertEqual(list(DemandCell.objects.values_list('x', 'y', 'pending')), [(13900, 3501, 1)])
+        self.assertEqual(self.supply(), {(13900, 3500): 1})
+        # A pruned cell is created again when something counts in it.
+        taken.unassign_driver()
+        self.assertEqual(self.demand(), {(13900, 3500): 1, (13900, 3501): 1})
+
+    def test_serves_cells_in_view(self):
+        create_order('heatcustomer1', pickup=(35.005, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        create_order('heatcustomer2', pickup=(36.0, 139.005), dropoff=(35.1, 139.1), pickup_time=self.pickup_time)
+        url = reverse('heatmap')
+        self.assertEqual(self.client.get(url, {'bbox': '139,35,139.1,35.1'}).status_code, 404)
+        self.client.login(username='heatdriver', password='password')
+        self.client.get(url, {'bbox': '139,35,139.1,35.1'})
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'bbox': '139,35,139.1,35.1', 'window': self.pickup_time.isoformat()})
+        features = response.json()['features']
+        self.assertEqual([f['properties'] for f in features], [{'x': 13900, 'y': 3500, 'demand': 1, 'supply': 1}])
+        self.assertEqual(features[0]['geometry']['coordinates'][0][0], [139.0, 35.0])
+        self.assertEqual(self.client.get(url, {'bbox': '0,0,90,90'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'bbox': 'nowhere'}).status_code, 400)
+        for bbox in ('nan,0,1,1', '0,0,inf,1', '0,0,1,91', '-181,0,1,1'):
+            self.assertEqual(self.client.get(url, {'bbox': bbox}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'bbox': '139,35,139.1,35.1', 'window': '2026-13-45T00:00'}).status_code, 400)
+
+
+@override_settings(DAIKOU_ROLLUP_LAG=0)
+class OrderRollupTestCase(TestCase):
+    def setUp(self):
+        self.day = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        self.driver = Driver.objects.create(user=CustomUser.objects.create(username='rollupdriver'),
+                                            is_available=True, latitude=0.0, longitude=0.0)
+
+    def at(self, hour, minute=0):
+        return self.day + timedelta(hours=hour, minutes=minute)
+
+    def create_order(self, name, **timestamps):
+        order = create_order(name, dropoff=(0.3, 0.4), pickup_time=self.at(11))
+        # Back-date the order as if it had been placed then.
+        Order.objects.filter(id=order.id).update(**timestamps)
+        order.refresh_from_db()
+        return order
+
+    def test_run_by_the_job_queue(self):
+        self.create_order('rollupqueued', created_at=self.at(10))
+        with override_settings(DAIKOU_ROLLUP_INTERVAL=60):
+            tasks.schedule_recurring()
+            tasks.schedule_recurring()
+            queued = Job.objects.get(name='rollup_orders')
+            self.assertLessEqual(queued.run_at, timezone.now() + timedelta(seconds=60))
+            Job.objects.filter(name='rollup_orders').update(run_at=timezone.now())
+            # Run when its time has come, in the next slot.
+            with patch('find_daikou.tasks.time.time', return_value=time.time() + 60):
+                self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.rollup(OrderRollup.DAY, self.day).created, 1)
+        # The run queued the next one.
+        self.assertEqual(Job.objects.filter(name='rollup_orders', status=Job.QUEUED).count(), 1)
+
+    def rollup(self, period, start, dimension=OrderRollup.ALL, key=''):
+        return OrderRollup.objects.get(period=period, start=start, dimension=dimension, key=key)
+
+    def test_counts_events_in_their_periods(self):
+        self.create_order('rollupcustomer1', created_at=self.at(10, 15), assigned_at=self.at(10, 45),
+                          completed_at=self.at(11, 30), driver=self.driver, completed=True,
+                          eta=self.at(11, 5))
+        cancelled = self.create_order('rollupcustomer2', created_at=self.at(10, 20))
+        cancelled.cancel()
+        Order.objects.filter(id=cancelled.id).update(completed_at=self.at(10, 30), cancelled_at=self.at(10, 30))
+
+        self.assertEqual(rollups.run(), (1, rollups.run(full=True)[1]))
+        day = self.rollup(OrderRollup.DAY, self.day)
+        self.assertEqual((day.created, day.completed, day.cancelled, day.assigned, day.assign_seconds),
+                         (2, 1, 1, 1, 1800))
+        self.assertEqual((day.eta_count, day.eta_error_seconds, day.eta_late), (1, 300, 1))
+        ten, eleven = self.rollup(OrderRollup.HOUR, self.at(10)), self.rollup(OrderRollup.HOUR, self.at(11))
+        self.assertEqual((ten.created, ten.cancelled, ten.assigned, ten.completed), (2, 1, 1, 0))
+        self.assertEqual((eleven.created, eleven.completed), (0, 1))
+        self.assertEqual(self.rollup(OrderRollup.DAY, self.day, OrderRollup.DRIVER, str(self.driver.id)).completed, 1)
+        self.assertEqual(self.rollup(OrderRollup.DAY, self.day, OrderRollup.ZONE, cancelled.zone).created, 2)
+
+    def test_only_counts_days_with_changed_orders(self):
+        order = self.create_order('rollupcustomer1', created_at=self.at(10), updated_at=self.at(10))
+        self.create_order('rollupcustomer2', created_at=self.at(34), updated_at=self.at(34))
+        self.assertEqual(rollups.run(), (2, 12))
+        self.assertEqual(rollups.run(), (0, 0))
+
+        order.assign_driver(self.driver)
+        self.assertEqual(rollups.run()[0], 2)
+        today = rollups.day_of(timezone.now())
+        self.assertEqual(self.rollup(OrderRollup.DAY, today).assigned, 1)
+        self.assertEqual(self.rollup(OrderRollup.DAY, self.day + timedelta(days=1)).created, 1)
+
+    def test_admin_lists_rollups(self):
+        self.create_order('rollupcustomer1', created_at=self.at(10))
+        rollups.run()
+        CustomUser.objects.create_superuser(username='rollupadmin', password='password')
+        self.client.login(username='rollupadmin', password='password')
+        response = self.client.get(reverse('admin:find_daikou_orderrollup_changelist'), {'period': 'day'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Mean minutes to assign')
+
+
+@override_settings(DAIKOU_POSITION_FLUSH_INTERVAL=None, DAIKOU_SNAPSHOT_INTERVAL=0)
+class RouteTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.driver_user = CustomUser.objects.create_user(username='routedriver', password='password')
+        self.driver = Driver.objects.create(user=self.driver_user, is_available=True, latitude=35.0, longitude=139.0)
+        self.customer_user = CustomUser.objects.create_user(username='routecustomer', password='password')
+        customer = Customer.objects.create(user=self.customer_user)
+        car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=customer)
+        self.order = Order.objects.create(customer=customer, car=car, driver=self.driver,
+                                          pickup_latitude=35.0, pickup_longitude=139.0,
+                                          dropoff_latitude=35.1, dropoff_longitude=139.1, pickup_time=timezone.now())
+
+    def tearDown(self):
+        positions.buffer.discard(self.driver.id)
+
+    def test_encoding(self):
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(routes.encode(points), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(routes.decode('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), points)
+        self.assertEqual(routes.extend(routes.encode(points[:1]), points[1:] + points[2:]), routes.encode(points))
+        self.assertEqual(routes.last_point(routes.encode(points)), points[-1])
+        self.assertIsNone(routes.last_point(''))
+
+    def test_simplify(self):
+        line = [(0.0, i / 10) for i in range(11)] + [(0.5, 1.0)]
+        self.assertEqual(routes.simplify(line, 0.01), [(0.0, 0.0), (0.0, 1.0), (0.5, 1.0)])
+        self.assertEqual(routes.simplify(line, 1.0), [(0.0, 0.0), (0.5, 1.0)])
+        self.assertLess(routes.tolerance_for_zoom(16), routes.tolerance_for_zoom(10))
+
+    def test_flush_extends_route_of_current_order(self):
+        for latitude in (35.001, 35.002, 35.002, 35.004):
+            positions.buffer.update(self.driver, latitude, 139.0)
+            positions.buffer.flush()
+        self.order.refresh_from_db()
+        self.assertEqual(routes.decode(self.order.route), [(35.001, 139.0), (35.002, 139.0), (35.004, 139.0)])
+
+        self.client.login(username='routecustomer', password='password')
+        feature = self.client.get(reverse('order_route', args=[self.order.id]), {'zoom': 5}).json()
+        self.assertEqual(feature['geometry']['coordinates'], [[139.0, 35.001], [139.0, 35.004]])
+        self.assertEqual(feature['properties']['points'], 3)
+        for zoom in (-2000, 2000):
+            response = self.client.get(reverse('order_route', args=[self.order.id]), {'zoom': zoom})
+            self.assertEqual(response.status_code, 200)
+        self.assertContains(self.client.get(reverse('history')), reverse('order_route', args=[self.order.id]))
+
+        CustomUser.objects.create_user(username='routestranger', password='password')
+        self.client.login(username='routestranger', password='password')
+        self.assertEqual(self.client.get(reverse('order_route', args=[self.order.id])).status_code, 404)
+
+    def test_unassigned_route_is_not_written_back(self):
+        self.assertEqual(routes.record_positions({self.driver.id: (35.001, 139.0)}), 1)
+        extend = routes.extend
+
+        def unassign_meanwhile(route, points):
+            Order.objects.get(id=self.order.id).unassign_driver()
+            return extend(route, points)
+
+        with patch.object(routes, 'extend', unassign_meanwhile):
+            routes.record_positions({self.driver.id: (35.002, 139.0)})
+        order = Order.objects.get(id=self.order.id)
+        self.assertEqual((order.driver_id, order.route), (None, ''))
+
+
+class DistanceCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        distances.shared_cache().clear()
+        distances.local.clear()
+
+    def computed(self, pairs):
+        with patch.object(distances, 'haversine_km_many', wraps=distances.haversine_km_many) as compute:
+            estimates = distances.lookup_many(pairs)
+        return estimates, [len(call.args[0]) for call in compute.call_args_list]
+
+    def test_batch_only_computes_missing_pairs(self):
+        station, bars, airport = (35.6812, 139.7671), (35.6938, 139.7034), (35.5494, 139.7798)
+        estimates, computed = self.computed([(station, bars), (bars, station), (station, airport)])
+        self.assertEqual(computed, [2])
+        self.assertEqual(estimates[0], estimates[1])
+        self.assertAlmostEqual(estimates[0].km, 5.96, places=2)
+        self.assertAlmostEqual(estimates[0].minutes, estimates[0].km / 30 * 60)
+        # Nearby points fall in the same quantized pair
+        self.assertEqual(self.computed([((35.68121, 139.76709), bars), (station, (35.0, 135.0))])[1], [1])
+
+    def test_shared_through_cache(self):
+        pair = ((35.6812, 139.7671), (35.6938, 139.7034))
+        self.computed([pair])
+        distances.local.clear()
+        self.assertEqual(self.computed([pair])[1], [])
+        self.assertEqual(len(distances.local), 1)
+        # Not in the default cache, whose keys it would evict.
+        key = distances.cache_key(distances.pair_key(*pair))
+        self.assertIsNone(cache.get(key))
+        self.assertIsNotNone(distances.shared_cache().get(key))
+
+    @override_settings(DAIKOU_DISTANCE_LRU_SIZE=2)
+    def test_lru_evicts_least_recently_used(self):
+        a, b, c = [((35.0, 139.0), (35.0 + i / 10, 139.0)) for i in (1, 2, 3)]
+        distances.lookup_many([a, b])
+        distances.lookup(*a)
+        distances.lookup(*c)
+        keys = [distances.pair_key(*pair) for pair in (a, b, c)]
+        self.assertEqual(set(distances.local.get_many(keys)), {keys[0], keys[2]})
+
+    def test_suggests_eta_to_drivers(self):
+        user = CustomUser.objects.create_user(username='etadriver', password='password')
+        driver = Driver.objects.create(user=user, is_available=True, latitude=35.0, longitude=139.0)
+        customer = Customer.objects.create(user=CustomUser.objects.create(username='etacustomer'))
+        car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=customer)
+        order = Order.objects.create(customer=customer, car=car, pickup_latitude=35.1, pickup_longitude=139.0,
+                                     dropoff_latitude=35.2, dropoff_longitude=139.0, pickup_time=timezone.now())
+        self.client.login(username='etadriver', password='password')
+        self.assertEqual(self.client.get(reverse('eta_suggestion'), {'order_id': order.id}).json(),
+                         {'minutes': 23, 'km': 11.12})
+
+        self.client.get(reverse('confirm_order'), {'order_id': order.id})
+        order.refresh_from_db()
+        self.assertEqual(order.driver, driver)
+        self.assertAlmostEqual((order.eta - timezone.now()).total_seconds() / 60, 23, delta=1)
+        self.assertContains(self.client.get(reverse('update_eta')), 'value="23"')
+
+@override_settings(DAIKOU_PICKUP_LEAD_TIME=1800)
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.driver = Driver.objects.create(user=CustomUser.objects.create(username='scheduledriver'),
+                                            is_available=True, latitude=35.60, longitude=139.70)
+
+    def test_orders_are_held_until_lead_time(self):
+        now = timezone.now()
+        soon = create_order('soon', pickup=(35.61, 139.71), pickup_time=now + timedelta(minutes=10))
+        tonight = create_order('tonight', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=5))
+        later = create_order('later', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=2))
+        self.assertTrue(soon.released)
+        self.assertFalse(tonight.released)
+        self.assertEqual(list(Order.objects.open()), [soon])
+        self.assertEqual(dispatch.pending_zones(), {soon.zone})
+
+        held = scheduler.Scheduler()
+        self.assertTrue(held.stale(60))
+        self.assertEqual(held.refresh(), 2)
+        self.assertFalse(held.stale(60))
+        self.assertEqual(held.next_release(), later.pickup_time - timedelta(minutes=30))
+        self.assertEqual(held.release_due(now), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(held.release_due(now + timedelta(hours=2)), [later.id])
+        self.assertEqual(set(Order.objects.open()), {soon, later})
+        self.assertEqual(held.release_due(now + timedelta(hours=5)), [tonight.id])
+        self.assertEqual(len(held), 0)
+
+    def test_postponed_orders_go_back_on_the_heap(self):
+        now = timezone.now()
+        order = create_order('postponed', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=2))
+        held = scheduler.Scheduler()
+        held.refresh()
+        Order.objects.filter(id=order.id).update(pickup_time=now + timedelta(hours=4))
+        self.assertEqual(held.release_due(now + timedelta(hours=2)), [])
+        self.assertEqual(held.next_release(), now + timedelta(hours=3, minutes=30))
+
+    def test_rescan_finds_orders_committed_late(self):
+        now = timezone.now()
+        later = create_order('committedfirst', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=2))
+        held = scheduler.Scheduler()
+        self.assertEqual(held.refresh(), 1)
+        # A bulk booking that took a lower id but committed after the scan.
+        early = create_order('committedlate', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=1))
+        Order.objects.filter(id=early.id).update(id=later.id - 1)
+        self.assertEqual(held.refresh(), 2)
+        self.assertEqual(held.next_release(), early.pickup_time - timedelta(minutes=30))
+
+    def test_release_jobs(self):
+        now = timezone.now()
+        order = create_order('releasejob', pickup=(35.61, 139.71), pickup_time=now + timedelta(hours=2))
+        queued = Job.objects.get(name='release_orders')
+        self.assertEqual(queued.payload, {'order_id': order.id})
+        self.assertAlmostEqual(queued.run_at, order.pickup_time - timedelta(minutes=30), delta=timedelta(seconds=5))
+        self.assertEqual(jobs.run_pending(), 0)
+
+        # Moving the pickup queues a job for the new release time.
+        order.pickup_time = now + timedelta(minutes=40)
+        order.save()
+        order.save()
+        self.assertEqual(Job.objects.filter(name='release_orders').count(), 2)
+        Job.objects.filter(name='release_orders').update(run_at=now)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(jobs.run_pending(), 2)
+        order.refresh_from_db()
+        self.assertFalse(order.released)
+        self.assertEqual(Job.objects.filter(name='release_orders', status=Job.QUEUED).count(), 1)
+
+        with override_settings(DAIKOU_PICKUP_LEAD_TIME=3600):
+            Job.objects.filter(status=Job.QUEUED).update(run_at=now)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(jobs.run_pending(), 1)
+        order.refresh_from_db()
+        self.assertTrue(order.released)
+        self.assertEqual(list(Order.objects.open()), [order])
+        self.assertEqual(Job.objects.filter(name='release_orders', status=Job.QUEUED).count(), 0)
+
+    def test_held_orders_are_not_dispatched_or_taken(self):
+        order = create_order('held', pickup=(35.61, 139.71), pickup_time=timezone.now() + timedelta(hours=2))
+        self.assertEqual(dispatch.Worker('a').run_once(), 0)
+        self.driver.user.set_password('password')
+        self.driver.user.save()
+        self.client.login(username='scheduledriver', password='password')
+        self.client.get(reverse('confirm_order'), {'order_id': order.id, 'time_to_pickup': 5})
+        order.refresh_from_db()
+        self.assertIsNone(order.driver)
+
+        with override_settings(DAIKOU_PICKUP_LEAD_TIME=3 * 3600):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(dispatch.Worker('a').run_once(), 1)
+        order.refresh_from_db()
+        self.assertTrue(order.released)
+        self.assertEqual(order.driver, self.driver)
+
+@override_settings(DAIKOU_NEARBY_RADII_KM=(1, 3, 5), DAIKOU_NEARBY_CELL_SIZE=0.02,
+                   DAIKOU_POSITION_FLUSH_INTERVAL=None, DAIKOU_SNAPSHOT_INTERVAL=0)
+class NearbyDriversTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # About 0.45, 2 and 4 km north of the station, and one in Osaka
+        self.drivers = [
+            Driver.objects.create(user=CustomUser.objects.create(username=f'nearby{i}'), is_available=True,
+                                  latitude=latitude, longitude=139.7671)
+            for i, latitude in enumerate([35.6852, 35.6992, 35.7172, 34.70])
+        ]
+        Driver.objects.create(user=CustomUser.objects.create(username='offduty'), is_available=False,
+                              latitude=35.6812, longitude=139.7671)
+
+    def tearDown(self):
+        for driver in self.drivers:
+            positions.buffer.discard(driver.id)
+
+    def counts(self, found):
+        return [count for km, count in found.counts]
+
+    def test_counts_free_drivers_within_radii(self):
+        found = nearby.nearby(35.6812, 139.7671)
+        self.assertEqual(self.counts(found), [1, 2, 3])
+        self.assertAlmostEqual(found.eta_minutes, 0.45 / 30 * 60, delta=0.1)
+        self.assertEqual(nearby.nearby(0.0, 0.0), nearby.Nearby([(1, 0), (3, 0), (5, 0)], None))
+
+        # Drivers on an order and buffered positions
+        customer = Customer.objects.create(user=CustomUser.objects.create(username='nearbycustomer'))
+        car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(customer=customer, car=car, driver=self.drivers[0], pickup_latitude=35.6857,
+                                 pickup_longitude=139.7671, dropoff_latitude=35.0, dropoff_longitude=139.0,
+                                 pickup_time=timezone.now())
+        positions.buffer.update(self.drivers[3], 35.6812, 139.7672)
+        found = nearby.nearby(35.6812, 139.7671, nearby.build_index())
+        self.assertEqual(self.counts(found), [1, 2, 3])
+        self.assertLess(found.eta_minutes, 0.1)
+
+    def test_does_not_query_the_database(self):
+        index = nearby.build_index()
+        with self.assertNumQueries(0):
+            nearby.nearby(35.6812, 139.7671, index)
+
+    def test_view(self):
+        CustomUser.objects.create_user(username='nearbyuser', password='password')
+        self.client.login(username='nearbyuser', password='password')
+        response = self.client.get(reverse('nearby_drivers'), {'latitude': 35.6812, 'longitude': 139.7671})
+        self.assertEqual(response.json(), {
+            'drivers': [{'km': 1, 'count': 1}, {'km': 3, 'count': 2}, {'km': 5, 'count': 3}],
+            'eta_minutes': 1,
+        })
+        self.assertEqual(self.client.get(reverse('nearby_drivers'), {'latitude': 'north'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('nearby_drivers'), {'latitude': 95, 'longitude': 0}).status_code, 400)
+
+@override_settings(DAIKOU_POSITION_FLUSH_INTERVAL=None, DAIKOU_SNAPSHOT_INTERVAL=0)
+class SimulationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        for pk in positions.buffer.pending():
+            positions.buffer.discard(pk)
+
+    def test_run_goes_through_the_views(self):
+        settings = simulation.Settings(seed=7, drivers=3, customers=4, ticks=12, booking_rate=0.5, drop_rate=0)
+        # Cached boards are invalidated on commit, which the test transaction never does.
+        with patch('django.db.transaction.on_commit', lambda func, *args, **kwargs: func()):
+            report = simulation.Simulation(settings).run()
+        self.assertEqual(report.errors, 0)
+        self.assertGreater(report.events['orders booked'], 0)
+        self.assertGreater(report.events['orders confirmed'], 0)
+        self.assertNotIn('agent failures', report.events)
+        self.assertEqual(set(report.violations.values()), {0})
+        self.assertTrue({'call_driver', 'confirm_order', 'driverlist', 'update_position'} <= set(report.views))
+        self.assertEqual(report.requests, sum(view[0] for view in report.views.values()))
+
+        self.assertEqual(simulation.Simulation(settings).clean_up(), 7)
+        self.assertFalse(CustomUser.objects.filter(username__startswith='sim7-').exists())
+
+    @override_settings(DEBUG=True, ALLOWED_HOSTS=[])
+    def test_command_runs_outside_the_test_runner(self):
+        # The test runner allows the test client's `testserver` host, manage.py does not.
+        out = StringIO()
+        with patch('django.db.transaction.on_commit', lambda func, *args, **kwargs: func()):
+            call_command('simulate', seed=5, drivers=2, customers=3, ticks=3, booking_rate=1,
+                         concurrency=1, clean_up=True, stdout=out, stderr=StringIO())
+        output = out.getvalue()
+        self.assertIn(', 0 errors', output)
+        self.assertIn('orders booked: 3', output)
+
+    def test_refused_bookings_are_not_counted(self):
+        run = simulation.Simulation(simulation.Settings(seed=9, drivers=0, customers=1))
+        run.set_up()
+        customer = run.agents[0]
+        customer.car_id = 0
+        customer.book(0)
+        self.assertEqual(run.stats.events, {'bookings refused': 1})
+        self.assertIsNone(customer.booked_at)
+
+    def test_same_seed_makes_same_plans(self):
+        settings = simulation.Settings(seed=3, drivers=2, customers=0)
+        first, second = simulation.Simulation(settings), simulation.Simulation(settings)
+        first.set_up()
+        second.set_up()
+        self.assertEqual([agent.position for agent in first.agents], [agent.position for agent in second.agents])
+        self.assertEqual(simulation.percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(simulation.percentile([1, 2, 3, 4], 0.99), 4)
+
+class FleetStateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_driver(self, name, latitude=35.68, longitude=139.76, is_available=True):
+        return Driver.objects.create(user=CustomUser.objects.create(username=name), is_available=is_available,
+                                     latitude=latitude, longitude=longitude)
+
+    def test_arrays_grow_and_compact(self):
+        state = fleet.FleetState(capacity=2)
+        for pk in range(1, 6):
+            state.put(pk, 35.0 + pk, 139.0, pk != 3, 'tokyo' if pk % 2 else 'osaka', f'driver{pk}')
+        self.assertEqual(len(state), 5)
+        self.assertEqual(state.rows().ids.tolist(), [1, 2, 4, 5])
+        self.assertEqual(state.rows('tokyo').names, ['driver1', 'driver5'])
+        self.assertEqual(state.rows('nowhere').ids.tolist(), [])
+
+        state.remove(2)
+        self.assertEqual(state.index[5], 1)
+        self.assertEqual(state.rows().ids.tolist(), [1, 4, 5])
+        state.move(5, 40.0, 140.0, 'osaka')
+        state.assign(4, 9)
+        self.assertEqual(state.rows('osaka').latitudes.tolist(), [39.0, 40.0])
+        self.assertEqual(state.rows(free=True).ids.tolist(), [1, 5])
+        state.unassign(4, 8)
+        self.assertEqual(state.rows(ids=[4, 5], free=True).ids.tolist(), [5])
+        state.unassign(4, 9)
+        self.assertEqual(state.rows(ids=[4, 5], free=True).ids.tolist(), [4, 5])
+
+    def test_kept_in_sync_by_write_paths(self):
+        driver = self.create_driver('fleetdriver')
+        state = fleet.current()
+        self.assertEqual(state.rows().ids.tolist(), [driver.id])
+
+        positions.buffer.update(driver, 34.70, 135.50)
+        self.addCleanup(positions.buffer.discard, driver.id)
+        self.assertEqual(state.rows('osaka').ids.tolist(), [driver.id])
+
+        customer = Customer.objects.create(user=CustomUser.objects.create(username='fleetcustomer'))
+        car = Car.objects.create(make='Toyota', model='Prius', year=2020, customer=customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(customer=customer, car=car, driver=driver, pickup_latitude=34.70,
+                                         pickup_longitude=135.50, dropoff_latitude=34.8, dropoff_longitude=135.6,
+                                         pickup_time=timezone.now())
+        self.assertEqual(fleet.current().rows(free=True).ids.tolist(), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            order.cancel()
+        self.assertEqual(fleet.current().rows(free=True).ids.tolist(), [driver.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            driver.delete()
+        self.assertEqual(len(fleet.current()), 0)
+
+    def test_picks_up_changes_of_other_processes_from_the_feed(self):
+        fleet.current()
+        # Written by another process: only the feed log tells this one.
+        driver = self.create_driver('elsewhere')
+        self.assertEqual(len(fleet.state), 0)
+        feed.record_change(driver.id)
+        with self.assertNumQueries(2):
+            self.assertEqual(fleet.current().rows().ids.tolist(), [driver.id])
+
+        Driver.objects.filter(id=driver.id).update(latitude=35.0)
+        with override_settings(DAIKOU_FLEET_RELOAD_INTERVAL=0):
+            self.assertEqual(fleet.current().rows().latitudes.tolist(), [35.0])
+
+    def test_reload_does_not_block_readers_or_lose_changes(self):
+        driver = self.create_driver('reloaded')
+        state = fleet.FleetState()
+        state.load()
+        read, seen = fleet.FleetState._read, []
+
+        def read_while_serving(loaded, drivers):
+            read(loaded, drivers)
+            reader = threading.Thread(target=lambda: seen.append(state.rows().ids.tolist()))
+            reader.start()
+            reader.join(5)
+            # Moved in this process after the load read the database.
+            Driver.objects.filter(id=driver.id).update(latitude=36.0)
+            state.move(driver.id, 36.0, 139.76, 'tokyo')
+
+        with patch.object(fleet.FleetState, '_read', read_while_serving):
+            state.load()
+        self.assertEqual(seen, [[driver.id]])
+        self.assertEqual(state.rows().latitudes.tolist(), [36.0])
+
+    def test_one_thread_reloads_at_a_time(self):
+        for loaded_at in (None, time.monotonic()):
+            state, loads = fleet.FleetState(), []
+            state.loaded_at = loaded_at
+
+            def load():
+                loads.append(1)
+                time.sleep(0.1)
+                state.loaded_at = time.monotonic()
+
+            with patch.object(state, 'load', load):
+                threads = [threading.Thread(target=state.reload) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(5)
+            self.assertEqual(len(loads), 1)
+
+    def test_feed_is_served_from_state(self):
+        for i in range(3):
+            self.create_driver(f'fed{i}', latitude=35.0 + i)
+        fleet.current()
+        CustomUser.objects.create_user(username='feedcustomer', password='password')
+        self.client.login(username='feedcustomer', password='password')
+        with override_settings(DAIKOU_SNAPSHOT_INTERVAL=0), self.assertNumQueries(1):
+            # Only the user; no drivers
+            data = self.client.get(reverse('driverlist')).json()
+        self.assertEqual([f['geometry']['coordinates'][1] for f in data['features']], [35.0, 36.0, 37.0])
+
+class BulkBookingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customers = []
+        for i in range(3):
+            customer = Customer.objects.create(user=CustomUser.objects.create(username=f'shuttle{i}'))
+            Car.objects.create(make='Toyota', model='HiAce', year=2022, customer=customer)
+            self.customers.append(customer)
+        self.url = reverse('api_v1:book_orders')
+
+    def ride(self, customer, car=None, **values):
+        return {'customer': customer.id, 'car': car or customer.cars.get().id,
+                'pickup_latitude': 35.61, 'pickup_longitude': 139.71,
+                'dropoff_latitude': 35.62, 'dropoff_longitude': 139.72,
+                'pickup_time': timezone.now().isoformat(), **values}
+
+    def post(self, rows):
+        return self.client.post(self.url, json.dumps({'orders': rows}), content_type='application/json')
+
+    def test_books_valid_rows_with_set_based_queries(self):
+        first, second, third = self.customers
+        tomorrow = (timezone.now() + timedelta(days=1)).isoformat()
+        rows = [
+            self.ride(first),
+            self.ride(second, pickup_time=tomorrow),
+            self.ride(third, first.cars.get().id),
+            self.ride(first),
+            self.ride(third, pickup_time='2020-01-01T00:00:00+00:00'),
+            self.ride(third, pickup_latitude=120),
+            self.ride(third, pickup_time='2026-13-45T00:00'),
+            'nonsense',
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            results = bookings.book(rows)
+        orders = Order.objects.in_bulk([result['id'] for result in results[:2]])
+        self.assertEqual(len(orders), 2)
+        self.assertTrue(orders[results[0]['id']].released)
+        self.assertFalse(orders[results[1]['id']].released)
+        self.assertEqual(list(Job.objects.filter(name='release_orders').values_list('payload', flat=True)),
+                         [{'order_id': results[1]['id']}])
+        self.assertEqual(orders[results[0]['id']].zone, 'tokyo')
+        self.assertIsNotNone(orders[results[0]['id']].created_at)
+        self.assertEqual(results[2:], [
+            {'errors': ['The selected car does not belong to the customer.']},
+            {'errors': ['A customer can only have one incomplete order at a time.']},
+            {'errors': ['The pickup time is outside the booking window.']},
+            {'errors': ['Invalid pickup_latitude.']},
+            {'errors': ['Invalid pickup_time.']},
+            {'errors': ['Expected an object.']},
+        ])
+        self.assertEqual(sorted(DemandCell.objects.values_list('pending', flat=True)), [1, 1])
+        self.assertEqual(bookings.book([self.ride(first)]),
+                         [{'errors': ['A customer can only have one incomplete order at a time.']}])
+
+    def test_many_rows_take_a_constant_number_of_queries(self):
+        bookings.book([self.ride(self.customers[0])])
+        ride = self.ride(self.customers[1])
+        with CaptureQueriesContext(connection) as one:
+            bookings.book([ride])
+
+        customers = Customer.objects.bulk_create(
+            [Customer(user=CustomUser.objects.create(username=f'guest{i}')) for i in range(200)])
+        Car.objects.bulk_create([Car(make='Toyota', model='Prius', year=2020, customer=c) for c in customers])
+        cars = dict(Car.objects.filter(customer__in=customers).values_list('customer_id', 'id'))
+        rows = [self.ride(c, cars[c.id]) for c in customers]
+        with CaptureQueriesContext(connection) as many:
+            results = bookings.book(rows)
+        self.assertTrue(all('id' in result for result in results))
+
+        # In the demand cell of the rides before, so only the inserts grow, in batches
+        # as large as the database takes.
+        def inserts(queries):
+            return [query for query in queries if query['sql'].startswith('INSERT INTO "find_daikou_order"')]
+        self.assertEqual(len(many) - len(inserts(many)), len(one) - len(inserts(one)))
+        self.assertLessEqual(len(inserts(many)), 5)
+
+    def test_view(self):
+        staff = CustomUser.objects.create_user(username='events', password='password', is_staff=True)
+        self.assertEqual(self.post([]).status_code, 401)
+        CustomUser.objects.create_user(username='someone', password='password')
+        self.client.login(username='someone', password='password')
+        self.assertEqual(self.post([]).status_code, 403)
+
+        self.client.login(username=staff.username, password='password')
+        response = self.post([self.ride(self.customers[0])])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()['results'][0]), ['id'])
+        self.assertEqual(self.client.post(self.url, 'nope', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        with override_settings(DAIKOU_BULK_BOOKING_MAX_ROWS=1):
+            self.assertEqual(self.post([{}, {}]).json(), {'error': 'At most 1 orders per request.'})
+
+
+class ConditionalWriteTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        customer = Customer.objects.create(user=CustomUser.objects.create(username='writecustomer'))
+        car = Car.objects.create(make='Mazda', model='Demio', year=2019, customer=customer)
+        self.drivers = [Driver.objects.create(user=CustomUser.objects.create(username=f'writedriver{i}'),
+                                              is_available=True, latitude=35.0, longitude=139.0)
+                        for i in range(2)]
+        self.order = Order.objects.create(customer=customer, car=car, pickup_latitude=35.0, pickup_longitude=139.0,
+                                          dropoff_latitude=35.1, dropoff_longitude=139.1, pickup_time=timezone.now())
+
+    def order_writes(self, queries):
+        return [query['sql'] for query in queries if 'find_daikou_order' in query['sql']]
+
+    def test_writes_only_the_changed_columns(self):
+        eta = timezone.now() + timedelta(minutes=10)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.order.assign_driver(self.drivers[0], eta))
+        writes = self.order_writes(queries.captured_queries)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('UPDATE "find_daikou_order" SET "driver_id"'))
+        self.assertNotIn('"car_id" =', writes[0].split('WHERE')[0])
+        self.assertEqual(Order.objects.get(id=self.order.id).eta, eta)
+        self.assertIsNotNone(self.order.assigned_at)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.order.set_eta(eta + timedelta(minutes=5)))
+        writes = self.order_writes(queries.captured_queries)
+        self.assertEqual(len(writes), 1)
+        self.assertNotIn('"pickup_latitude"', writes[0])
+
+    def test_guards_against_stale_instances(self):
+        stale = Order.objects.get(id=self.order.id)
+        self.assertTrue(self.order.assign_driver(self.drivers[0]))
+        self.assertFalse(stale.assign_driver(self.drivers[1]))
+        self.assertIsNone(stale.driver_id)
+        self.assertEqual(Order.objects.get(id=self.order.id).driver_id, self.drivers[0].id)
+
+        stale = Order.objects.get(id=self.order.id)
+        self.assertTrue(self.order.complete_order())
+        self.assertFalse(self.order.complete_order())
+        self.assertFalse(stale.unassign_driver())
+        self.assertFalse(stale.set_eta(timezone.now()))
+        completed = Order.objects.get(id=self.order.id)
+        self.assertEqual(completed.driver_id, self.drivers[0].id)
+        self.assertTrue(completed.completed)
+        self.assertFalse(stale.cancel())
+        self.assertIsNone(Order.objects.get(id=self.order.id).cancelled_at)
+
+    def test_keeps_the_first_assignment_time(self):
+        self.assertTrue(self.order.assign_driver(self.drivers[0]))
+        assigned_at = self.order.assigned_at
+        self.assertTrue(self.order.unassign_driver())
+        self.assertTrue(self.order.assign_driver(self.drivers[1]))
+        self.assertEqual(Order.objects.get(id=self.order.id).assigned_at, assigned_at)
+
+    def test_scheduled_orders_are_not_assigned(self):
+        Order.objects.filter(id=self.order.id).update(released=False)
+        self.assertFalse(Order.objects.get(id=self.order.id).assign_driver(self.drivers[0]))
+
+    def test_signals_follow_the_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.order.assign_driver(self.drivers[0]))
+        self.assertFalse(DemandCell.objects.filter(pending__gt=0).exists())
+        self.assertEqual(fleet.current().rows(free=True).ids.tolist(), [self.drivers[1].id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.order.unassign_driver())
+        self.assertTrue(DemandCell.objects.filter(pending=1).exists())
+        self.assertEqual(len(fleet.current().rows(free=True).ids), 2)
+
+        driver = self.drivers[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(driver.set_available(False))
+            self.assertFalse(driver.set_available(False))
+        self.assertFalse(Driver.objects.get(id=driver.id).is_available)
+        self.assertEqual(fleet.current().rows().ids.tolist(), [self.drivers[0].id])
+        self.assertEqual(sum(SupplyCell.objects.values_list('available', flat=True)), 1)
+
+    def test_views(self):
+        driver = self.drivers[0]
+        driver.user.set_password('password')
+        driver.user.save()
+        self.client.login(username=driver.user.username, password='password')
+        self.client.get(reverse('set_driver_unavailable'))
+        self.assertFalse(Driver.objects.get(id=driver.id).is_available)
+        self.client.get(reverse('set_driver_available'))
+        self.assertTrue(Driver.objects.get(id=driver.id).is_available)
+
+        self.client.get(reverse('confirm_order'), {'order_id': self.order.id, 'time_to_pickup': 5})
+        self.assertEqual(Order.objects.get(id=self.order.id).driver_id, driver.id)
+        self.client.post(reverse('update_eta'), {'minutes': 20})
+        self.assertGreater(Order.objects.get(id=self.order.id).eta, timezone.now() + timedelta(minutes=15))
@@ -23,6 +23,10 @@ import find_daikou.views as views
 urlpatterns = [
     path('', views.index, name='index'),
     path('test/', views.available_drivers, name='driverlist'),
+    path('orders.geojson', views.order_features, name='order_features'),
+    path('heatmap.geojson', views.heatmap_cells, name='heatmap'),
+    path('routes/<int:order_id>.geojson', views.order_route, name='order_route'),
+    path('tiles/<str:layer>/<int:z>/<int:x>/<int:y>.mvt', views.vector_tile, name='vector_tile'),
     path('confirm_order', views.confirm_order, name='confirm_order'),
     path('call_driver/', views.call_driver, name='call_driver'),
     path('add_car/', views.add_car, name='add_car'),
@@ -30,10 +34,16 @@ urlpatterns = [
     path('history/', views.history, name='history'),
     path('set_driver_available/', views.set_driver_available, name='set_driver_available'),
     path('set_driver_unavailable/', views.set_driver_unavailable, name='set_driver_unavailable'),
+    path('update_position/', views.update_position, name='update_position'),
     path('cancel_order/', views.cancel_order, name='cancel_order'),
     path('update_eta/', views.update_eta, name='update_eta'),
+    path('eta_suggestion/', views.eta_suggestion, name='eta_suggestion'),
+    path('nearby_drivers/', views.nearby_drivers, name='nearby_drivers'),
     path('register/', views.register, name='register'),
     path('login/', LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
+    path('api/v1/', include('find_daikou.api')),
+    path('admin/profiles/', views.profile_list, name='profile_list'),
+    path('admin/profiles/<str:name>', views.profile_download, name='profile_download'),
     path('admin/', admin.site.urls),
 ]
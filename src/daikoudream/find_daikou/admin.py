@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import CustomUser, Customer, Car, Driver, Order
+from .models import CustomUser, Customer, Car, Driver, Order, DispatchWorker, ZoneLease, Job, OrderRollup, RollupWatermark
 
 class CustomUserAdmin(admin.ModelAdmin):
     list_display = ('username', 'email', 'is_staff')
@@ -11,13 +11,60 @@ class CarAdmin(admin.ModelAdmin):
     list_display = ('make', 'model', 'year', 'customer')
 
 class DriverAdmin(admin.ModelAdmin):
-    list_display = ('user', 'is_available', 'latitude', 'longitude')
+    list_display = ('user', 'is_available', 'latitude', 'longitude', 'zone')
+    list_filter = ('zone',)
 
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('customer', 'driver', 'car', 'pickup_time', 'completed')
+    list_display = ('customer', 'driver', 'car', 'pickup_time', 'completed', 'zone')
+    list_filter = ('zone',)
+    readonly_fields = ('created_at', 'updated_at', 'assigned_at', 'completed_at', 'cancelled_at')
+
+class DispatchWorkerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'started_at', 'heartbeat_at', 'orders_dispatched')
+
+class ZoneLeaseAdmin(admin.ModelAdmin):
+    list_display = ('zone', 'owner', 'expires_at')
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'priority', 'attempts', 'run_at', 'finished_at')
+    list_filter = ('status', 'name')
+
+class OrderRollupAdmin(admin.ModelAdmin):
+    """ Read-only: rollups are written by the rollup_orders command. """
+    list_display = ('start', 'period', 'dimension', 'key', 'created', 'completed', 'cancelled', 'assigned',
+                    'mean_minutes_to_assign', 'mean_eta_error_minutes', 'eta_late')
+    list_filter = ('period', 'dimension')
+    search_fields = ('key',)
+    date_hierarchy = 'start'
+    ordering = ('-start', 'dimension', 'key')
+
+    @admin.display(description='Mean minutes to assign')
+    def mean_minutes_to_assign(self, rollup):
+        return round(rollup.assign_seconds / rollup.assigned / 60, 1) if rollup.assigned else None
+
+    @admin.display(description='Mean ETA error (minutes)')
+    def mean_eta_error_minutes(self, rollup):
+        return round(rollup.eta_error_seconds / rollup.eta_count / 60, 1) if rollup.eta_count else None
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class RollupWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('name', 'processed_until')
 
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Car, CarAdmin)
 admin.site.register(Driver, DriverAdmin)
 admin.site.register(Order, OrderAdmin)
+admin.site.register(DispatchWorker, DispatchWorkerAdmin)
+admin.site.register(ZoneLease, ZoneLeaseAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(OrderRollup, OrderRollupAdmin)
+admin.site.register(RollupWatermark, RollupWatermarkAdmin)
@@ -0,0 +1,335 @@
+"""
+Version 1 of the JSON API, for the mobile apps. Mounted under /api/v1/.
+
+Every list endpoint takes:
+
+- `fields=a,b,c` to only return those fields. Only the columns (and joins)
+  the requested fields need are queried. Without it, every field but the
+  large opt-in ones (an order's `route`) is returned.
+- `limit=<n>` and `cursor=<token>` for pagination. A page carries the
+  `next` cursor, or null on the last page. Cursors are opaque to clients and
+  stay valid while rows are added.
+
+Responses are gzip compressed for clients that accept it, and carry an ETag
+so that unchanged pages can be revalidated with If-None-Match. Requests use
+the session of the logged in user; endpoints that need one answer 401
+without it.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from functools import partial, wraps
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.urls import path
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_http_methods
+
+from . import bookings, positions, zones
+from .models import Driver, Order, customer_cars
+
+
+class ApiError(Exception):
+    """Turned into a JSON error response with the given status."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class Computed(NamedTuple):
+    """A field computed from the values of some lookups."""
+    lookups: Tuple[str, ...]
+    compute: Callable[[Dict[str, Any]], Any]
+
+
+# Field name -> the ORM lookup it is read from, or how it is computed.
+Fields = Dict[str, Union[str, Computed]]
+
+
+def order_status(row: Dict[str, Any]) -> str:
+    if row['completed']:
+        return 'completed'
+    return 'assigned' if row['driver_id'] is not None else 'waiting'
+
+
+DRIVER_FIELDS: Fields = {
+    'id': 'id',
+    'name': 'user__username',
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'zone': 'zone',
+}
+
+ORDER_FIELDS: Fields = {
+    'id': 'id',
+    'status': Computed(('completed', 'driver_id'), order_status),
+    'pickup_latitude': 'pickup_latitude',
+    'pickup_longitude': 'pickup_longitude',
+    'dropoff_latitude': 'dropoff_latitude',
+    'dropoff_longitude': 'dropoff_longitude',
+    'pickup_time': 'pickup_time',
+    'eta': 'eta',
+    'zone': 'zone',
+    'driver': 'driver__user__username',
+    'car_id': 'car_id',
+    'car_make': 'car__make',
+    'car_model': 'car__model',
+    'car_year': 'car__year',
+    # The encoded polyline of the route driven (see find_daikou.routes); opt-in
+    'route': 'route',
+}
+
+# Fields only returned when asked for by name, as they can be large
+OPT_IN_FIELDS = frozenset({'route'})
+
+CAR_FIELDS: Sequence[str] = ('id', 'make', 'model', 'year')
+
+
+def requested_fields(request: HttpRequest, available: Iterable[str]) -> List[str]:
+    """The fields asked for with `fields=`, or all of them but the opt-in ones."""
+    available = list(available)
+    names = [name for name in request.GET.get('fields', '').split(',') if name]
+    if not names:
+        return [name for name in available if name not in OPT_IN_FIELDS]
+    unknown = sorted(set(names) - set(available))
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}.")
+    return list(dict.fromkeys(names))
+
+
+def project(queryset: QuerySet, fields: Fields, names: List[str]) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    Query only what the named fields need.
+
+    Returns:
+        The id and the dict of named fields of every row.
+    """
+    lookups = ['id']
+    for name in names:
+        spec = fields[name]
+        lookups += spec.lookups if isinstance(spec, Computed) else [spec]
+    return [
+        (row['id'], {name: fields[name].compute(row) if isinstance(fields[name], Computed) else row[fields[name]]
+                     for name in names})
+        for row in queryset.values(*dict.fromkeys(lookups))
+    ]
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise ApiError('Invalid cursor.')
+
+
+def paginate(request: HttpRequest, queryset: QuerySet, fields: Fields, names: List[str],
+             descending: bool = False) -> Tuple[List[Tuple[int, Dict[str, Any]]], Optional[str]]:
+    """
+    Project the page of a query set asked for with `limit` and `cursor`, keyed on the row id.
+
+    Returns:
+        The rows of the page, as `project` returns them, and the cursor of the next page
+        or None if this is the last one.
+    """
+    try:
+        limit = int(request.GET.get('limit', getattr(settings, 'DAIKOU_API_PAGE_SIZE', 50)))
+    except ValueError:
+        raise ApiError('Invalid limit.')
+    if limit < 1:
+        raise ApiError('Invalid limit.')
+    limit = min(limit, getattr(settings, 'DAIKOU_API_MAX_PAGE_SIZE', 200))
+    cursor = request.GET.get('cursor')
+    if cursor:
+        last_id = decode_cursor(cursor)
+        queryset = queryset.filter(id__lt=last_id) if descending else queryset.filter(id__gt=last_id)
+    # One row more than the page tells whether there is a next one.
+    rows = project(queryset.order_by('-id' if descending else 'id')[:limit + 1], fields, names)
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1][0])
+    return rows, None
+
+
+def api_response(request: HttpRequest, data: Dict[str, Any]) -> HttpResponse:
+    body = json.dumps(data, cls=DjangoJSONEncoder).encode()
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def api_view(view: Optional[Callable] = None, *, methods: Sequence[str] = ('GET',)) -> Callable:
+    """GET only unless other `methods` are given, gzip compressed, with ApiErrors turned into JSON error responses."""
+    if view is None:
+        return partial(api_view, methods=methods)
+
+    @require_http_methods(list(methods))
+    @gzip_page
+    @wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+    return wrapper
+
+
+def require_profile(request: HttpRequest, *profiles: str) -> None:
+    if not request.user.is_authenticated:
+        raise ApiError('Authentication required.', 401)
+    if not any(hasattr(request.user, profile) for profile in profiles):
+        raise ApiError('Not available to this user.', 403)
+
+
+def list_response(request: HttpRequest, queryset: QuerySet, fields: Fields, descending: bool = False) -> HttpResponse:
+    rows, next_cursor = paginate(request, queryset, fields, requested_fields(request, fields), descending)
+    return api_response(request, {'results': [row for _, row in rows], 'next': next_cursor})
+
+
+@api_view
+def drivers(request: HttpRequest) -> HttpResponse:
+    """
+    The available drivers, optionally of one `zone`.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: A page of drivers.
+    """
+    queryset = Driver.objects.in_zone(request.GET.get('zone', '')).filter(is_available=True)
+    rows, next_cursor = paginate(request, queryset, DRIVER_FIELDS, requested_fields(request, DRIVER_FIELDS))
+    # Positions reported since the last flush, as on the map
+    for driver_id, row in rows:
+        buffered = positions.buffer.get(driver_id)
+        if buffered is not None:
+            row.update((key, value) for key, value in zip(('latitude', 'longitude'), buffered) if key in row)
+    return api_response(request, {'results': [row for _, row in rows], 'next': next_cursor})
+
+
+@api_view
+def order_board(request: HttpRequest) -> HttpResponse:
+    """
+    The orders waiting for a driver around the requesting driver (see zones.board_zones).
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: A page of open orders.
+    """
+    require_profile(request, 'driver')
+    driver = request.user.driver
+    queryset = Order.objects.in_zones(zones.board_zones(driver.latitude, driver.longitude)).open()
+    return list_response(request, queryset, ORDER_FIELDS)
+
+
+@api_view
+def order_history(request: HttpRequest) -> HttpResponse:
+    """
+    The orders of the requesting customer or driver, newest first.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: A page of orders.
+    """
+    require_profile(request, 'customer', 'driver')
+    if hasattr(request.user, 'customer'):
+        queryset = Order.objects.filter(customer=request.user.customer)
+    else:
+        queryset = Order.objects.filter(driver=request.user.driver)
+    return list_response(request, queryset, ORDER_FIELDS, descending=True)
+
+
+@api_view
+def active_order(request: HttpRequest) -> HttpResponse:
+    """
+    The incomplete order of the requesting customer or driver, with its status and ETA.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: `{"order": {...}}`, or `{"order": null}` if there is none.
+    """
+    require_profile(request, 'customer', 'driver')
+    if hasattr(request.user, 'customer'):
+        queryset = Order.objects.filter(customer=request.user.customer, completed=False)
+    else:
+        queryset = Order.objects.filter(driver=request.user.driver, completed=False)
+    rows = project(queryset.order_by('id')[:1], ORDER_FIELDS, requested_fields(request, ORDER_FIELDS))
+    return api_response(request, {'order': rows[0][1] if rows else None})
+
+
+@api_view
+def cars(request: HttpRequest) -> HttpResponse:
+    """
+    The cars of the requesting customer, from the same cache the booking pages use.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: All of the customer's cars, on a single page.
+    """
+    require_profile(request, 'customer')
+    names = requested_fields(request, CAR_FIELDS)
+    rows = [{name: getattr(car, name) for name in names} for car in customer_cars(request.user.customer.id)]
+    return api_response(request, {'results': rows, 'next': None})
+
+
+@api_view(methods=('POST',))
+def book_orders(request: HttpRequest) -> HttpResponse:
+    """
+    Books many rides at once, for staff booking on behalf of customers (see find_daikou.bookings).
+
+    Args:
+        request (HttpRequest): The HTTP request object, with a JSON body `{"orders": [...]}` of at
+            most `DAIKOU_BULK_BOOKING_MAX_ROWS` rides.
+
+    Returns:
+        HttpResponse: `{"results": [...]}`, with the `id` of the order or the `errors` of each ride, in order.
+    """
+    if not request.user.is_authenticated:
+        raise ApiError('Authentication required.', 401)
+    if not request.user.is_staff:
+        raise ApiError('Not available to this user.', 403)
+    try:
+        rows = json.loads(request.body)['orders']
+    except (ValueError, KeyError, TypeError):
+        raise ApiError('Expected a JSON object with a list of orders.')
+    if not isinstance(rows, list):
+        raise ApiError('Expected a JSON object with a list of orders.')
+    max_rows = getattr(settings, 'DAIKOU_BULK_BOOKING_MAX_ROWS', 500)
+    if len(rows) > max_rows:
+        raise ApiError(f'At most {max_rows} orders per request.')
+    return JsonResponse({'results': bookings.book(rows)})
+
+
+app_name = 'api_v1'
+
+urlpatterns = [
+    path('drivers/', drivers, name='drivers'),
+    path('orders/', order_history, name='order_history'),
+    path('orders/open/', order_board, name='order_board'),
+    path('orders/active/', active_order, name='active_order'),
+    path('orders/bulk/', book_orders, name='book_orders'),
+    path('cars/', cars, name='cars'),
+]
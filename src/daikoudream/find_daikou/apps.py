@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FindDaikouConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'find_daikou'
+
+    def ready(self):
+        from . import signals, tasks  # noqa: F401
@@ -0,0 +1,43 @@
+"""
+An authentication backend that keeps users in the cache backend.
+
+Django's `AuthenticationMiddleware` loads the user of a session on every
+request, and the views then look up the customer or driver profile of that
+user. `CachedModelBackend` loads both in one query and keeps the result in the
+cache for `DAIKOU_AUTH_CACHE_TIMEOUT` seconds, so that together with a cached
+session engine an authenticated request needs no queries to know who is
+asking. Cached users are dropped whenever the user or its profile is saved,
+and on logout (see find_daikou.signals).
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+
+def user_cache_key(user_id) -> str:
+    return f'auth-user:{user_id}'
+
+
+def invalidate_user(user_id) -> None:
+    """Drop the cached copy of a user and its profile."""
+    cache.delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """A ModelBackend whose `get_user` is served from the cache backend."""
+
+    def get_user(self, user_id) -> Optional[object]:
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            UserModel = get_user_model()
+            # Fetching both profiles also caches which one the user lacks, so
+            # hasattr(user, 'driver') needs no query either.
+            user = UserModel._default_manager.select_related('customer', 'driver').filter(pk=user_id).first()
+            if user is None:
+                return None
+            cache.set(key, user, getattr(settings, 'DAIKOU_AUTH_CACHE_TIMEOUT', 30))
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,129 @@
+"""
+Booking many rides at once, such as shuttles for an event.
+
+`book` checks a whole batch with a couple of set-based queries instead of
+the per-order queries of `Order.save`:
+
+- each car belongs to the customer the ride is for;
+- customers have no incomplete order, and get at most one ride per batch
+  (the one-active-order rule of `Order.save`);
+- pickup times are not in the past and at most `DAIKOU_BOOKING_HORIZON`
+  seconds ahead;
+
+and inserts the valid rides with `bulk_create` in one transaction. The
+derived data the model signals keep for saved orders (heatmap demand, order
+tiles and boards, release jobs of held rides) is updated for the whole batch
+at once.
+"""
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import heatmap, tasks, tiles
+from .models import Car, Order, order_features_cache_key, release_time
+from .signals import order_points
+from .zones import zone_for
+
+# How far in the past a pickup time may be, for clocks running a little behind
+PAST_GRACE = timedelta(minutes=5)
+
+COORDINATES = ('pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude')
+
+
+class Booking(NamedTuple):
+    customer_id: int
+    car_id: int
+    pickup_latitude: float
+    pickup_longitude: float
+    dropoff_latitude: float
+    dropoff_longitude: float
+    pickup_time: datetime
+
+
+def parse(row: Any) -> Tuple[Optional[Booking], List[str]]:
+    """Read a ride from its JSON object, and return it or what is wrong with it."""
+    if not isinstance(row, Mapping):
+        return None, ['Expected an object.']
+    errors = []
+    values: Dict[str, Any] = {}
+    for key in ('customer', 'car'):
+        try:
+            values[f'{key}_id'] = int(row[key])
+        except (KeyError, TypeError, ValueError):
+            errors.append(f'Invalid {key}.')
+    for key, bound in zip(COORDINATES, (90, 180, 90, 180)):
+        try:
+            values[key] = float(row[key])
+            if not -bound <= values[key] <= bound:
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            errors.append(f'Invalid {key}.')
+    try:
+        # None if malformed; ValueError if well formed but impossible, like month 13.
+        pickup_time = parse_datetime(row['pickup_time']) if isinstance(row.get('pickup_time'), str) else None
+    except ValueError:
+        pickup_time = None
+    if pickup_time is None:
+        errors.append('Invalid pickup_time.')
+    elif timezone.is_naive(pickup_time):
+        pickup_time = timezone.make_aware(pickup_time)
+    values['pickup_time'] = pickup_time
+    return (None, errors) if errors else (Booking(**values), [])
+
+
+def book(rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    """
+    Book the valid rides of a batch.
+
+    Args:
+        rows: The rides, as JSON objects with the `customer` and `car` ids, the pickup
+            and dropoff coordinates and an ISO `pickup_time`.
+
+    Returns:
+        For each row in order, the `id` of its order or the `errors` that kept it from
+        being booked.
+    """
+    parsed = [parse(row) for row in rows]
+    bookings = [booking for booking, _ in parsed if booking is not None]
+    owners = dict(Car.objects.filter(id__in={b.car_id for b in bookings}).values_list('id', 'customer_id'))
+    busy = set(Order.objects.filter(customer_id__in={b.customer_id for b in bookings}, completed=False)
+               .values_list('customer_id', flat=True))
+
+    now = timezone.now()
+    horizon = now + timedelta(seconds=getattr(settings, 'DAIKOU_BOOKING_HORIZON', 7 * 86400))
+    results: List[Dict[str, Any]] = []
+    orders: List[Order] = []
+    for booking, errors in parsed:
+        if booking is not None:
+            if owners.get(booking.car_id) != booking.customer_id:
+                errors.append('The selected car does not belong to the customer.')
+            if booking.customer_id in busy:
+                errors.append('A customer can only have one incomplete order at a time.')
+            if not now - PAST_GRACE <= booking.pickup_time <= horizon:
+                errors.append('The pickup time is outside the booking window.')
+        if errors:
+            results.append({'errors': errors})
+            continue
+        busy.add(booking.customer_id)
+        order = Order(**booking._asdict(), zone=zone_for(booking.pickup_latitude, booking.pickup_longitude),
+                      released=release_time(booking.pickup_time) <= now)
+        results.append({'order': order})
+        orders.append(order)
+
+    if not orders:
+        return results
+    with transaction.atomic():
+        Order.objects.bulk_create(orders, batch_size=500)
+        tasks.enqueue_releases(order for order in orders if not order.released)
+        heatmap.adjust_demand(heatmap.moves((None, heatmap.demand_key(order.__dict__)) for order in orders))
+        points = [point for order in orders for point in order_points(order)]
+        keys = {order_features_cache_key(zone) for zone in {'', *(order.zone for order in orders)}}
+        transaction.on_commit(partial(tiles.invalidate_points, 'orders', points))
+        transaction.on_commit(partial(cache.delete_many, list(keys)))
+    return [{'id': result.pop('order').id} if 'order' in result else result for result in results]
@@ -0,0 +1,223 @@
+"""
+Automatic dispatch of open orders, outside of the request cycle.
+
+The `dispatch` management command runs a pool of worker processes. Each
+worker holds renewable leases (`ZoneLease`) on some of the zones with open
+orders, and matches the orders of its zones with the nearest free driver of
+the same zone. A lease is only ever held by one worker; the zones are spread
+evenly over the live workers, so when a worker dies its leases expire and
+the others take over its zones, and when one joins the others hand some of
+theirs over.
+
+Workers are live as long as their `DispatchWorker` row has a recent
+heartbeat, which also carries the number of orders they dispatched. Leases
+and heartbeats are compared with the clock of each worker, so the machines
+running workers need synchronized clocks.
+
+Orders booked for later are only dispatched once released to the board;
+each worker releases the ones that are due before its pass (see
+find_daikou.scheduler).
+"""
+import logging
+import math
+import os
+import socket
+from datetime import timedelta
+from typing import List, Optional, Set
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .scheduler import Scheduler
+from .distances import lookup_many
+from .models import DispatchWorker, Driver, Order, ZoneLease
+from .zones import ZoneLockTimeout, zone_lock
+
+logger = logging.getLogger(__name__)
+
+def lease_duration() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'DAIKOU_DISPATCH_LEASE', 15))
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire_lease(zone: str, owner: str) -> bool:
+    """
+    Take or renew the lease on a zone.
+
+    Args:
+        zone: The zone to lease.
+        owner: The name of the worker taking the lease.
+
+    Returns:
+        Whether `owner` now holds the lease; False if another worker holds it.
+    """
+    now = timezone.now()
+    expires_at = now + lease_duration()
+    # A single conditional UPDATE, so two workers can't both take an expired lease.
+    if ZoneLease.objects.filter(Q(owner=owner) | Q(expires_at__lte=now), zone=zone).update(
+            owner=owner, expires_at=expires_at):
+        return True
+    try:
+        with transaction.atomic():
+            ZoneLease.objects.create(zone=zone, owner=owner, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    return True
+
+
+def release_leases(owner: str, zones: Optional[Set[str]] = None) -> None:
+    """Give up the leases of a worker, on the given zones or on all of them."""
+    leases = ZoneLease.objects.filter(owner=owner)
+    if zones is not None:
+        leases = leases.filter(zone__in=zones)
+    leases.delete()
+
+
+def held_zones(owner: str) -> Set[str]:
+    return set(ZoneLease.objects.filter(owner=owner, expires_at__gt=timezone.now()).values_list('zone', flat=True))
+
+
+def pending_zones() -> Set[str]:
+    """The zones with orders waiting for a driver."""
+    return set(Order.objects.open().values_list('zone', flat=True).distinct())
+
+
+def live_workers() -> int:
+    return DispatchWorker.objects.filter(heartbeat_at__gt=timezone.now() - lease_duration()).count()
+
+
+def rebalance(owner: str) -> List[str]:
+    """
+    Renew, take and give up leases so that `owner` holds its share of the zones with
+    open orders.
+
+    Returns:
+        The zones `owner` holds a lease on.
+    """
+    zones = pending_zones()
+    share = math.ceil(len(zones) / max(live_workers(), 1))
+    owned = held_zones(owner)
+    held = owned & zones
+    # Hand over zones without work, and the ones above our share so that
+    # workers that just joined get theirs.
+    surplus = set(sorted(held)[share:])
+    release_leases(owner, (owned - zones) | surplus)
+    held -= surplus
+    for zone in sorted(held):
+        if not acquire_lease(zone, owner):
+            held.discard(zone)
+    for zone in sorted(zones - held):
+        if len(held) >= share:
+            break
+        if acquire_lease(zone, owner):
+            held.add(zone)
+    return sorted(held)
+
+
+def dispatch_zone(zone: str) -> int:
+    """
+    Assign the open orders of a zone to the nearest free drivers of that zone.
+
+    Orders are served in order of pickup time. Rows being assigned elsewhere
+    (say by `confirm_order`) are skipped and picked up on the next pass.
+
+    Args:
+        zone: The zone to dispatch.
+
+    Returns:
+        The number of orders assigned.
+    """
+    batch_size = getattr(settings, 'DAIKOU_DISPATCH_BATCH_SIZE', 100)
+    assigned = 0
+    with zone_lock(zone), transaction.atomic():
+        orders = list(
+            Order.objects.in_zone(zone).open().select_for_update(skip_locked=True)
+            .order_by('pickup_time', 'id')[:batch_size]
+        )
+        if not orders:
+            return 0
+        busy = Order.objects.filter(completed=False, driver__isnull=False).values('driver')
+        drivers = list(
+            Driver.objects.in_zone(zone).select_for_update(skip_locked=True)
+            .filter(is_available=True).exclude(id__in=busy)
+        )
+        for order in orders:
+            if not drivers:
+                break
+            estimates = lookup_many([
+                ((order.pickup_latitude, order.pickup_longitude), (d.latitude, d.longitude)) for d in drivers
+            ])
+            nearest = min(range(len(drivers)), key=lambda i: estimates[i].km)
+            try:
+                taken = order.assign_driver(
+                    drivers[nearest], timezone.now() + timedelta(minutes=estimates[nearest].minutes))
+            except ValidationError as e:
+                logger.warning('Could not dispatch order %s: %s', order.id, e)
+                continue
+            if not taken:
+                continue
+            drivers.pop(nearest)
+            assigned += 1
+    return assigned
+
+
+class Worker:
+    """
+    One process of the dispatch pool.
+
+    Args:
+        name: The name the worker holds its leases under.
+        interval: Seconds between two dispatch passes.
+    """
+
+    def __init__(self, name: str, interval: Optional[float] = None):
+        self.name = name
+        self.interval = interval if interval is not None else getattr(settings, 'DAIKOU_DISPATCH_INTERVAL', 1)
+        self.started_at = timezone.now()
+        self.dispatched = 0
+        self.scheduler = Scheduler()
+
+    def heartbeat(self) -> None:
+        DispatchWorker.objects.update_or_create(name=self.name, defaults={
+            'started_at': self.started_at,
+            'heartbeat_at': timezone.now(),
+            'orders_dispatched': self.dispatched,
+        })
+
+    def run_once(self) -> int:
+        """Run one dispatch pass over the zones of this worker and return the orders assigned."""
+        self.heartbeat()
+        if self.scheduler.stale(getattr(settings, 'DAIKOU_SCHEDULER_REFRESH_INTERVAL', 60)):
+            self.scheduler.refresh()
+        self.scheduler.release_due()
+        assigned = 0
+        for zone in rebalance(self.name):
+            try:
+                assigned += dispatch_zone(zone)
+            except ZoneLockTimeout:
+                # Busy with requests; try again on the next pass.
+                continue
+        self.dispatched += assigned
+        if assigned:
+            self.heartbeat()
+        return assigned
+
+    def run(self, stop) -> None:
+        """Dispatch until `stop` (a threading or multiprocessing Event) is set, then hand back all leases."""
+        try:
+            while not stop.is_set():
+                try:
+                    self.run_once()
+                except Exception:
+                    logger.exception('Dispatch pass of %s failed.', self.name)
+                    connection.close()
+                stop.wait(self.interval)
+        finally:
+            release_leases(self.name)
+            DispatchWorker.objects.filter(name=self.name).delete()
@@ -0,0 +1,147 @@
+"""
+Memoized distances and travel times between pairs of points.
+
+ETA suggestions and dispatch keep measuring the same trips: from the
+station rank to the bar district, from the same few hot spots to the same
+pickups. Points are quantized to `DAIKOU_DISTANCE_PRECISION` decimals (3
+is about 100 m), and the distance of each quantized pair is kept:
+
+- in a per-process LRU of at most `DAIKOU_DISTANCE_LRU_SIZE` pairs, and
+- in the `DAIKOU_DISTANCE_CACHE` cache (an alias of `CACHES`) for
+  `DAIKOU_DISTANCE_CACHE_TIMEOUT` seconds, bounded by the backend's own
+  eviction. Its own alias keeps these entries from evicting those of the
+  default cache; it is only shared between processes on a shared backend.
+
+`lookup_many` reads a whole batch of pairs with one cache round trip and
+computes the missing ones in one vectorized numpy pass. Distances are great
+circle distances; travel times assume `DAIKOU_DISPATCH_SPEED_KMH`.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+
+from . import positions
+from .models import Driver, Order
+
+EARTH_RADIUS_KM = 6371.0
+
+# (latitude, longitude)
+Point = Tuple[float, float]
+# Quantized (latitude, longitude) of both ends, the smaller first
+PairKey = Tuple[int, int, int, int]
+
+
+class Estimate(NamedTuple):
+    km: float
+    minutes: float
+
+
+def precision() -> int:
+    return getattr(settings, 'DAIKOU_DISTANCE_PRECISION', 3)
+
+
+def pair_key(origin: Point, destination: Point) -> PairKey:
+    """The quantized pair; distances are symmetric, so both directions share a key."""
+    factor = 10 ** precision()
+    a = (round(float(origin[0]) * factor), round(float(origin[1]) * factor))
+    b = (round(float(destination[0]) * factor), round(float(destination[1]) * factor))
+    return (*a, *b) if a <= b else (*b, *a)
+
+
+def shared_cache() -> BaseCache:
+    return caches[getattr(settings, 'DAIKOU_DISTANCE_CACHE', 'distances')]
+
+
+def cache_key(key: PairKey) -> str:
+    return f"distance:{precision()}:{':'.join(map(str, key))}"
+
+
+def haversine_km_many(latitudes1, longitudes1, latitudes2, longitudes2) -> np.ndarray:
+    """The great-circle distances between arrays of points, in kilometers."""
+    phi1, phi2 = np.radians(latitudes1), np.radians(latitudes2)
+    d_lambda = np.radians(np.asarray(longitudes2) - np.asarray(longitudes1))
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class LRU:
+    """A thread-safe mapping that drops its least recently used entries above `DAIKOU_DISTANCE_LRU_SIZE`."""
+
+    def __init__(self):
+        self._entries: 'OrderedDict[PairKey, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Sequence[PairKey]) -> Dict[PairKey, float]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+        return found
+
+    def set_many(self, values: Dict[PairKey, float]) -> None:
+        size = getattr(settings, 'DAIKOU_DISTANCE_LRU_SIZE', 10000)
+        with self._lock:
+            self._entries.update(values)
+            for key in values:
+                self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+local = LRU()
+
+
+def lookup_many(pairs: Sequence[Tuple[Point, Point]]) -> List[Estimate]:
+    """
+    The distances and travel times of (origin, destination) pairs, in order.
+
+    Only the pairs found neither in the local LRU nor in the cache are computed,
+    all together.
+    """
+    keys = [pair_key(origin, destination) for origin, destination in pairs]
+    found = local.get_many(keys)
+
+    missing = list(dict.fromkeys(key for key in keys if key not in found))
+    if missing:
+        cache = shared_cache()
+        shared = cache.get_many([cache_key(key) for key in missing])
+        from_cache = {key: shared[cache_key(key)] for key in missing if cache_key(key) in shared}
+        found.update(from_cache)
+        local.set_many(from_cache)
+
+        missing = [key for key in missing if key not in from_cache]
+        if missing:
+            factor = 10 ** precision()
+            ends = np.array(missing, dtype=float) / factor
+            computed = dict(zip(missing, haversine_km_many(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3]).tolist()))
+            found.update(computed)
+            local.set_many(computed)
+            cache.set_many({cache_key(key): km for key, km in computed.items()},
+                           getattr(settings, 'DAIKOU_DISTANCE_CACHE_TIMEOUT', 86400))
+
+    speed = getattr(settings, 'DAIKOU_DISPATCH_SPEED_KMH', 30)
+    return [Estimate(found[key], found[key] / speed * 60) for key in keys]
+
+
+def lookup(origin: Point, destination: Point) -> Estimate:
+    """The distance and travel time from one point to another."""
+    return lookup_many([(origin, destination)])[0]
+
+
+def suggested_eta(driver: Driver, order: Order) -> Estimate:
+    """How far a driver is from the pickup of an order, from their latest (buffered) position."""
+    position = positions.buffer.get(driver.id, (driver.latitude, driver.longitude))
+    return lookup(position, (order.pickup_latitude, order.pickup_longitude))
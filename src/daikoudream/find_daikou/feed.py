@@ -0,0 +1,106 @@
+"""
+Change log of the available driver feed.
+
+Every change to a driver's feed entry (it moved, became available or stopped
+driving) appends the driver's id to a bounded log kept in the cache backend,
+so all processes sharing the cache see the same log. A client that passes the
+version of the last feed it received gets only the drivers logged since;
+once its version has fallen out of the log it gets a full snapshot again.
+
+Versions combine a random epoch, picked whenever the log starts over, with a
+sequence number, so a version from a lost log is never mistaken for a current
+one. They stay below 2**52 to survive a round trip through JavaScript.
+"""
+import random
+from typing import Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+EPOCH_KEY = 'fleet-log:epoch'
+SEQUENCE_KEY = 'fleet-log:seq'
+SEQUENCE_BITS = 32
+
+
+def log_size() -> int:
+    return getattr(settings, 'DAIKOU_FEED_LOG_SIZE', 1000)
+
+
+def log_timeout() -> int:
+    return getattr(settings, 'DAIKOU_FEED_LOG_TIMEOUT', 300)
+
+
+def _entry_key(sequence: int) -> str:
+    return f'fleet-log:{sequence}'
+
+
+def _epoch() -> int:
+    epoch = cache.get(EPOCH_KEY)
+    if epoch is None:
+        cache.add(EPOCH_KEY, random.getrandbits(52 - SEQUENCE_BITS) or 1, None)
+        cache.add(SEQUENCE_KEY, 0, None)
+        epoch = cache.get(EPOCH_KEY)
+    return epoch
+
+
+def _restart() -> None:
+    cache.set_many({EPOCH_KEY: random.getrandbits(52 - SEQUENCE_BITS) or 1, SEQUENCE_KEY: 0}, None)
+
+
+def _split(version: int) -> Tuple[int, int]:
+    return version >> SEQUENCE_BITS, version & ((1 << SEQUENCE_BITS) - 1)
+
+
+def _join(epoch: int, sequence: int) -> int:
+    return (epoch << SEQUENCE_BITS) | sequence
+
+
+def current_version() -> int:
+    """The version of the feed as of now."""
+    epoch = _epoch()
+    return _join(epoch, cache.get(SEQUENCE_KEY, 0))
+
+
+def record_change(driver_id: int) -> None:
+    """Log that the feed entry of a driver changed."""
+    _epoch()
+    try:
+        sequence = cache.incr(SEQUENCE_KEY)
+    except ValueError:
+        # The sequence was evicted: start a new log, which sends every client
+        # back to a full snapshot.
+        _restart()
+        return
+    if sequence >= 1 << SEQUENCE_BITS:
+        _restart()
+        return
+    cache.set(_entry_key(sequence), driver_id, log_timeout())
+
+
+def changes_since(version: int) -> Optional[Tuple[int, Set[int]]]:
+    """
+    Collect the drivers whose feed entry changed after `version`.
+
+    Returns:
+        The version the changes bring the client to and the ids of the changed
+        drivers, or None if `version` is no longer covered by the log and the
+        client needs a full snapshot.
+    """
+    epoch, since = _split(version)
+    if epoch != _epoch():
+        return None
+    current = cache.get(SEQUENCE_KEY, 0)
+    if since > current or current - since > log_size():
+        return None
+    entries = cache.get_many([_entry_key(seq) for seq in range(since + 1, current + 1)])
+    if current > since + 1 and _entry_key(since + 1) not in entries:
+        # The oldest entry the client needs has expired or was evicted.
+        return None
+    changed: Set[int] = set()
+    sequence = since
+    # Stop at the first gap: its writer has bumped the sequence but not stored
+    # the entry yet, and the rest is picked up by the next poll.
+    while sequence < current and _entry_key(sequence + 1) in entries:
+        sequence += 1
+        changed.add(entries[_entry_key(sequence)])
+    return _join(epoch, sequence), changed
@@ -0,0 +1,266 @@
+"""
+Compact in-memory state of the fleet, for the hot paths that look at every
+driver: the driver feed snapshots and the nearby driver counts.
+
+Each process keeps one `FleetState`: parallel numpy arrays of the id,
+position, availability, zone and current order of every driver, and an
+id -> slot map, about a hundred bytes per driver instead of the kilobytes of
+a `Driver` and its `CustomUser`. Lookups and updates of a driver are O(1);
+removing one moves the last slot into its place.
+
+The state is loaded from the database on first use and kept in sync:
+
+- in this process, by the write paths: the position buffer moves drivers
+  as they report, and the model signals (see find_daikou.signals) refresh
+  drivers and assign orders once their writes are committed;
+- from other processes, through the feed change log (see find_daikou.feed):
+  `current` reloads the drivers logged since the state was last synced, and
+  reloads everything if the log no longer covers it, or every
+  `DAIKOU_FLEET_RELOAD_INTERVAL` seconds, which also catches orders
+  assigned elsewhere.
+
+A reload builds new arrays aside and swaps them in, so the feed and nearby
+requests of the process go on reading the current ones meanwhile, and only
+one thread reloads at a time.
+"""
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+import numpy as np
+from django.conf import settings
+
+from . import feed, positions
+from .models import Driver, Order
+
+NO_ORDER = 0
+
+# What a load replaces.
+LOADED = ('ids', 'latitudes', 'longitudes', 'available', 'orders', 'zones', 'names', 'index', 'size',
+          'zone_names', '_zone_codes')
+
+
+class FleetRows(NamedTuple):
+    """Some drivers of the fleet, by increasing id."""
+    ids: np.ndarray
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+    names: List[str]
+
+
+class FleetState:
+    """The drivers of the fleet, in parallel arrays."""
+
+    def __init__(self, capacity: int = 1024):
+        self._lock = threading.RLock()
+        self._loading = threading.Lock()
+        # The drivers changed while a load is reading the database.
+        self._changed: Optional[Set[int]] = None
+        self._allocate(capacity)
+        self.version: Optional[int] = None
+        self.loaded_at: Optional[float] = None
+
+    def _allocate(self, capacity: int) -> None:
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.latitudes = np.zeros(capacity, dtype=np.float64)
+        self.longitudes = np.zeros(capacity, dtype=np.float64)
+        self.available = np.zeros(capacity, dtype=bool)
+        self.orders = np.zeros(capacity, dtype=np.int64)
+        self.zones = np.zeros(capacity, dtype=np.int32)
+        self.names: List[str] = []
+        self.index: Dict[int, int] = {}
+        self.size = 0
+        self.zone_names: List[str] = []
+        self._zone_codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _zone_code(self, zone: str) -> int:
+        code = self._zone_codes.get(zone)
+        if code is None:
+            code = self._zone_codes[zone] = len(self.zone_names)
+            self.zone_names.append(zone)
+        return code
+
+    def _note(self, driver_id: int) -> None:
+        if self._changed is not None:
+            self._changed.add(driver_id)
+
+    def _grow(self) -> None:
+        capacity = max(2 * len(self.ids), 1)
+        for name in ('ids', 'latitudes', 'longitudes', 'available', 'orders', 'zones'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, name, grown)
+
+    def put(self, driver_id: int, latitude: float, longitude: float, available: bool, zone: str,
+            name: str, order_id: Optional[int] = None) -> None:
+        """Add or replace a driver."""
+        with self._lock:
+            self._note(driver_id)
+            slot = self.index.get(driver_id)
+            if slot is None:
+                if self.size == len(self.ids):
+                    self._grow()
+                slot = self.index[driver_id] = self.size
+                self.size += 1
+                self.names.append(name)
+            else:
+                self.names[slot] = name
+            self.ids[slot] = driver_id
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+            self.available[slot] = available
+            self.zones[slot] = self._zone_code(zone)
+            self.orders[slot] = order_id or NO_ORDER
+
+    def move(self, driver_id: int, latitude: float, longitude: float, zone: str) -> None:
+        with self._lock:
+            self._note(driver_id)
+            slot = self.index.get(driver_id)
+            if slot is not None:
+                self.latitudes[slot] = latitude
+                self.longitudes[slot] = longitude
+                self.zones[slot] = self._zone_code(zone)
+
+    def assign(self, driver_id: int, order_id: int) -> None:
+        with self._lock:
+            self._note(driver_id)
+            slot = self.index.get(driver_id)
+            if slot is not None:
+                self.orders[slot] = order_id
+
+    def unassign(self, driver_id: int, order_id: int) -> None:
+        """Take an order off a driver, unless the driver has moved on to another one."""
+        with self._lock:
+            self._note(driver_id)
+            slot = self.index.get(driver_id)
+            if slot is not None and self.orders[slot] == order_id:
+                self.orders[slot] = NO_ORDER
+
+    def remove(self, driver_id: int) -> None:
+        with self._lock:
+            self._note(driver_id)
+            slot = self.index.pop(driver_id, None)
+            if slot is None:
+                return
+            last = self.size - 1
+            if slot != last:
+                for array in (self.ids, self.latitudes, self.longitudes, self.available, self.orders, self.zones):
+                    array[slot] = array[last]
+                self.names[slot] = self.names[last]
+                self.index[int(self.ids[slot])] = slot
+            self.names.pop()
+            self.size = last
+
+    def rows(self, zone: str = '', free: bool = False, ids: Optional[Iterable[int]] = None) -> FleetRows:
+        """
+        The available drivers, by increasing id.
+
+        Args:
+            zone: Only the drivers of this zone, or of every zone for ''.
+            free: Only the drivers without an order.
+            ids: Only the drivers with these ids.
+        """
+        with self._lock:
+            n = self.size
+            mask = self.available[:n].copy()
+            if zone:
+                code = self._zone_codes.get(zone)
+                if code is None:
+                    return FleetRows(np.zeros(0, np.int64), np.zeros(0), np.zeros(0), [])
+                mask &= self.zones[:n] == code
+            if free:
+                mask &= self.orders[:n] == NO_ORDER
+            if ids is not None:
+                mask &= np.isin(self.ids[:n], np.fromiter(ids, dtype=np.int64))
+            slots = np.flatnonzero(mask)
+            slots = slots[np.argsort(self.ids[slots], kind='stable')]
+            return FleetRows(self.ids[slots], self.latitudes[slots], self.longitudes[slots],
+                             [self.names[slot] for slot in slots])
+
+    def _read(self, drivers) -> None:
+        """Put the drivers of a queryset, at their buffered positions and with their orders."""
+        busy = dict(Order.objects.filter(driver__in=drivers.values('id'), completed=False)
+                    .values_list('driver_id', 'id'))
+        rows = drivers.values_list('id', 'latitude', 'longitude', 'is_available', 'zone', 'user__username')
+        for pk, latitude, longitude, available, zone, name in rows.iterator(chunk_size=2000):
+            buffered = positions.buffer.get(pk)
+            if buffered is not None:
+                latitude, longitude = buffered
+            self.put(pk, latitude, longitude, available, zone, name, busy.get(pk))
+
+    def load(self) -> None:
+        """
+        Load every driver from the database, replacing the current state.
+
+        The drivers are read into a new state without holding the lock, and swapped
+        in under it. The drivers changed in this process meanwhile are read again.
+        """
+        version = feed.current_version()
+        with self._lock:
+            self._changed = set()
+        try:
+            loaded = FleetState(max(Driver.objects.count(), 1024))
+            loaded._read(Driver.objects.all())
+        finally:
+            with self._lock:
+                changed, self._changed = self._changed, None
+        with self._lock:
+            for name in LOADED:
+                setattr(self, name, getattr(loaded, name))
+            self.version = version
+            self.loaded_at = time.monotonic()
+            self.refresh(changed)
+
+    def reload(self) -> None:
+        """
+        Load the state, unless another thread is already loading it.
+
+        Then the current state is good enough, and only a first load is waited for.
+        """
+        loaded_at = self.loaded_at
+        if not self._loading.acquire(blocking=loaded_at is None):
+            return
+        try:
+            # Loaded by the thread we waited for
+            if self.loaded_at == loaded_at:
+                self.load()
+        finally:
+            self._loading.release()
+
+    def refresh(self, driver_ids: Iterable[int]) -> None:
+        """Read some drivers from the database again, dropping the ones that are gone."""
+        driver_ids = set(driver_ids)
+        if not driver_ids or self.loaded_at is None:
+            return
+        with self._lock:
+            for pk in driver_ids:
+                self.remove(pk)
+            self._read(Driver.objects.filter(id__in=driver_ids))
+
+    def sync(self) -> None:
+        """Catch up with the drivers changed in other processes."""
+        interval = getattr(settings, 'DAIKOU_FLEET_RELOAD_INTERVAL', 60)
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= interval:
+            self.reload()
+            return
+        changes = feed.changes_since(self.version)
+        if changes is None:
+            self.reload()
+            return
+        version, changed = changes
+        with self._lock:
+            self.refresh(changed)
+            self.version = version
+
+
+state = FleetState()
+
+
+def current() -> FleetState:
+    """The fleet state of this process, synced with the other processes."""
+    state.sync()
+    return state
@@ -0,0 +1,231 @@
+"""
+Demand and supply heatmap, kept up to date as orders and drivers change.
+
+The map is divided into square cells of `DAIKOU_HEATMAP_CELL_SIZE` degrees.
+Demand is the number of open orders (waiting for a driver) picking up in a
+cell, per window of `DAIKOU_HEATMAP_WINDOW` seconds of pickup time. Supply is
+the number of available drivers in a cell right now.
+
+Both are stored as counters (`DemandCell`, `SupplyCell`) that are adjusted
+whenever an order is created, assigned, completed or deleted, and whenever a
+driver moves or changes availability (see find_daikou.signals and the position
+buffer). Reading a view only reads the cells inside it, however many orders
+there are.
+
+`rebuild` counts everything again from the orders and drivers, to start the
+counters on an existing database or repair them (the `rebuild_heatmap`
+management command). `prune` deletes the cells whose counters are back to 0,
+every `DAIKOU_HEATMAP_PRUNE_INTERVAL` seconds (the `prune_heatmap` job).
+"""
+import math
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DemandCell, Driver, Order, SupplyCell
+
+# (x, y), with x counted in cells east of longitude 0 and y north of latitude 0
+Cell = Tuple[int, int]
+# (window, x, y)
+DemandKey = Tuple[datetime, int, int]
+BBox = Tuple[float, float, float, float]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class ViewTooLarge(ValueError):
+    pass
+
+
+def cell_size() -> float:
+    return getattr(settings, 'DAIKOU_HEATMAP_CELL_SIZE', 0.01)
+
+
+def window_seconds() -> int:
+    return getattr(settings, 'DAIKOU_HEATMAP_WINDOW', 900)
+
+
+def cell_for(latitude: float, longitude: float) -> Cell:
+    size = cell_size()
+    return math.floor(float(longitude) / size), math.floor(float(latitude) / size)
+
+
+def window_for(moment: datetime) -> datetime:
+    """The start of the window containing `moment`."""
+    if timezone.is_naive(moment):
+        # Stored in the default time zone, as the database does
+        moment = timezone.make_aware(moment)
+    seconds = window_seconds()
+    return EPOCH + timedelta(seconds=(moment - EPOCH).total_seconds() // seconds * seconds)
+
+
+def demand_key(values: Dict[str, Any]) -> Optional[DemandKey]:
+    """
+    The demand cell an order counts in, or None if it does not count.
+
+    Args:
+        values: The field values of the order, as in its `__dict__`.
+    """
+    try:
+        if values['completed'] or values['driver_id'] is not None or values['pickup_time'] is None:
+            return None
+        return (window_for(values['pickup_time']), *cell_for(values['pickup_latitude'], values['pickup_longitude']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def supply_key(values: Dict[str, Any]) -> Optional[Cell]:
+    """
+    The supply cell a driver counts in, or None if it does not count.
+
+    Args:
+        values: The field values of the driver, as in its `__dict__`.
+    """
+    try:
+        if not values['is_available']:
+            return None
+        return cell_for(values['latitude'], values['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def moves(changes: Iterable[Tuple[Optional[tuple], Optional[tuple]]]) -> Counter:
+    """Sum up (old key, new key) changes into the delta of each key."""
+    deltas: Counter = Counter()
+    for old, new in changes:
+        if old == new:
+            continue
+        if old is not None:
+            deltas[old] -= 1
+        if new is not None:
+            deltas[new] += 1
+    return deltas
+
+
+def _adjust(model, field: str, names: Tuple[str, ...], deltas: Counter) -> None:
+    # In key order, so that concurrent adjustments lock rows in the same order.
+    for key in sorted(deltas):
+        delta = deltas[key]
+        if not delta:
+            continue
+        lookup = dict(zip(names, key))
+        if model.objects.filter(**lookup).update(**{field: F(field) + delta}):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**lookup, **{field: delta})
+        except IntegrityError:
+            # Created concurrently
+            model.objects.filter(**lookup).update(**{field: F(field) + delta})
+
+
+def adjust_demand(deltas: Counter) -> None:
+    """Add to the demand counters, by (window, x, y)."""
+    _adjust(DemandCell, 'pending', ('window', 'x', 'y'), deltas)
+
+
+def adjust_supply(deltas: Counter) -> None:
+    """Add to the supply counters, by (x, y)."""
+    _adjust(SupplyCell, 'available', ('x', 'y'), deltas)
+
+
+def cells_in_view(bbox: BBox, window: datetime) -> List[Dict[str, Any]]:
+    """
+    The cells with demand or supply inside a view.
+
+    Args:
+        bbox: The view, as (min_lon, min_lat, max_lon, max_lat).
+        window: Count the orders picking up in the window containing this moment.
+
+    Returns:
+        A dict per cell with its `x`, `y`, `demand` and `supply`.
+
+    Raises:
+        ViewTooLarge: If the view spans more than `DAIKOU_HEATMAP_MAX_CELLS` cells.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    min_x, min_y = cell_for(min_lat, min_lon)
+    max_x, max_y = cell_for(max_lat, max_lon)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > getattr(settings, 'DAIKOU_HEATMAP_MAX_CELLS', 10000):
+        raise ViewTooLarge('Too many cells in view.')
+
+    in_view = {'x__gte': min_x, 'x__lte': max_x, 'y__gte': min_y, 'y__lte': max_y}
+    cells: Dict[Cell, Dict[str, Any]] = {}
+    for x, y, pending in DemandCell.objects.filter(window=window_for(window), pending__gt=0, **in_view) \
+            .values_list('x', 'y', 'pending'):
+        cells[x, y] = {'x': x, 'y': y, 'demand': pending, 'supply': 0}
+    for x, y, available in SupplyCell.objects.filter(available__gt=0, **in_view).values_list('x', 'y', 'available'):
+        cells.setdefault((x, y), {'x': x, 'y': y, 'demand': 0})['supply'] = available
+    return [cells[cell] for cell in sorted(cells)]
+
+
+def as_geojson(cells: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """The cells as a GeoJSON FeatureCollection of squares."""
+    size = cell_size()
+    features = []
+    for cell in cells:
+        lon, lat = cell['x'] * size, cell['y'] * size
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]],
+            },
+            'properties': cell,
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def prune() -> Tuple[int, int]:
+    """
+    Delete the cells that count nothing anymore.
+
+    A cell is created the first time something counts in it, and its counter goes
+    back to 0 as orders are taken and drivers leave, so every past window would
+    keep its rows. Only empty cells are deleted: a past window may still hold
+    orders nobody took, and its count must be there when they are. What is left
+    is bounded by the open orders and the available drivers.
+
+    Returns:
+        The number of demand and supply cells deleted.
+    """
+    demand, _ = DemandCell.objects.filter(pending=0).delete()
+    supply, _ = SupplyCell.objects.filter(available=0).delete()
+    return demand, supply
+
+
+@transaction.atomic
+def rebuild() -> Tuple[int, int]:
+    """
+    Count the demand and supply cells again from scratch.
+
+    Returns:
+        The number of demand and supply cells written.
+    """
+    demand = Counter(
+        demand_key(values) for values in
+        Order.objects.filter(driver=None, completed=False)
+        .values('completed', 'driver_id', 'pickup_time', 'pickup_latitude', 'pickup_longitude')
+    )
+    supply = Counter(
+        supply_key(values) for values in
+        Driver.objects.filter(is_available=True).values('is_available', 'latitude', 'longitude')
+    )
+    demand.pop(None, None)
+    supply.pop(None, None)
+    DemandCell.objects.all().delete()
+    SupplyCell.objects.all().delete()
+    DemandCell.objects.bulk_create(
+        [DemandCell(window=window, x=x, y=y, pending=count) for (window, x, y), count in demand.items()],
+        batch_size=500,
+    )
+    SupplyCell.objects.bulk_create(
+        [SupplyCell(x=x, y=y, available=count) for (x, y), count in supply.items()],
+        batch_size=500,
+    )
+    return len(demand), len(supply)
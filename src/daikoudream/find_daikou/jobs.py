@@ -0,0 +1,264 @@
+"""
+A durable background job queue kept in the database.
+
+Views enqueue the follow-up work a user does not need to wait for, and the
+`run_jobs` management command runs it in worker processes. There is no broker:
+jobs are `Job` rows, claimed with `SELECT ... FOR UPDATE SKIP LOCKED`, and a
+job enqueued inside a transaction only becomes visible to workers once that
+transaction commits.
+
+Job types are registered with the `job` decorator (see find_daikou.tasks) and
+can ask for:
+
+- a priority: higher priority jobs are claimed first;
+- retries: a failing job is retried up to `max_attempts` times, waiting
+  `backoff * 2 ** (attempt - 1)` seconds (at most `DAIKOU_JOB_MAX_BACKOFF`)
+  before each retry;
+- batching: queued jobs of a type with `batch_size` above 1 and the same
+  `batch_key` are claimed together and handed to one call, as a list of
+  payloads.
+
+Jobs may carry an idempotency key, in which case enqueueing the same key
+again returns the existing job instead of adding one. Keys are remembered
+as long as finished jobs are kept, `DAIKOU_JOB_KEEP` seconds.
+
+With `DAIKOU_JOBS_EAGER`, jobs are still recorded but run in the process that
+enqueued them, right after its transaction commits. Handy without workers.
+"""
+import logging
+import traceback
+from datetime import timedelta
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobType(NamedTuple):
+    func: Callable
+    priority: int
+    max_attempts: int
+    backoff: float
+    batch_size: int
+
+
+registry: Dict[str, JobType] = {}
+
+
+def job(name: str, *, priority: int = 0, max_attempts: int = 5, backoff: float = 2.0, batch_size: int = 1):
+    """
+    Register a function as a job type.
+
+    The function is called with the payload as keyword arguments, or with a list of
+    payloads if `batch_size` is above 1.
+
+    Args:
+        name: The name jobs of this type are enqueued under.
+        priority: The default priority of its jobs.
+        max_attempts: How often a job is tried before it is marked failed.
+        backoff: Seconds to wait before the first retry, doubled for every further one.
+        batch_size: The most jobs handed to one call.
+    """
+    def register(func: Callable) -> Callable:
+        registry[name] = JobType(func, priority, max_attempts, backoff, batch_size)
+        return func
+    return register
+
+
+def enqueue(name: str, payload: Optional[Dict[str, Any]] = None, *, priority: Optional[int] = None,
+            idempotency_key: Optional[str] = None, batch_key: str = '', delay: float = 0) -> Job:
+    """
+    Add a job to the queue.
+
+    Args:
+        name: The registered name of the job type.
+        payload: The JSON-serializable arguments of the job.
+        priority: Overrides the priority of the job type.
+        idempotency_key: If a job with this key exists, it is returned instead of adding one.
+        batch_key: Jobs with the same name and batch key may be run together.
+        delay: Seconds before the job may run.
+
+    Returns:
+        The queued job.
+    """
+    job_type = registry.get(name)
+    if job_type is None:
+        raise ValueError(f'Unknown job {name}.')
+    if idempotency_key is not None:
+        existing = Job.objects.filter(idempotency_key=idempotency_key).first()
+        if existing is not None:
+            return existing
+    try:
+        with transaction.atomic():
+            queued = Job.objects.create(
+                name=name,
+                payload=payload or {},
+                priority=job_type.priority if priority is None else priority,
+                run_at=timezone.now() + timedelta(seconds=delay),
+                max_attempts=job_type.max_attempts,
+                idempotency_key=idempotency_key,
+                batch_key=batch_key,
+            )
+    except IntegrityError:
+        if idempotency_key is None:
+            raise
+        return Job.objects.get(idempotency_key=idempotency_key)
+    if getattr(settings, 'DAIKOU_JOBS_EAGER', False) and not delay:
+        transaction.on_commit(partial(run_pending, 'eager', [queued.id]))
+    return queued
+
+
+def enqueue_many(name: str, jobs: Iterable[Tuple[Dict[str, Any], float]], *, batch_key: str = '') -> List[Job]:
+    """
+    Add several jobs of a type to the queue in one insert.
+
+    Args:
+        name: The registered name of the job type.
+        jobs: The payload and delay, in seconds, of each job.
+        batch_key: Jobs with the same name and batch key may be run together.
+
+    Returns:
+        The queued jobs.
+    """
+    job_type = registry.get(name)
+    if job_type is None:
+        raise ValueError(f'Unknown job {name}.')
+    now = timezone.now()
+    queued = Job.objects.bulk_create([
+        Job(name=name, payload=payload, priority=job_type.priority, run_at=now + timedelta(seconds=delay),
+            max_attempts=job_type.max_attempts, batch_key=batch_key)
+        for payload, delay in jobs
+    ], batch_size=500)
+    due = [j.id for j in queued if j.run_at <= now]
+    if getattr(settings, 'DAIKOU_JOBS_EAGER', False) and due:
+        transaction.on_commit(partial(run_pending, 'eager', due))
+    return queued
+
+
+def claim(worker: str, ids: Optional[List[int]] = None) -> List[Job]:
+    """
+    Claim the next due job, along with the jobs that may be batched with it.
+
+    Args:
+        worker: The name of the claiming worker.
+        ids: Only claim among these jobs.
+
+    Returns:
+        The claimed jobs, all of the same type; empty if no job is due.
+    """
+    now = timezone.now()
+    due = Job.objects.select_for_update(skip_locked=True).filter(status=Job.QUEUED, run_at__lte=now)
+    if ids is not None:
+        due = due.filter(id__in=ids)
+    with transaction.atomic():
+        first = due.order_by('-priority', 'run_at', 'id').first()
+        if first is None:
+            return []
+        batch = [first]
+        job_type = registry.get(first.name)
+        if job_type is not None and job_type.batch_size > 1:
+            batch += due.filter(name=first.name, batch_key=first.batch_key).exclude(id=first.id) \
+                .order_by('run_at', 'id')[:job_type.batch_size - 1]
+        Job.objects.filter(id__in=[j.id for j in batch]).update(
+            status=Job.RUNNING, locked_by=worker, locked_at=now, attempts=F('attempts') + 1,
+        )
+    for claimed in batch:
+        claimed.status, claimed.attempts = Job.RUNNING, claimed.attempts + 1
+    return batch
+
+
+def backoff_delay(job_type: Optional[JobType], attempts: int) -> float:
+    base = job_type.backoff if job_type is not None else 2.0
+    return min(base * 2 ** (attempts - 1), getattr(settings, 'DAIKOU_JOB_MAX_BACKOFF', 3600))
+
+
+def execute(batch: List[Job]) -> bool:
+    """
+    Run claimed jobs and record the outcome: done, queued for a retry, or failed.
+
+    Returns:
+        Whether the jobs succeeded.
+    """
+    name = batch[0].name
+    job_type = registry.get(name)
+    try:
+        if job_type is None:
+            raise LookupError(f'Unknown job {name}.')
+        # The job's writes are undone if it fails, so a retry starts afresh.
+        with transaction.atomic():
+            if job_type.batch_size > 1:
+                job_type.func([j.payload for j in batch])
+            else:
+                job_type.func(**batch[0].payload)
+    except Exception:
+        logger.exception('Job %s failed.', name)
+        error = traceback.format_exc()
+        now = timezone.now()
+        for failed in batch:
+            if failed.attempts >= failed.max_attempts:
+                changes = {'status': Job.FAILED, 'finished_at': now}
+            else:
+                changes = {'status': Job.QUEUED,
+                           'run_at': now + timedelta(seconds=backoff_delay(job_type, failed.attempts))}
+            Job.objects.filter(id=failed.id).update(last_error=error, locked_by='', locked_at=None, **changes)
+        return False
+    Job.objects.filter(id__in=[j.id for j in batch]).update(status=Job.DONE, finished_at=timezone.now())
+    return True
+
+
+def requeue_stale() -> int:
+    """Queue again the running jobs of workers that died, and return how many there were."""
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'DAIKOU_JOB_TIMEOUT', 300))
+    return Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(
+        status=Job.QUEUED, locked_by='', locked_at=None,
+    )
+
+
+def purge_finished() -> int:
+    """Delete the jobs that finished more than `DAIKOU_JOB_KEEP` seconds ago."""
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'DAIKOU_JOB_KEEP', 86400))
+    deleted, _ = Job.objects.filter(status__in=[Job.DONE, Job.FAILED], finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def run_pending(worker: str = 'inline', ids: Optional[List[int]] = None) -> int:
+    """
+    Run due jobs until there are none left.
+
+    Args:
+        worker: The name to claim jobs under.
+        ids: Only run these jobs.
+
+    Returns:
+        The number of jobs run.
+    """
+    count = 0
+    while True:
+        batch = claim(worker, ids)
+        if not batch:
+            return count
+        execute(batch)
+        count += len(batch)
+
+
+def run_worker(worker: str, stop, interval: float) -> None:
+    """Run jobs until `stop` (a threading or multiprocessing Event) is set."""
+    while not stop.is_set():
+        try:
+            batch = claim(worker)
+            if batch:
+                execute(batch)
+                continue
+            requeue_stale()
+            purge_finished()
+        except Exception:
+            logger.exception('Job worker %s failed.', worker)
+            connection.close()
+        stop.wait(interval)
@@ -0,0 +1,74 @@
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from find_daikou.dispatch import Worker, worker_name
+from find_daikou.models import DispatchWorker
+
+
+def run_worker(stop, interval: float) -> None:
+    # The pool is stopped through `stop`; don't die halfway through a pass on Ctrl-C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    Worker(worker_name(), interval).run(stop)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of dispatch workers that assign open orders to the nearest free drivers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='Number of worker processes (default: one per CPU).')
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'DAIKOU_DISPATCH_INTERVAL', 1),
+                            help='Seconds between two dispatch passes of a worker.')
+        parser.add_argument('--report', type=float, default=60,
+                            help='Seconds between two throughput reports.')
+
+    def handle(self, *args, **options):
+        # Workers are forked, and must not share the parent's database connections.
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+        def spawn():
+            connections.close_all()
+            process = context.Process(target=run_worker, args=(stop, options['interval']), daemon=True)
+            process.start()
+            return process
+
+        processes = [spawn() for _ in range(options['workers'])]
+        self.stdout.write(f"Started {len(processes)} dispatch workers.")
+        last_report, last_counts = time.monotonic(), {}
+        try:
+            while not stop.is_set():
+                stop.wait(1)
+                for i, process in enumerate(processes):
+                    if not process.is_alive() and not stop.is_set():
+                        # Its leases expire and are taken over by the others meanwhile.
+                        self.stderr.write(f"Dispatch worker {process.pid} exited with {process.exitcode}, restarting it.")
+                        processes[i] = spawn()
+                now = time.monotonic()
+                if now - last_report >= options['report']:
+                    last_counts = self.report(last_counts, now - last_report)
+                    last_report = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        self.stdout.write("Dispatch workers stopped.")
+
+    def report(self, last_counts, elapsed):
+        """Write the orders per second of each worker since the last report."""
+        counts = dict(DispatchWorker.objects.values_list('name', 'orders_dispatched'))
+        for name, count in sorted(counts.items()):
+            rate = (count - last_counts.get(name, 0)) / elapsed if elapsed else 0
+            self.stdout.write(f"{name}: {count} orders dispatched, {rate:.2f} orders/s")
+        return counts
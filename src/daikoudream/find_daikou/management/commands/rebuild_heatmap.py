@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from find_daikou import heatmap
+
+
+class Command(BaseCommand):
+    help = ('Count the demand and supply heatmap cells again from the orders and drivers. '
+            'Run once on an existing database, or to repair the counters.')
+
+    def handle(self, *args, **options):
+        demand, supply = heatmap.rebuild()
+        self.stdout.write(f"Wrote {demand} demand cells and {supply} supply cells.")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from find_daikou import rollups
+
+
+class Command(BaseCommand):
+    help = 'Update the hourly and daily order rollups with the orders changed since the last run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Count every day again, not only the ones with changed orders.')
+
+    def handle(self, *args, **options):
+        days, count = rollups.run(full=options['full'])
+        self.stdout.write(f"Counted {days} days into {count} rollups.")
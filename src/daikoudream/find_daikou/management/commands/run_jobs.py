@@ -0,0 +1,67 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from find_daikou import jobs, tasks
+from find_daikou.dispatch import worker_name
+
+
+def run_worker(stop, interval: float) -> None:
+    # The pool is stopped through `stop`; don't die halfway through a job on Ctrl-C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    jobs.run_worker(worker_name(), stop, interval)
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs from the database queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes.')
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'DAIKOU_JOB_POLL_INTERVAL', 1),
+                            help='Seconds an idle worker waits before looking for jobs again.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Run the jobs that are due in this process, then exit.')
+
+    def handle(self, *args, **options):
+        # Recurring jobs queue their next run themselves; start them, once.
+        tasks.schedule_recurring()
+        if options['burst']:
+            jobs.requeue_stale()
+            self.stdout.write(f"Ran {jobs.run_pending(worker_name())} jobs.")
+            return
+
+        # Workers are forked, and must not share the parent's database connections.
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+        def spawn():
+            connections.close_all()
+            process = context.Process(target=run_worker, args=(stop, options['interval']), daemon=True)
+            process.start()
+            return process
+
+        processes = [spawn() for _ in range(options['workers'])]
+        self.stdout.write(f"Started {len(processes)} job workers.")
+        try:
+            while not stop.is_set():
+                stop.wait(1)
+                for i, process in enumerate(processes):
+                    if not process.is_alive() and not stop.is_set():
+                        # Its running jobs are queued again after DAIKOU_JOB_TIMEOUT.
+                        self.stderr.write(f"Job worker {process.pid} exited with {process.exitcode}, restarting it.")
+                        processes[i] = spawn()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        self.stdout.write("Job workers stopped.")
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from find_daikou.simulation import Settings, Simulation
+
+
+class Command(BaseCommand):
+    help = ('Load the service with simulated drivers and customers going through the real views, '
+            'and report throughput, latencies, errors and broken constraints.')
+
+    def add_arguments(self, parser):
+        defaults = Settings()
+        parser.add_argument('--seed', type=int, default=defaults.seed,
+                            help='Seed of the simulation; the same seed makes the same plans.')
+        parser.add_argument('--drivers', type=int, default=defaults.drivers, help='Number of simulated drivers.')
+        parser.add_argument('--customers', type=int, default=defaults.customers, help='Number of simulated customers.')
+        parser.add_argument('--ticks', type=int, default=defaults.ticks, help='Number of steps every agent takes.')
+        parser.add_argument('--tick', type=float, default=defaults.tick, help='Simulated seconds per step.')
+        parser.add_argument('--center', type=float, nargs=2, default=defaults.center, metavar=('LATITUDE', 'LONGITUDE'),
+                            help='Center of the simulated area.')
+        parser.add_argument('--radius', type=float, default=defaults.radius_km, help='Radius of the simulated area, in km.')
+        parser.add_argument('--booking-rate', type=float, default=defaults.booking_rate,
+                            help='Chance that an idle customer books a ride on a step.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of threads sending requests.')
+        parser.add_argument('--clean-up', action='store_true',
+                            help='Delete the simulated users and their orders afterwards.')
+
+    def handle(self, *args, **options):
+        simulation = Simulation(Settings(
+            seed=options['seed'],
+            drivers=options['drivers'],
+            customers=options['customers'],
+            ticks=options['ticks'],
+            tick=options['tick'],
+            center=tuple(options['center']),
+            radius_km=options['radius'],
+            booking_rate=options['booking_rate'],
+        ))
+        try:
+            report = simulation.run(options['concurrency'])
+        finally:
+            if options['clean_up']:
+                simulation.clean_up()
+
+        self.stdout.write(f"{report.requests} requests in {report.seconds:.1f} s: "
+                          f"{report.throughput:.1f} requests/s, {report.errors} errors")
+        self.stdout.write(f"{'view':<28}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+        for view, (count, errors, p50, p90, p99) in report.views.items():
+            self.stdout.write(f"{view:<28}{count:>10}{errors:>8}{p50 * 1000:>10.1f}{p90 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+        for event, count in sorted(report.events.items()):
+            self.stdout.write(f"{event}: {count}")
+        for violation, count in report.violations.items():
+            write = self.stderr.write if count else self.stdout.write
+            write(f"{violation}: {count}")
@@ -0,0 +1,147 @@
+"""
+Backpressure for the map polling endpoints.
+
+`BackpressureMiddleware` counts the polling requests in flight and keeps a
+moving average of database query latency. When either climbs past its
+thresholds, polls are answered from stale cached data and told to come back
+less often; only when nothing stale is at hand are they turned away with a
+503. Booking and order acceptance are never shed, so they keep the database
+to themselves while the map slows down.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.urls import Resolver404, resolve
+
+from .models import order_features_cache_key
+from .snapshot import publisher_for
+from .zones import board_zones
+
+NORMAL = 'normal'
+DEGRADED = 'degraded'
+OVERLOADED = 'overloaded'
+
+# Views polled by the map, which may be degraded or shed under load. Every
+# other view, booking and order acceptance included, always goes through.
+POLL_VIEWS = {'driverlist', 'order_features'}
+
+# Weight of the newest query in the latency average, and seconds after which
+# the average is forgotten when no queries come in to update it.
+LATENCY_SMOOTHING = 0.2
+LATENCY_MAX_AGE = 5.0
+
+
+class LoadMonitor:
+    """Tracks polls in flight and database latency across the threads of a process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.polls_in_flight = 0
+        self.db_latency = 0.0
+        self._latency_updated = 0.0
+
+    def record_query(self, duration: float) -> None:
+        with self._lock:
+            if time.monotonic() - self._latency_updated > LATENCY_MAX_AGE:
+                self.db_latency = duration
+            else:
+                self.db_latency += LATENCY_SMOOTHING * (duration - self.db_latency)
+            self._latency_updated = time.monotonic()
+
+    def latency(self) -> float:
+        if time.monotonic() - self._latency_updated > LATENCY_MAX_AGE:
+            return 0.0
+        return self.db_latency
+
+    def start_poll(self) -> None:
+        with self._lock:
+            self.polls_in_flight += 1
+
+    def end_poll(self) -> None:
+        with self._lock:
+            self.polls_in_flight -= 1
+
+    def level(self) -> str:
+        """The current pressure level: NORMAL, DEGRADED or OVERLOADED."""
+        polls, latency = self.polls_in_flight, self.latency()
+        if polls >= getattr(settings, 'DAIKOU_SHED_OVERLOADED_POLLS', 50) \
+                or latency >= getattr(settings, 'DAIKOU_SHED_OVERLOADED_DB_LATENCY', 1.0):
+            return OVERLOADED
+        if polls >= getattr(settings, 'DAIKOU_SHED_DEGRADED_POLLS', 20) \
+                or latency >= getattr(settings, 'DAIKOU_SHED_DEGRADED_DB_LATENCY', 0.2):
+            return DEGRADED
+        return NORMAL
+
+
+monitor = LoadMonitor()
+
+
+def poll_interval(level: str) -> int:
+    """Seconds clients should wait before polling again at the given level."""
+    interval = getattr(settings, 'DAIKOU_FEED_POLL_INTERVAL', 5)
+    if level != NORMAL:
+        interval *= getattr(settings, 'DAIKOU_SHED_POLL_BACKOFF', 4)
+    return interval
+
+
+def has_stale_data(request: HttpRequest, url_name: str) -> bool:
+    """Whether a polling view can answer from memory without touching the database."""
+    if url_name == 'driverlist':
+        return publisher_for(request.GET.get('zone', '')).latest() is not None
+    if url_name == 'order_features':
+        # The board is only ever served from the cache; without it, it would be rebuilt.
+        driver = getattr(request.user, 'driver', None) if request.user.is_authenticated else None
+        if driver is None:
+            return False
+        keys = [order_features_cache_key(zone) for zone in board_zones(driver.latitude, driver.longitude)]
+        return len(cache.get_many(keys)) == len(keys)
+    return False
+
+
+class BackpressureMiddleware:
+    """
+    Sets `request.load_level` on polling requests and sheds them as a last resort.
+
+    Polling views read `request.load_level` and fall back to stale cached data
+    when it is not NORMAL. Responses to polls carry an `X-Poll-Interval` header
+    with the number of seconds clients should wait before the next one.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def _time_query(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            monitor.record_query(time.monotonic() - start)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            url_name = None
+
+        with connection.execute_wrapper(self._time_query):
+            if url_name not in POLL_VIEWS:
+                return self.get_response(request)
+
+            level = monitor.level()
+            if level == OVERLOADED and not has_stale_data(request, url_name):
+                response = HttpResponse('The service is busy, please try again shortly.', status=503)
+                response['Retry-After'] = str(getattr(settings, 'DAIKOU_SHED_RETRY_AFTER', 10))
+                return response
+
+            request.load_level = level
+            monitor.start_poll()
+            try:
+                response = self.get_response(request)
+            finally:
+                monitor.end_poll()
+        response['X-Poll-Interval'] = str(poll_interval(level))
+        return response
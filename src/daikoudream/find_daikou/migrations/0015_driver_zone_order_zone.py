@@ -0,0 +1,61 @@
+# Generated by Django 4.0.6 on 2026-10-19 11:59
+
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def zone_for(latitude, longitude):
+    # find_daikou.zones.zone_for as of this migration, so that later changes
+    # to the zones code do not change what it does.
+    latitude, longitude = float(latitude), float(longitude)
+    for name, (min_lon, min_lat, max_lon, max_lat) in getattr(settings, 'DAIKOU_ZONES', {}).items():
+        if min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat:
+            return name
+    size = getattr(settings, 'DAIKOU_ZONE_GRID_SIZE', 1.0)
+    return f'grid:{math.floor(latitude / size)}:{math.floor(longitude / size)}'
+
+
+def assign_zones(apps, schema_editor):
+    # Row by row in chunks, so that the order history is never held in memory at once.
+    for model, latitude, longitude in (('Driver', 'latitude', 'longitude'),
+                                       ('Order', 'pickup_latitude', 'pickup_longitude')):
+        manager = apps.get_model('find_daikou', model).objects
+        batch = []
+        for row in manager.only('id', latitude, longitude).iterator(chunk_size=2000):
+            row.zone = zone_for(getattr(row, latitude), getattr(row, longitude))
+            batch.append(row)
+            if len(batch) == 2000:
+                manager.bulk_update(batch, ['zone'], batch_size=500)
+                batch = []
+        manager.bulk_update(batch, ['zone'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0014_customer_address_customer_phone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='zone',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='zone',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='driver',
+            index=models.Index(fields=['zone', 'is_available'], name='find_daikou_zone_6e2e2f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['zone', 'completed', 'driver'], name='find_daikou_zone_8260fa_idx'),
+        ),
+        migrations.RunPython(assign_zones, migrations.RunPython.noop),
+    ]
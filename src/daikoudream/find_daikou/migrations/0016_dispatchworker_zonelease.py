@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0015_driver_zone_order_zone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchWorker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('started_at', models.DateTimeField()),
+                ('heartbeat_at', models.DateTimeField()),
+                ('orders_dispatched', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ZoneLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone', models.CharField(max_length=64, unique=True)),
+                ('owner', models.CharField(max_length=128)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0017_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemandCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.DateTimeField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('pending', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('window', 'x', 'y'), name='unique_demand_cell')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SupplyCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('available', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('x', 'y'), name='unique_supply_cell')],
+            },
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:29
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def date_existing_orders(apps, schema_editor):
+    # When existing orders were placed is not known; their pickup time comes closest.
+    Order = apps.get_model('find_daikou', 'Order')
+    Order.objects.update(created_at=models.F('pickup_time'), updated_at=models.F('pickup_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0018_demandcell_supplycell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('processed_until', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='assigned_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='cancelled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(date_existing_orders, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=8)),
+                ('start', models.DateTimeField()),
+                ('dimension', models.CharField(choices=[('all', 'All orders'), ('zone', 'Zone'), ('driver', 'Driver'), ('customer', 'Customer')], max_length=16)),
+                ('key', models.CharField(blank=True, default='', max_length=64)),
+                ('created', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('cancelled', models.PositiveIntegerField(default=0)),
+                ('assigned', models.PositiveIntegerField(default=0)),
+                ('assign_seconds', models.FloatField(default=0)),
+                ('eta_count', models.PositiveIntegerField(default=0)),
+                ('eta_error_seconds', models.FloatField(default=0)),
+                ('eta_late', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dimension', 'key', 'period', 'start'], name='find_daikou_dimensi_135013_idx')],
+                'constraints': [models.UniqueConstraint(fields=('period', 'start', 'dimension', 'key'), name='unique_order_rollup')],
+            },
+        ),
+    ]
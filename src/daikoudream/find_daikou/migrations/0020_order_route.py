@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0019_order_timestamps_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='route',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0020_order_route'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='find_daikou_zone_8260fa_idx',
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='released',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['zone', 'released', 'completed', 'driver'], name='find_daikou_zone_3d95a4_idx'),
+        ),
+    ]
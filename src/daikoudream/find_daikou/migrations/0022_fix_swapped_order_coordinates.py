@@ -0,0 +1,55 @@
+# Generated by Django 4.0.6 on 2026-10-19 14:10
+
+import math
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import F, Q
+
+
+def zone_for(latitude, longitude):
+    # find_daikou.zones.zone_for as of this migration.
+    latitude, longitude = float(latitude), float(longitude)
+    for name, (min_lon, min_lat, max_lon, max_lat) in getattr(settings, 'DAIKOU_ZONES', {}).items():
+        if min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat:
+            return name
+    size = getattr(settings, 'DAIKOU_ZONE_GRID_SIZE', 1.0)
+    return f'grid:{math.floor(latitude / size)}:{math.floor(longitude / size)}'
+
+
+def swap_coordinates(apps, schema_editor):
+    # Orders booked on the map were stored with longitude and latitude swapped.
+    # Only the rows whose "latitude" is out of range are certainly swapped;
+    # those are put right and moved to the zone of their real pickup point.
+    # The heatmap counts of the open ones are off until `manage.py rebuild_heatmap`.
+    Order = apps.get_model('find_daikou', 'Order')
+    swapped = Order.objects.filter(
+        Q(pickup_latitude__gt=90) | Q(pickup_latitude__lt=-90)
+        | Q(dropoff_latitude__gt=90) | Q(dropoff_latitude__lt=-90)
+    )
+    # In chunks of ids, so that the affected rows are never held in memory at once.
+    last_id = 0
+    while True:
+        ids = list(swapped.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:2000])
+        if not ids:
+            break
+        last_id = ids[-1]
+        Order.objects.filter(id__in=ids).update(
+            pickup_latitude=F('pickup_longitude'), pickup_longitude=F('pickup_latitude'),
+            dropoff_latitude=F('dropoff_longitude'), dropoff_longitude=F('dropoff_latitude'),
+        )
+        orders = list(Order.objects.filter(id__in=ids).only('id', 'pickup_latitude', 'pickup_longitude'))
+        for order in orders:
+            order.zone = zone_for(order.pickup_latitude, order.pickup_longitude)
+        Order.objects.bulk_update(orders, ['zone'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find_daikou', '0021_order_released'),
+    ]
+
+    operations = [
+        migrations.RunPython(swap_coordinates, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,99 @@
-from django.db import models
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models
 from django.contrib.auth.models import AbstractUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.db.models import Exists, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .zones import zone_for
+
+class CarInfo(NamedTuple):
+    """ What the booking pages need to know about a car. """
+    id: int
+    make: str
+    model: str
+    year: int
+
+def customer_cars_cache_key(customer_id) -> str:
+    return f'customer-cars:{customer_id}'
+
+def customer_cars(customer_id) -> List[CarInfo]:
+    """
+    The cars of a customer, from the cache.
+
+    Kept until one of the customer's cars is saved or deleted (see find_daikou.signals),
+    or for DAIKOU_CAR_CACHE_TIMEOUT seconds.
+    """
+    key = customer_cars_cache_key(customer_id)
+    cars = cache.get(key)
+    if cars is None:
+        cars = [CarInfo(*row) for row in
+                Car.objects.filter(customer_id=customer_id).order_by('id').values_list('id', 'make', 'model', 'year')]
+        cache.set(key, cars, getattr(settings, 'DAIKOU_CAR_CACHE_TIMEOUT', 3600))
+    return cars
+
+def invalidate_customer_cars(customer_id) -> None:
+    cache.delete(customer_cars_cache_key(customer_id))
+
+ORDER_FEATURES_CACHE_KEY = 'order-features'
+
+def order_features_cache_key(zone: str) -> str:
+    """ Cache key of the encoded order board of a zone, or of every zone for ''. """
+    return f'{ORDER_FEATURES_CACHE_KEY}:{zone}'
+
+def customer_owns_car(customer_id, car_id) -> bool:
+    """ Whether a car belongs to a customer, by their ids. """
+    try:
+        car_id = int(car_id)
+    except (TypeError, ValueError):
+        return False
+    if any(car.id == car_id for car in customer_cars(customer_id)):
+        return True
+    # Confirm a refusal against the database, in case the cached list missed a new car.
+    invalidate_customer_cars(customer_id)
+    return any(car.id == car_id for car in customer_cars(customer_id))
+
+class ZoneQuerySet(models.QuerySet):
+    """ A query set of rows assigned to geographic zones. """
+
+    def in_zone(self, zone):
+        """ Rows in the given zone, or all rows for an empty zone. """
+        return self.filter(zone=zone) if zone else self
+
+    def in_zones(self, zones):
+        """ Rows in any of the given zones, or all rows if one of them is empty. """
+        return self if '' in zones else self.filter(zone__in=zones)
+
+class OrderQuerySet(ZoneQuerySet):
+    """ A query set of orders. """
+
+    def open(self):
+        """ Orders waiting for a driver: released to the board, unassigned and incomplete. """
+        return self.filter(released=True, driver=None, completed=False)
+
+def pickup_lead_time() -> timedelta:
+    """ How long before their pickup time scheduled orders are released to the board. """
+    return timedelta(seconds=getattr(settings, 'DAIKOU_PICKUP_LEAD_TIME', 1800))
+
+def send_saved(instance: models.Model, update_fields) -> None:
+    """
+    Let the post_save receivers know about columns written with `QuerySet.update`,
+    so the derived data they keep (see find_daikou.signals) follows as after a `save`.
+    """
+    models.signals.post_save.send(sender=type(instance), instance=instance, created=False,
+                                  update_fields=frozenset(update_fields), raw=False,
+                                  using=instance._state.db or DEFAULT_DB_ALIAS)
+
+def release_time(pickup_time: datetime) -> datetime:
+    """ When an order with the given pickup time goes on the board. """
+    if timezone.is_naive(pickup_time):
+        pickup_time = timezone.make_aware(pickup_time)
+    return pickup_time - pickup_lead_time()
 
 class CustomUser(AbstractUser):
     """ A custom user model to extend the default Django user model. """
@@ -48,9 +141,38 @@ class Driver(models.Model):
     longitude = models.FloatField(
         default = 0.0
     )
+    zone = models.CharField(max_length=64, blank=True, default='')
+
+    objects = ZoneQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['zone', 'is_available']),
+        ]
+
     def __str__(self):
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        self.zone = zone_for(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'zone'}
+        super().save(*args, **kwargs)
+
+    def set_available(self, available: bool) -> bool:
+        """
+        Write only the availability of the driver, and only if it changes.
+
+        Returns:
+            Whether the row was changed.
+        """
+        if not Driver.objects.filter(id=self.id, is_available=not available).update(is_available=available):
+            return False
+        self.is_available = available
+        send_saved(self, ['is_available'])
+        return True
+
 class Order(models.Model):
     """ A model to represent an order. """
 
@@ -77,33 +199,259 @@ class Order(models.Model):
     pickup_time = models.DateTimeField()
     completed = models.BooleanField(default=False)
     eta = models.DateTimeField(null=True, blank=True)
+    # The zone of the pickup point
+    zone = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Picks the orders to roll up again (see find_daikou.rollups)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # When a driver was first assigned, kept if they are unassigned
+    assigned_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    completed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Set along with completed_at when the customer cancelled the order
+    cancelled_at = models.DateTimeField(null=True, blank=True)
+    # The positions of the driver while on the order, as an encoded polyline (see find_daikou.routes)
+    route = models.TextField(blank=True, default='')
+    # Whether the order is on the board; scheduled orders are held back until
+    # shortly before their pickup time (see find_daikou.scheduler)
+    released = models.BooleanField(default=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['zone', 'released', 'completed', 'driver']),
+        ]
 
     def save(self, *args, **kwargs):
+        self.zone = zone_for(self.pickup_latitude, self.pickup_longitude)
+        now = timezone.now()
+        if self._state.adding:
+            self.released = release_time(self.pickup_time) <= now
+        if self.driver_id is not None and self.assigned_at is None:
+            self.assigned_at = now
+        if self.completed and self.completed_at is None:
+            self.completed_at = now
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'zone', 'updated_at', 'assigned_at', 'completed_at'}
         if not self.completed:
             # check if there are any existing incomplete orders associated with the customer
-            existing_orders = Order.objects.filter(customer=self.customer, completed=False).exclude(id=self.id)
-            if self.driver != None:
-               existing_orders_driver = Order.objects.filter(driver=self.driver, completed=False).exclude(id=self.id)
+            if self.driver_id is not None:
+               existing_orders_driver = Order.objects.filter(driver_id=self.driver_id, completed=False).exclude(id=self.id)
                if existing_orders_driver.exists():
                    raise ValidationError('A driver can only have one incomplete order at a time.')
-            existing_orders_user = Order.objects.filter(customer=self.customer, completed=False).exclude(id=self.id)
+            existing_orders_user = Order.objects.filter(customer_id=self.customer_id, completed=False).exclude(id=self.id)
             # check if the car belongs to the user associated with the order
-            if self.car not in self.customer.cars.all():
+            if not customer_owns_car(self.customer_id, self.car_id):
                 raise ValidationError('The selected car does not belong to the customer.')
             if existing_orders_user.exists():
                 raise ValidationError('A customer can only have one incomplete order at a time.')
         super().save(*args, **kwargs)
 
-    def complete_order(self):
-        self.completed = True
-        self.save()
+    def _write(self, guard: Q, **values) -> bool:
+        """
+        Write some columns of the order if its row still matches `guard`.
+
+        Unlike `save`, the other columns are left alone and the checks they
+        need are skipped: the guard is what makes the write valid.
+
+        Returns:
+            Whether the row was changed; the instance is only updated if it was,
+            but for the values computed by the database.
+        """
+        values['updated_at'] = timezone.now()
+        if not Order.objects.filter(guard, id=self.id).update(**values):
+            return False
+        for field, value in values.items():
+            if not hasattr(value, 'resolve_expression'):
+                setattr(self, field, value)
+        send_saved(self, values)
         return True
 
-    def assign_driver(self, driver):
-        self.driver = driver
-        self.save()
+    def complete_order(self) -> bool:
+        now = timezone.now()
+        return self._write(Q(completed=False), completed=True, completed_at=now)
+
+    def cancel(self) -> bool:
+        now = timezone.now()
+        return self._write(Q(completed=False), completed=True, completed_at=now, cancelled_at=now)
+
+    def assign_driver(self, driver: Driver, eta: Optional[datetime] = None) -> bool:
+        """
+        Give the order to a driver, if it is still on the board and the driver is free.
+
+        Args:
+            driver: The driver taking the order.
+            eta: When the driver expects to be at the pickup.
+
+        Returns:
+            Whether the order was assigned; False if it was taken, completed or
+            is not on the board yet.
+
+        Raises:
+            ValidationError: If the driver already has an incomplete order.
+        """
+        busy = Order.objects.filter(driver_id=driver.id, completed=False).exclude(id=self.id)
+        now = timezone.now()
+        # Kept if the order was assigned before, like in `save`
+        assigned_at = self.assigned_at or now
+        if self._write(Q(completed=False, driver__isnull=True, released=True) & ~Exists(busy),
+                       driver=driver, eta=eta, assigned_at=Coalesce('assigned_at', now)):
+            self.assigned_at = assigned_at
+            return True
+        if busy.exists():
+            raise ValidationError('A driver can only have one incomplete order at a time.')
+        return False
 
-    def unassign_driver(self):
-        self.driver = None
-        self.eta = None
-        self.save()
+    def unassign_driver(self) -> bool:
+        """Put the order back on the board, unless it was completed or given to another driver."""
+        if self.driver_id is None:
+            return False
+        return self._write(Q(completed=False, driver_id=self.driver_id), driver=None, eta=None, route='')
+
+    def set_eta(self, eta: datetime) -> bool:
+        """Write a new ETA, if the order is still with the same driver."""
+        if self.driver_id is None:
+            return False
+        return self._write(Q(completed=False, driver_id=self.driver_id), eta=eta)
+
+class DispatchWorker(models.Model):
+    """ A process of the dispatch worker pool (see find_daikou.dispatch). """
+
+    name = models.CharField(max_length=128, unique=True)
+    started_at = models.DateTimeField()
+    heartbeat_at = models.DateTimeField()
+    orders_dispatched = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+class ZoneLease(models.Model):
+    """ A renewable claim of one dispatch worker on a zone. """
+
+    zone = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=128)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.zone} ({self.owner})"
+
+class DemandCell(models.Model):
+    """ The open orders picking up in a heatmap cell during a window of time (see find_daikou.heatmap). """
+
+    window = models.DateTimeField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    pending = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['window', 'x', 'y'], name='unique_demand_cell'),
+        ]
+
+    def __str__(self):
+        return f"{self.window:%Y-%m-%d %H:%M} ({self.x}, {self.y}): {self.pending}"
+
+class SupplyCell(models.Model):
+    """ The available drivers in a heatmap cell (see find_daikou.heatmap). """
+
+    x = models.IntegerField()
+    y = models.IntegerField()
+    available = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['x', 'y'], name='unique_supply_cell'),
+        ]
+
+    def __str__(self):
+        return f"({self.x}, {self.y}): {self.available}"
+
+class OrderRollup(models.Model):
+    """ Order statistics of an hour or a day, overall or for one zone, driver or customer (see find_daikou.rollups). """
+
+    HOUR = 'hour'
+    DAY = 'day'
+    PERIOD_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    ALL = 'all'
+    ZONE = 'zone'
+    DRIVER = 'driver'
+    CUSTOMER = 'customer'
+    DIMENSION_CHOICES = [(ALL, 'All orders'), (ZONE, 'Zone'), (DRIVER, 'Driver'), (CUSTOMER, 'Customer')]
+
+    period = models.CharField(max_length=8, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()
+    dimension = models.CharField(max_length=16, choices=DIMENSION_CHOICES)
+    # The zone, or the id of the driver or customer; empty for all orders
+    key = models.CharField(max_length=64, blank=True, default='')
+    created = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    cancelled = models.PositiveIntegerField(default=0)
+    # Orders first assigned in the period, and the seconds they waited for it in total
+    assigned = models.PositiveIntegerField(default=0)
+    assign_seconds = models.FloatField(default=0)
+    # Of the orders assigned in the period, those with an ETA, how far it was from
+    # the pickup time in total, and how many would be late
+    eta_count = models.PositiveIntegerField(default=0)
+    eta_error_seconds = models.FloatField(default=0)
+    eta_late = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'start', 'dimension', 'key'], name='unique_order_rollup'),
+        ]
+        indexes = [
+            models.Index(fields=['dimension', 'key', 'period', 'start']),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.start:%Y-%m-%d %H:%M} {self.dimension} {self.key}".rstrip()
+
+class RollupWatermark(models.Model):
+    """ How far the rollups have processed changed orders. """
+
+    name = models.CharField(max_length=64, unique=True)
+    processed_until = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name}: {self.processed_until}"
+
+class Job(models.Model):
+    """ A unit of background work, run by the job workers (see find_daikou.jobs). """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    # Higher runs first
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    idempotency_key = models.CharField(max_length=200, null=True, blank=True, unique=True)
+    # Queued jobs of the same name and batch key may be run together
+    batch_key = models.CharField(max_length=200, blank=True, default='')
+    locked_by = models.CharField(max_length=128, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
@@ -0,0 +1,87 @@
+"""
+How many free drivers are near a point, for customers choosing where to be
+picked up.
+
+Answered on every click on the booking map, so never from the database: the
+free drivers (available and without an order) of the fleet state (see
+find_daikou.fleet) are bucketed into a grid of
+`DAIKOU_NEARBY_CELL_SIZE` degree cells, rebuilt at most once per
+`DAIKOU_SNAPSHOT_INTERVAL` seconds and shared like the fleet snapshots (see
+find_daikou.snapshot). A query only reads the cells around the point, and
+counts the drivers within each of `DAIKOU_NEARBY_RADII_KM`.
+"""
+import math
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from . import fleet
+from .distances import EARTH_RADIUS_KM, haversine_km_many
+from .snapshot import SnapshotPublisher
+
+# (x, y) of a grid cell
+Cell = Tuple[int, int]
+
+
+class NearbyIndex(NamedTuple):
+    built_at: float
+    cell_size: float
+    # (latitude, longitude) of the free drivers in each cell
+    cells: Dict[Cell, List[Tuple[float, float]]]
+
+
+class Nearby(NamedTuple):
+    # (radius in km, free drivers within it), by increasing radius
+    counts: List[Tuple[float, int]]
+    # Minutes the nearest of those drivers needs to get to the point
+    eta_minutes: Optional[float]
+
+
+def radii() -> List[float]:
+    return sorted(getattr(settings, 'DAIKOU_NEARBY_RADII_KM', (1, 3, 5)))
+
+
+def cell_for(latitude: float, longitude: float, cell_size: float) -> Cell:
+    return math.floor(longitude / cell_size), math.floor(latitude / cell_size)
+
+
+def build_index() -> NearbyIndex:
+    """Bucket the free drivers of the fleet state into grid cells."""
+    cell_size = getattr(settings, 'DAIKOU_NEARBY_CELL_SIZE', 0.02)
+    drivers = fleet.current().rows(free=True)
+    cells: Dict[Cell, List[Tuple[float, float]]] = defaultdict(list)
+    for latitude, longitude in zip(drivers.latitudes.tolist(), drivers.longitudes.tolist()):
+        cells[cell_for(latitude, longitude, cell_size)].append((latitude, longitude))
+    return NearbyIndex(built_at=time.time(), cell_size=cell_size, cells=dict(cells))
+
+
+publisher = SnapshotPublisher('nearby', build_index)
+
+
+def nearby(latitude: float, longitude: float, index: Optional[NearbyIndex] = None) -> Nearby:
+    """Count the free drivers around a point, from the latest index unless one is given."""
+    index = index or publisher.get()
+    radius = radii()[-1]
+    # The cells of the bounding box of the largest circle
+    lat_span = math.degrees(radius / EARTH_RADIUS_KM)
+    lon_span = lat_span / max(math.cos(math.radians(latitude)), 0.01)
+    min_x, min_y = cell_for(latitude - lat_span, longitude - lon_span, index.cell_size)
+    max_x, max_y = cell_for(latitude + lat_span, longitude + lon_span, index.cell_size)
+    found = [
+        point
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+        for point in index.cells.get((x, y), ())
+    ]
+    if not found:
+        return Nearby([(r, 0) for r in radii()], None)
+
+    points = np.array(found)
+    km = haversine_km_many(latitude, longitude, points[:, 0], points[:, 1])
+    counts = [(r, int(np.count_nonzero(km <= r))) for r in radii()]
+    nearest = float(km.min())
+    eta = nearest / getattr(settings, 'DAIKOU_DISPATCH_SPEED_KMH', 30) * 60 if nearest <= radius else None
+    return Nearby(counts, eta)
@@ -0,0 +1,172 @@
+"""
+Write-behind buffer for driver positions.
+
+Drivers report their position every few seconds. Rather than updating the
+`Driver` row each time, `PositionBuffer.update` keeps the latest position in
+memory, where the driver feed, its snapshots and the fleet state read it
+from right away. The buffer is written to the database in one batched UPDATE every
+`DAIKOU_POSITION_FLUSH_INTERVAL` seconds, as soon as it holds
+`DAIKOU_POSITION_FLUSH_SIZE` drivers, and when the process exits, so all but
+the last of the positions a driver reports in between never reach the
+database.
+
+Each flush also moves available drivers between heatmap cells and appends
+the written positions to the routes of the drivers' orders.
+
+The buffer belongs to one process. Other processes see a position once it is
+flushed, at most `DAIKOU_POSITION_FLUSH_INTERVAL` seconds later.
+"""
+import atexit
+import logging
+import math
+import threading
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import auth, feed, fleet, heatmap, routes
+from .models import Driver
+from .zones import zone_for
+
+logger = logging.getLogger(__name__)
+
+# driver id -> (latitude, longitude)
+Positions = Dict[int, Tuple[float, float]]
+
+
+def is_valid(latitude: float, longitude: float) -> bool:
+    """Whether a reported position is a point on Earth; NaN and infinities are not."""
+    return (math.isfinite(latitude) and math.isfinite(longitude)
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180)
+
+
+class PositionBuffer:
+    """Latest unflushed position of each driver that reported one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._positions: Positions = {}
+        # Position each buffered driver had in the database, and its user
+        self._origins: Positions = {}
+        self._users: Dict[int, int] = {}
+        self._flusher: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def update(self, driver: Driver, latitude: float, longitude: float) -> None:
+        """
+        Record a new position for a driver.
+
+        Raises:
+            ValueError: If the position is not a valid one (see `is_valid`); nothing is recorded.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        if not is_valid(latitude, longitude):
+            raise ValueError(f'Invalid position ({latitude}, {longitude}).')
+        zone = zone_for(latitude, longitude)
+        with self._lock:
+            previous = self._positions.get(driver.id, (float(driver.latitude), float(driver.longitude)))
+            self._origins.setdefault(driver.id, previous)
+            self._positions[driver.id] = (latitude, longitude)
+            self._users[driver.id] = driver.user_id
+            size = len(self._positions)
+        self._start_flusher()
+        fleet.state.move(driver.id, latitude, longitude, zone)
+        if driver.is_available:
+            feed.record_change(driver.id)
+        if size >= getattr(settings, 'DAIKOU_POSITION_FLUSH_SIZE', 500):
+            self.flush()
+
+    def get(self, driver_id: int, default: Optional[Tuple[float, float]] = None) -> Optional[Tuple[float, float]]:
+        """The buffered (latitude, longitude) of a driver, or `default` if there is none."""
+        return self._positions.get(driver_id, default)
+
+    def pending(self) -> Positions:
+        """A copy of all buffered positions."""
+        with self._lock:
+            return dict(self._positions)
+
+    def discard(self, driver_id: int) -> None:
+        """Forget the buffered position of a driver whose row was written directly."""
+        with self._lock:
+            self._positions.pop(driver_id, None)
+            self._origins.pop(driver_id, None)
+            self._users.pop(driver_id, None)
+
+    def flush(self) -> int:
+        """
+        Write all buffered positions to the database.
+
+        Returns:
+            The number of drivers written.
+        """
+        with self._lock:
+            positions, self._positions = self._positions, {}
+            origins, self._origins = self._origins, {}
+            users, self._users = self._users, {}
+        # A bad row would fail the whole batch, and every flush after it.
+        for pk, (lat, lon) in list(positions.items()):
+            if not is_valid(lat, lon):
+                logger.warning('Dropping invalid position (%s, %s) of driver %s.', lat, lon, pk)
+                del positions[pk]
+                origins.pop(pk, None)
+                users.pop(pk, None)
+        if not positions:
+            return 0
+        try:
+            with transaction.atomic():
+                Driver.objects.bulk_update(
+                    [Driver(id=pk, latitude=lat, longitude=lon, zone=zone_for(lat, lon))
+                     for pk, (lat, lon) in positions.items()],
+                    ['latitude', 'longitude', 'zone'],
+                    batch_size=500,
+                )
+                # Available drivers move from the heatmap cell of their old position to the new one.
+                available = Driver.objects.filter(id__in=list(positions), is_available=True).values_list('id', flat=True)
+                heatmap.adjust_supply(heatmap.moves(
+                    (heatmap.cell_for(*origins[pk]), heatmap.cell_for(*positions[pk])) for pk in available
+                ))
+                routes.record_positions(positions)
+        except Exception:
+            # Put the positions back, unless the drivers reported newer ones meanwhile.
+            with self._lock:
+                for pk, position in positions.items():
+                    self._positions.setdefault(pk, position)
+                    self._origins.setdefault(pk, origins[pk])
+                    self._users.setdefault(pk, users[pk])
+            raise
+        # Readers in other processes only see the positions now, so tell
+        # their clients, and drop cached users built from the old positions.
+        for pk in positions:
+            feed.record_change(pk)
+        for user_id in users.values():
+            auth.invalidate_user(user_id)
+        return len(positions)
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None or not getattr(settings, 'DAIKOU_POSITION_FLUSH_INTERVAL', 5):
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run, name='position-flusher', daemon=True)
+        self._flusher.start()
+
+    def _run(self) -> None:
+        interval = getattr(settings, 'DAIKOU_POSITION_FLUSH_INTERVAL', 5)
+        while not self._stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing driver positions failed.')
+            finally:
+                connection.close()
+
+    def stop(self) -> None:
+        """Stop the background flusher and write what is left."""
+        self._stopped.set()
+        self.flush()
+
+
+buffer = PositionBuffer()
+atexit.register(buffer.stop)
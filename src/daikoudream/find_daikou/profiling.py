@@ -0,0 +1,217 @@
+"""
+Opt-in profiling of single requests.
+
+`ProfilerMiddleware` profiles a request when a staff user asks for it, with an
+`X-Daikou-Profile` header or a `profile` query parameter, and otherwise one in
+every `DAIKOU_PROFILE_SAMPLE_RATE` requests. The view, template rendering
+included, then runs under one of two profilers:
+
+- 'sampling' (the default) records the stack of the request thread every
+  `DAIKOU_PROFILE_SAMPLE_INTERVAL` seconds, as folded stacks that flame graph
+  tools (flamegraph.pl, speedscope) read directly. Cheap enough to leave on
+  for a sample of live traffic.
+- 'cprofile' traces every call with cProfile and saves pstats data, exact but
+  several times slower.
+
+Each profile is saved to `DAIKOU_PROFILE_DIR` as a JSON summary, with the SQL
+the request issued, next to the profiler output. Only the newest
+`DAIKOU_PROFILE_KEEP` profiles are kept. Staff can list and download them from
+the admin (see `views.profile_list`).
+"""
+import cProfile
+import json
+import marshal
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.utils import timezone
+
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+MODES = (SAMPLING, CPROFILE)
+
+HEADER = 'X-Daikou-Profile'
+
+# Names of the files a profile is saved as, which are the only ones served back.
+FILE_NAME = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}\.(json|folded|prof)$')
+
+
+def profile_dir() -> Path:
+    return Path(getattr(settings, 'DAIKOU_PROFILE_DIR', settings.BASE_DIR / 'profiles'))
+
+
+class Sampler:
+    """Samples the call stack of one thread from a background thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def __enter__(self) -> 'Sampler':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """The samples in the folded stack format: one `frame;frame;frame count` line per stack."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class QueryRecorder:
+    """Records the SQL issued on the default connection, without its parameters."""
+
+    def __init__(self):
+        self.queries: List[Dict] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'many': many, 'duration_ms': (time.monotonic() - start) * 1000})
+
+
+def requested_mode(request: HttpRequest) -> Optional[str]:
+    """
+    Return the profiler to run a request under, or None to not profile it.
+
+    Args:
+        request: The request, with `request.user` set.
+    """
+    asked = request.headers.get(HEADER) or request.GET.get('profile')
+    if asked and request.user.is_staff:
+        return asked if asked in MODES else getattr(settings, 'DAIKOU_PROFILER', SAMPLING)
+    rate = getattr(settings, 'DAIKOU_PROFILE_SAMPLE_RATE', 0)
+    if rate and random.randrange(rate) == 0:
+        return getattr(settings, 'DAIKOU_PROFILER', SAMPLING)
+    return None
+
+
+def save_profile(summary: Dict, files: Dict[str, bytes]) -> str:
+    """
+    Write a profile to `DAIKOU_PROFILE_DIR` and drop the oldest ones above `DAIKOU_PROFILE_KEEP`.
+
+    Args:
+        summary: The JSON summary of the profile.
+        files: Profiler output, by file extension.
+
+    Returns:
+        The name the profile is saved under, without extension.
+    """
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{timezone.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    summary = dict(summary, name=name, files=sorted(f'{name}.{ext}' for ext in ['json', *files]))
+    for ext, data in files.items():
+        (directory / f'{name}.{ext}').write_bytes(data)
+    # The summary goes last, so listed profiles are always complete.
+    (directory / f'{name}.json').write_text(json.dumps(summary))
+
+    keep = getattr(settings, 'DAIKOU_PROFILE_KEEP', 100)
+    for old in sorted(directory.glob('*.json'))[:-keep]:
+        for path in directory.glob(f'{old.stem}.*'):
+            path.unlink()
+    return name
+
+
+def list_profiles() -> List[Dict]:
+    """The summaries of the saved profiles, newest first."""
+    directory = profile_dir()
+    if not directory.is_dir():
+        return []
+    return [json.loads(path.read_text()) for path in sorted(directory.glob('*.json'), reverse=True)]
+
+
+def profile_file(name: str) -> Optional[Path]:
+    """The path of a saved profile file, or None if there is no such file."""
+    path = profile_dir() / name
+    if FILE_NAME.match(name) and path.is_file():
+        return path
+    return None
+
+
+def run_profiled(get_response, request: HttpRequest, mode: str) -> Tuple[HttpResponse, Dict[str, bytes], Dict]:
+    """Run a request under the given profiler, returning the response, the profiler output and stats."""
+    recorder = QueryRecorder()
+    start = time.monotonic()
+    with connection.execute_wrapper(recorder):
+        if mode == CPROFILE:
+            profiler = cProfile.Profile()
+            response = profiler.runcall(get_response, request)
+            profiler.create_stats()
+            # The same bytes Profile.dump_stats() writes, readable with pstats.Stats.
+            files = {'prof': marshal.dumps(profiler.stats)}
+            stats = {}
+        else:
+            interval = getattr(settings, 'DAIKOU_PROFILE_SAMPLE_INTERVAL', 0.001)
+            with Sampler(threading.get_ident(), interval) as sampler:
+                response = get_response(request)
+            files = {'folded': sampler.folded().encode()}
+            stats = {'samples': sum(sampler.stacks.values())}
+    stats.update(
+        duration_ms=(time.monotonic() - start) * 1000,
+        queries=recorder.queries,
+        query_count=len(recorder.queries),
+        query_ms=sum(q['duration_ms'] for q in recorder.queries),
+    )
+    return response, files, stats
+
+
+class ProfilerMiddleware:
+    """
+    Profiles the requests picked by `requested_mode`.
+
+    Goes after the authentication middleware. Profiled responses carry an
+    `X-Daikou-Profile` header with the name of the saved profile.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        mode = requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+
+        response, files, stats = run_profiled(self.get_response, request, mode)
+        match = request.resolver_match
+        name = save_profile(dict(
+            stats,
+            mode=mode,
+            created=timezone.now().isoformat(),
+            method=request.method,
+            path=request.get_full_path(),
+            view=match.view_name if match else None,
+            status=response.status_code,
+            user=request.user.pk,
+        ), files)
+        response[HEADER] = name
+        return response
@@ -0,0 +1,141 @@
+"""
+Hourly and daily order statistics, so dashboards never scan the order history.
+
+`OrderRollup` rows hold, per hour and per day, overall and per zone, driver
+and customer:
+
+- the orders created, completed and cancelled;
+- the orders first assigned a driver, and how long they waited for it;
+- of those, how far the ETA the driver gave was from the requested pickup
+  time, and how many would be late.
+
+Each event counts in the period it happened in. The timestamps an order
+records them with (`created_at`, `assigned_at`, `completed_at`) are set once
+and never move, so a period only changes when an order with an event in it
+changes. `run` (the `rollup_orders` management command, and the job of the
+same name every `DAIKOU_ROLLUP_INTERVAL` seconds) looks up the orders saved
+since its watermark, and counts again the days their events fall in,
+reading only the orders with events on those days.
+
+Orders changed with queryset updates, which don't set `updated_at`, or
+deleted are not picked up; `run(full=True)` counts everything again.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Order, OrderRollup, RollupWatermark
+
+WATERMARK = 'orders'
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+METRICS = ('created', 'completed', 'cancelled', 'assigned', 'assign_seconds', 'eta_count', 'eta_error_seconds', 'eta_late')
+
+# (period, start, dimension, key)
+RollupKey = Tuple[str, datetime, str, str]
+
+
+def day_of(moment: datetime) -> datetime:
+    """The start of the (UTC) day containing `moment`."""
+    return moment.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def hour_of(moment: datetime) -> datetime:
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def changed_days(since: datetime, until: datetime) -> Set[datetime]:
+    """The days with events of the orders saved in (since, until]."""
+    days = set()
+    changed = Order.objects.filter(updated_at__gt=since, updated_at__lte=until) \
+        .values_list('created_at', 'assigned_at', 'completed_at')
+    for moments in changed.iterator():
+        days.update(day_of(moment) for moment in moments if moment is not None)
+    return days
+
+
+def count_day(day: datetime) -> Dict[RollupKey, Dict[str, float]]:
+    """Count the events of one day, per hour and for the whole day."""
+    end = day + timedelta(days=1)
+    orders = Order.objects.filter(
+        Q(created_at__gte=day, created_at__lt=end)
+        | Q(assigned_at__gte=day, assigned_at__lt=end)
+        | Q(completed_at__gte=day, completed_at__lt=end)
+    ).values_list('zone', 'driver_id', 'customer_id', 'pickup_time', 'eta',
+                  'created_at', 'assigned_at', 'completed_at', 'cancelled_at')
+
+    counts: Dict[RollupKey, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    for zone, driver_id, customer_id, pickup_time, eta, created_at, assigned_at, completed_at, cancelled_at \
+            in orders.iterator():
+        groups = [(OrderRollup.ALL, ''), (OrderRollup.ZONE, zone), (OrderRollup.CUSTOMER, str(customer_id))]
+        if driver_id is not None:
+            groups.append((OrderRollup.DRIVER, str(driver_id)))
+
+        def add(moment: datetime, metrics: Iterable[Tuple[str, float]]) -> None:
+            if not day <= moment < end:
+                return
+            for period, start in ((OrderRollup.DAY, day), (OrderRollup.HOUR, hour_of(moment))):
+                for dimension, key in groups:
+                    counted = counts[period, start, dimension, key]
+                    for metric, value in metrics:
+                        counted[metric] += value
+
+        add(created_at, [('created', 1)])
+        if completed_at is not None:
+            add(completed_at, [('cancelled' if cancelled_at is not None else 'completed', 1)])
+        if assigned_at is not None:
+            metrics = [('assigned', 1), ('assign_seconds', (assigned_at - created_at).total_seconds())]
+            if eta is not None:
+                lateness = (eta - pickup_time).total_seconds()
+                metrics += [('eta_count', 1), ('eta_error_seconds', abs(lateness)), ('eta_late', int(lateness > 0))]
+            add(assigned_at, metrics)
+    return counts
+
+
+def rollup_day(day: datetime) -> int:
+    """
+    Replace the rollups of a day and its hours with fresh counts.
+
+    Returns:
+        The number of rollups written.
+    """
+    counts = count_day(day)
+    with transaction.atomic():
+        OrderRollup.objects.filter(start__gte=day, start__lt=day + timedelta(days=1)).delete()
+        OrderRollup.objects.bulk_create([
+            OrderRollup(period=period, start=start, dimension=dimension, key=key, **metrics)
+            for (period, start, dimension, key), metrics in counts.items()
+        ], batch_size=500)
+    return len(counts)
+
+
+def run(full: bool = False) -> Tuple[int, int]:
+    """
+    Bring the rollups up to date with the orders saved since the last run.
+
+    Orders saved in the last `DAIKOU_ROLLUP_LAG` seconds are left for the next
+    run, as the transactions saving them may not have committed yet.
+
+    Args:
+        full: Count every day again, not only the changed ones.
+
+    Returns:
+        The number of days counted and of rollups written.
+    """
+    until = timezone.now() - timedelta(seconds=getattr(settings, 'DAIKOU_ROLLUP_LAG', 60))
+    with transaction.atomic():
+        # Locked for the whole run, so that runs don't overlap.
+        RollupWatermark.objects.get_or_create(name=WATERMARK, defaults={'processed_until': EPOCH})
+        watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+        if full:
+            OrderRollup.objects.all().delete()
+        days = changed_days(EPOCH if full else watermark.processed_until, until)
+        rollups = sum(rollup_day(day) for day in sorted(days))
+        watermark.processed_until = until
+        watermark.save()
+    return len(days), rollups
@@ -0,0 +1,175 @@
+"""
+The routes driven for orders, stored as encoded polylines.
+
+While a driver has an order, every position the position buffer writes for
+them is appended to `Order.route`. Routes use the polyline encoding of the
+Google Maps APIs: each coordinate is stored as the difference from the
+previous point, rounded to 1e-5 degrees and written as a variable-length
+run of printable characters, about 4 to 6 bytes per point instead of the 16
+of two floats. Appending needs the last point of a route, which is found by
+summing its deltas in one pass, without decoding the points into a list.
+
+Routes are decoded on demand, and simplified (Douglas-Peucker) to the detail
+visible at the zoom level they are shown at before being sent to the map.
+"""
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db.models import Case, F, TextField, Value, When
+
+from .models import Order
+
+# (latitude, longitude)
+Point = Tuple[float, float]
+
+PRECISION = 5
+
+
+def _encode_value(value: int) -> str:
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def encode(points: Iterable[Point], previous: Point = (0.0, 0.0)) -> str:
+    """
+    Encode points as a polyline.
+
+    Args:
+        points: The points to encode.
+        previous: The point the encoded points follow, to append them to an existing polyline.
+    """
+    factor = 10 ** PRECISION
+    last_lat, last_lon = round(previous[0] * factor), round(previous[1] * factor)
+    chunks = []
+    for latitude, longitude in points:
+        lat, lon = round(latitude * factor), round(longitude * factor)
+        chunks.append(_encode_value(lat - last_lat))
+        chunks.append(_encode_value(lon - last_lon))
+        last_lat, last_lon = lat, lon
+    return ''.join(chunks)
+
+
+def decode(encoded: str) -> List[Point]:
+    """Decode a polyline into its points."""
+    factor = 10 ** PRECISION
+    points = []
+    lat, lon = 0, 0
+    deltas = _deltas(encoded)
+    for lat_delta, lon_delta in zip(deltas, deltas):
+        lat += lat_delta
+        lon += lon_delta
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def _deltas(encoded: str) -> Iterator[int]:
+    index, length = 0, len(encoded)
+    while index < length:
+        result, shift = 0, 0
+        while True:
+            byte = ord(encoded[index]) - 63
+            index += 1
+            result |= (byte & 0x1f) << shift
+            shift += 5
+            if byte < 0x20:
+                break
+        yield ~(result >> 1) if result & 1 else result >> 1
+
+
+def last_point(encoded: str) -> Optional[Point]:
+    """The last point of a polyline, or None if it is empty."""
+    factor = 10 ** PRECISION
+    total = [0, 0]
+    count = 0
+    for count, delta in enumerate(_deltas(encoded), 1):
+        total[(count - 1) % 2] += delta
+    return (total[0] / factor, total[1] / factor) if count else None
+
+
+def extend(encoded: str, points: Sequence[Point]) -> str:
+    """Append points to a polyline, skipping the ones that don't move from the point before."""
+    previous = last = last_point(encoded)
+    factor = 10 ** PRECISION
+    added = []
+    for latitude, longitude in points:
+        point = (round(latitude * factor) / factor, round(longitude * factor) / factor)
+        if point != last:
+            added.append(point)
+            last = point
+    if not added:
+        return encoded
+    return encoded + encode(added, previous or (0.0, 0.0))
+
+
+def _distance_to_segment(point: Point, start: Point, end: Point) -> float:
+    (y, x), (y1, x1), (y2, x2) = point, start, end
+    dx, dy = x2 - x1, y2 - y1
+    if dx == dy == 0:
+        return ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)))
+    return ((x - x1 - t * dx) ** 2 + (y - y1 - t * dy) ** 2) ** 0.5
+
+
+def simplify(points: Sequence[Point], tolerance: float) -> List[Point]:
+    """
+    Drop the points of a line that are closer than `tolerance` (in degrees) to the
+    simplified line (Douglas-Peucker). The first and last points are always kept.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            d = _distance_to_segment(points[i], points[first], points[last])
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack += [(first, farthest), (farthest, last)]
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def tolerance_for_zoom(zoom: int) -> float:
+    """The degrees `DAIKOU_ROUTE_TOLERANCE_PIXELS` pixels span at a web mercator zoom level."""
+    return getattr(settings, 'DAIKOU_ROUTE_TOLERANCE_PIXELS', 1) * 360 / (256 * 2 ** zoom)
+
+
+def record_positions(positions: dict) -> int:
+    """
+    Append the new positions of drivers to the routes of their current orders.
+
+    A route is only written while its order is still incomplete, with the same
+    driver and the route read here: one unassigned meanwhile (which clears its
+    route) is left alone.
+
+    Args:
+        positions: (latitude, longitude) by driver id.
+
+    Returns:
+        The number of routes that had new points to append.
+    """
+    orders = Order.objects.filter(driver_id__in=list(positions), completed=False) \
+        .values_list('id', 'driver_id', 'route')
+    changed = []
+    for order_id, driver_id, route in orders:
+        extended = extend(route, [positions[driver_id]])
+        if extended != route:
+            changed.append((order_id, driver_id, route, extended))
+    for start in range(0, len(changed), 500):
+        batch = changed[start:start + 500]
+        Order.objects.filter(id__in=[order_id for order_id, _, _, _ in batch], completed=False).update(route=Case(
+            *(When(id=order_id, driver_id=driver_id, route=route, then=Value(extended))
+              for order_id, driver_id, route, extended in batch),
+            default=F('route'),
+            output_field=TextField(),
+        ))
+    return len(changed)
@@ -0,0 +1,100 @@
+"""
+Release of scheduled orders to the board.
+
+An order booked for later (say a ride home tonight) is saved with
+`released=False`, and stays off the board and out of dispatch until
+`DAIKOU_PICKUP_LEAD_TIME` seconds before its pickup time. Orders due within
+the lead time are released as soon as they are created.
+
+Held orders are released by `release_orders` jobs (see find_daikou.tasks),
+queued with a delay when the order is booked or its pickup time moves, so
+the `run_jobs` workers release them whether or not dispatch workers run.
+
+Dispatch workers also keep a `Scheduler` as a sweep behind the jobs: a heap
+of the held orders keyed by their release time, so every pass only looks at
+its top. The heap is rebuilt from all `released=False` orders every
+`DAIKOU_SCHEDULER_REFRESH_INTERVAL` seconds rather than read incrementally by
+id, since ids are not committed in order: a bulk booking can commit after a
+later id was seen. Releasing is a conditional update, so several workers
+releasing the same order is harmless; it goes through `save` so that the
+board caches are invalidated.
+"""
+import heapq
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, release_time
+
+
+class Scheduler:
+    """The held orders of this process, by release time."""
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self.refreshed_at: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def stale(self, max_age: float) -> bool:
+        """Whether the heap was not rebuilt in the last `max_age` seconds."""
+        return self.refreshed_at is None or timezone.now() - self.refreshed_at >= timedelta(seconds=max_age)
+
+    def refresh(self) -> int:
+        """Rebuild the heap from the held orders, and return how many there are."""
+        held = Order.objects.filter(released=False, completed=False).values_list('id', 'pickup_time')
+        self._heap = [(release_time(pickup_time), order_id) for order_id, pickup_time in held]
+        heapq.heapify(self._heap)
+        self.refreshed_at = timezone.now()
+        return len(self._heap)
+
+    def next_release(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def release_due(self, now: Optional[datetime] = None) -> List[int]:
+        """
+        Release the orders due by `now`.
+
+        The pickup time of an order may have been postponed since it was added;
+        orders that are not due anymore go back on the heap at their new release time.
+
+        Returns:
+            The ids of the orders released.
+        """
+        now = now or timezone.now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[1])
+        if not due:
+            return []
+        released = []
+        pickup_times = dict(Order.objects.filter(id__in=due, released=False, completed=False)
+                            .values_list('id', 'pickup_time'))
+        for order_id, pickup_time in pickup_times.items():
+            at = release_time(pickup_time)
+            if at > now:
+                heapq.heappush(self._heap, (at, order_id))
+            elif release(order_id):
+                released.append(order_id)
+        return released
+
+
+def release(order_id: int) -> bool:
+    """
+    Put a held order on the board.
+
+    Returns:
+        Whether the order was released here; False if it was released, completed
+        or locked elsewhere.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update(skip_locked=True) \
+            .filter(id=order_id, released=False, completed=False).first()
+        if order is None:
+            return False
+        order.released = True
+        order.save(update_fields=['released'])
+    return True
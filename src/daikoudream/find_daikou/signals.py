@@ -0,0 +1,206 @@
+"""
+Model signal receivers keeping derived data (cached tiles, feeds, heatmap
+counters, the fleet state) in step with the database. Connected from `FindDaikouConfig.ready`.
+
+Derived data is only touched once the write is committed; before that, a
+concurrent reader would rebuild it from the old rows and keep them around.
+The heatmap counters are rows themselves, and are written in the same
+transaction instead.
+"""
+from functools import partial
+from typing import List, Optional, Tuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from . import auth, feed, fleet, heatmap, positions, tasks, tiles
+from .models import Car, Customer, CustomUser, Driver, Order, invalidate_customer_cars, order_features_cache_key
+
+
+def _points(instance, *fields: Tuple[str, str]) -> List[Tuple[float, float]]:
+    # Read straight from the instance dict: a deferred field must not trigger
+    # a query just to work out which tiles to invalidate.
+    values = instance.__dict__
+    try:
+        return [(float(values[lon]), float(values[lat])) for lon, lat in fields]
+    except (KeyError, TypeError, ValueError):
+        return []
+
+
+def driver_points(driver: Driver) -> List[Tuple[float, float]]:
+    """The (lon, lat) points a driver occupies on the map."""
+    return _points(driver, ('longitude', 'latitude'))
+
+
+def order_points(order: Order) -> List[Tuple[float, float]]:
+    """The (lon, lat) points an order occupies on the map."""
+    return _points(order, ('pickup_longitude', 'pickup_latitude'), ('dropoff_longitude', 'dropoff_latitude'))
+
+
+def driver_feed_entry(driver: Driver) -> Optional[List[Tuple[float, float]]]:
+    """What the driver feed shows of a driver: its position, or None if it is not listed."""
+    if not driver.__dict__.get('is_available'):
+        return None
+    return driver_points(driver)
+
+
+@receiver(post_init, sender=Driver)
+def remember_driver_points(sender, instance: Driver, **kwargs) -> None:
+    # Keep the position the driver was loaded with, to tell when it is
+    # written directly rather than through the position buffer.
+    instance._loaded_points = driver_points(instance)
+    instance._loaded_feed_entry = driver_feed_entry(instance)
+    instance._loaded_supply = heatmap.supply_key(instance.__dict__)
+
+
+@receiver(post_init, sender=Order)
+def remember_order_points(sender, instance: Order, **kwargs) -> None:
+    instance._loaded_points = order_points(instance)
+    instance._loaded_zone = instance.__dict__.get('zone', '')
+    instance._loaded_demand = heatmap.demand_key(instance.__dict__)
+    instance._loaded_driver_id = instance.__dict__.get('driver_id')
+    instance._loaded_pickup_time = instance.__dict__.get('pickup_time')
+
+
+@receiver([post_save, post_delete], sender=Driver)
+def discard_buffered_position(sender, instance: Driver, **kwargs) -> None:
+    points = driver_points(instance)
+    if points != getattr(instance, '_loaded_points', points):
+        # The position was written directly; an older buffered one must not
+        # overwrite it when the buffer is flushed.
+        positions.buffer.discard(instance.id)
+    instance._loaded_points = points
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_tiles(sender, instance: Order, **kwargs) -> None:
+    points = order_points(instance)
+    transaction.on_commit(partial(tiles.invalidate_points, 'orders', getattr(instance, '_loaded_points', []) + points))
+    instance._loaded_points = points
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_features(sender, instance: Order, **kwargs) -> None:
+    # The board of the zone the order was in, of the one it is in now, and of all zones.
+    keys = {order_features_cache_key(zone) for zone in ('', instance._loaded_zone, instance.zone)}
+    transaction.on_commit(partial(cache.delete_many, list(keys)))
+    instance._loaded_zone = instance.zone
+
+
+@receiver(post_save, sender=Order)
+def count_order_demand(sender, instance: Order, created: bool, **kwargs) -> None:
+    # In the same transaction as the order, so the counters commit along with it.
+    # A new instance was "loaded" with the values it was created with, which
+    # were not counted yet.
+    key = heatmap.demand_key(instance.__dict__)
+    heatmap.adjust_demand(heatmap.moves([(None if created else instance._loaded_demand, key)]))
+    instance._loaded_demand = key
+
+
+@receiver(post_save, sender=Order)
+def schedule_order_release(sender, instance: Order, created: bool, **kwargs) -> None:
+    # A held order is put on the board by a delayed job (see find_daikou.scheduler),
+    # queued when it is booked and again when its pickup time moves.
+    values = instance.__dict__
+    pickup_time = values.get('pickup_time')
+    if values.get('released') is False and not values.get('completed') \
+            and (created or pickup_time != instance._loaded_pickup_time):
+        tasks.enqueue_releases([instance])
+    instance._loaded_pickup_time = pickup_time
+
+
+@receiver(post_delete, sender=Order)
+def uncount_order_demand(sender, instance: Order, **kwargs) -> None:
+    heatmap.adjust_demand(heatmap.moves([(instance._loaded_demand, None)]))
+    instance._loaded_demand = None
+
+
+@receiver(post_save, sender=Driver)
+def count_driver_supply(sender, instance: Driver, created: bool, **kwargs) -> None:
+    key = heatmap.supply_key(instance.__dict__)
+    heatmap.adjust_supply(heatmap.moves([(None if created else instance._loaded_supply, key)]))
+    instance._loaded_supply = key
+
+
+@receiver(post_delete, sender=Driver)
+def uncount_driver_supply(sender, instance: Driver, **kwargs) -> None:
+    heatmap.adjust_supply(heatmap.moves([(instance._loaded_supply, None)]))
+    instance._loaded_supply = None
+
+
+def reassign_fleet_order(order_id: int, previous: Optional[int], current: Optional[int]) -> None:
+    if previous is not None and previous != current:
+        fleet.state.unassign(previous, order_id)
+    if current is not None:
+        fleet.state.assign(current, order_id)
+
+
+@receiver(post_save, sender=Order)
+def track_fleet_order(sender, instance: Order, created: bool, **kwargs) -> None:
+    current = None if instance.completed else instance.driver_id
+    transaction.on_commit(partial(reassign_fleet_order, instance.id,
+                                  None if created else instance._loaded_driver_id, current))
+    instance._loaded_driver_id = current
+
+
+@receiver(post_delete, sender=Order)
+def untrack_fleet_order(sender, instance: Order, **kwargs) -> None:
+    transaction.on_commit(partial(reassign_fleet_order, instance.id, instance._loaded_driver_id, None))
+
+
+@receiver(post_save, sender=Driver)
+def refresh_fleet_driver(sender, instance: Driver, **kwargs) -> None:
+    transaction.on_commit(partial(fleet.state.refresh, [instance.id]))
+
+
+@receiver(post_delete, sender=Driver)
+def remove_fleet_driver(sender, instance: Driver, **kwargs) -> None:
+    transaction.on_commit(partial(fleet.state.remove, instance.id))
+
+
+@receiver(post_init, sender=Car)
+def remember_car_owner(sender, instance: Car, **kwargs) -> None:
+    instance._loaded_customer_id = instance.__dict__.get('customer_id')
+
+
+@receiver([post_save, post_delete], sender=Car)
+def invalidate_car_lists(sender, instance: Car, **kwargs) -> None:
+    # Right away, so the rest of this transaction sees the change, and again on
+    # commit, in case a concurrent request cached the list in between.
+    for customer_id in {instance._loaded_customer_id, instance.customer_id} - {None}:
+        invalidate_customer_cars(customer_id)
+        transaction.on_commit(partial(invalidate_customer_cars, customer_id))
+    instance._loaded_customer_id = instance.customer_id
+
+
+@receiver(post_save, sender=Driver)
+def log_driver_feed_change(sender, instance: Driver, created: bool, **kwargs) -> None:
+    entry = driver_feed_entry(instance)
+    if created or entry != getattr(instance, '_loaded_feed_entry', None):
+        transaction.on_commit(partial(feed.record_change, instance.id))
+    instance._loaded_feed_entry = entry
+
+
+@receiver(post_delete, sender=Driver)
+def log_driver_feed_removal(sender, instance: Driver, **kwargs) -> None:
+    transaction.on_commit(partial(feed.record_change, instance.id))
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def invalidate_cached_user(sender, instance: CustomUser, **kwargs) -> None:
+    transaction.on_commit(partial(auth.invalidate_user, instance.pk))
+
+
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=Driver)
+def invalidate_cached_profile(sender, instance, **kwargs) -> None:
+    transaction.on_commit(partial(auth.invalidate_user, instance.user_id))
+
+
+@receiver(user_logged_out)
+def invalidate_cached_user_on_logout(sender, request, user, **kwargs) -> None:
+    if user is not None:
+        auth.invalidate_user(user.pk)
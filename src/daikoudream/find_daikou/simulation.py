@@ -0,0 +1,390 @@
+"""
+A fleet and demand simulator, to load the service like a rush hour would.
+
+Virtual drivers drive along random paths around a center point, report their
+positions, poll the driver feed and the order board, take the nearest open
+order and update their ETA. Virtual customers book rides, wait for a driver,
+and cancel when they give up waiting or when their ride is over (there is no
+view to complete an order). Everyone goes through the real views with the
+Django test client, so the whole request path is exercised, middleware and
+signals included, without a server.
+
+The simulation runs in ticks of `tick` simulated seconds, as fast as the
+views answer. Every agent takes one step per tick, spread over a pool of
+threads; each agent draws from its own random generator, seeded from the
+simulation seed and its name, so a run with the same seed makes the same
+plans whatever the thread interleaving (though what the views answer
+depends on it).
+
+The simulated users are named `sim<seed>-...` and kept between runs with the
+same seed, unless cleaned up.
+"""
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings as django_settings
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from .distances import EARTH_RADIUS_KM
+from .models import Car, Customer, CustomUser, Driver, Order
+
+# (latitude, longitude)
+Point = Tuple[float, float]
+
+ACTIVE_ORDER_FIELDS = 'id,status,pickup_latitude,pickup_longitude,dropoff_latitude,dropoff_longitude'
+
+
+def offset(origin: Point, km: float, bearing: float) -> Point:
+    """The point `km` away from `origin` in the direction `bearing` (radians from north)."""
+    latitude = origin[0] + math.degrees(km * math.cos(bearing) / EARTH_RADIUS_KM)
+    longitude = origin[1] + math.degrees(km * math.sin(bearing) / EARTH_RADIUS_KM) / math.cos(math.radians(origin[0]))
+    return latitude, longitude
+
+
+def distance_km(a: Point, b: Point) -> float:
+    """Equirectangular distance, plenty for the few km the agents move at a time."""
+    x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    y = math.radians(b[0] - a[0])
+    return EARTH_RADIUS_KM * math.hypot(x, y)
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """The `q` (0 to 1) percentile of sorted values, by nearest rank."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class Settings(NamedTuple):
+    seed: int = 0
+    drivers: int = 10
+    customers: int = 20
+    ticks: int = 60
+    # Simulated seconds per tick
+    tick: float = 10
+    center: Point = (35.6812, 139.7671)
+    radius_km: float = 5
+    speed_kmh: float = 30
+    # Chance that an idle customer books a ride on a tick, and that the ride is for later
+    booking_rate: float = 0.1
+    scheduled_rate: float = 0.05
+    # Ticks a customer waits for a driver before cancelling
+    patience: int = 30
+    # Chance that a driver with an order updates their ETA, or drops the order, on a tick
+    eta_update_rate: float = 0.2
+    drop_rate: float = 0.01
+
+
+class Stats:
+    """Latencies and failures of the requests of a run, by view."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.events: Dict[str, int] = defaultdict(int)
+
+    def record(self, view: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies[view].append(seconds)
+            if not ok:
+                self.errors[view] += 1
+
+    def count(self, event: str) -> None:
+        with self._lock:
+            self.events[event] += 1
+
+    @property
+    def requests(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+
+def client_host() -> str:
+    """
+    A host name `ALLOWED_HOSTS` accepts, for the clients to send.
+
+    The test client sends `testserver`, which only the test runner allows.
+    """
+    for host in django_settings.ALLOWED_HOSTS:
+        if host != '*':
+            # '.example.com' matches example.com and its subdomains.
+            return host.lstrip('.')
+    # Allowed with '*', and by Django itself with DEBUG and no ALLOWED_HOSTS.
+    return 'localhost'
+
+
+class Agent:
+    """A simulated user, stepping through the views with its own client."""
+
+    def __init__(self, simulation: 'Simulation', user: CustomUser):
+        self.simulation = simulation
+        self.user = user
+        self.random = random.Random(f'{simulation.settings.seed}:{user.username}')
+        self.client = Client(raise_request_exception=False, HTTP_HOST=client_host())
+        self.client.force_login(user)
+
+    def request(self, view: str, method: str = 'get', **kwargs):
+        """Send a request to a view and record how long it took; other statuses than 200, 302 and 304 are errors."""
+        started = time.perf_counter()
+        response = getattr(self.client, method)(reverse(view), **kwargs)
+        self.simulation.stats.record(view, time.perf_counter() - started, response.status_code in (200, 302, 304))
+        return response
+
+    def active_order(self) -> Optional[dict]:
+        response = self.request('api_v1:active_order', data={'fields': ACTIVE_ORDER_FIELDS})
+        return response.json()['order'] if response.status_code == 200 else None
+
+    def random_point(self) -> Point:
+        settings = self.simulation.settings
+        return offset(settings.center, settings.radius_km * math.sqrt(self.random.random()),
+                      self.random.uniform(0, 2 * math.pi))
+
+    def step(self, tick: int) -> None:
+        raise NotImplementedError
+
+
+class DriverAgent(Agent):
+    """Drives to random waypoints while free, and to the pickup and dropoff of its order."""
+
+    def __init__(self, simulation: 'Simulation', user: CustomUser):
+        super().__init__(simulation, user)
+        self.position = self.random_point()
+        self.waypoint = self.random_point()
+        self.order_id: Optional[int] = None
+        self.picked_up = False
+
+    def move_towards(self, target: Point) -> bool:
+        """Move one tick towards a point, and return whether it was reached."""
+        settings = self.simulation.settings
+        step = settings.speed_kmh * settings.tick / 3600
+        remaining = distance_km(self.position, target)
+        if remaining <= step:
+            self.position = target
+            return True
+        fraction = step / remaining
+        self.position = (self.position[0] + (target[0] - self.position[0]) * fraction,
+                         self.position[1] + (target[1] - self.position[1]) * fraction)
+        return False
+
+    def step(self, tick: int) -> None:
+        self.request('update_position', 'post', data={'latitude': self.position[0], 'longitude': self.position[1]})
+        self.request('driverlist')
+        order = self.active_order()
+        if order is None:
+            if self.move_towards(self.waypoint):
+                self.waypoint = self.random_point()
+            self.take_nearest_order()
+            return
+
+        if order['id'] != self.order_id:
+            self.order_id, self.picked_up = order['id'], False
+        if not self.picked_up:
+            self.picked_up = self.move_towards((order['pickup_latitude'], order['pickup_longitude']))
+        else:
+            self.move_towards((order['dropoff_latitude'], order['dropoff_longitude']))
+        if self.random.random() < self.simulation.settings.drop_rate:
+            self.request('cancel_order')
+            self.simulation.stats.count('orders dropped')
+        elif self.random.random() < self.simulation.settings.eta_update_rate:
+            self.request('update_eta', 'post')
+
+    def take_nearest_order(self) -> None:
+        response = self.request('order_features')
+        if response.status_code != 200:
+            return
+        # GeoJSON points are (longitude, latitude)
+        pickups = {
+            feature['properties']['id']: tuple(reversed(feature['geometry']['coordinates']))
+            for feature in json.loads(response.content)['features'] if feature['properties']['type'] == 'pickup'
+        }
+        if not pickups:
+            return
+        order_id = min(pickups, key=lambda pk: (distance_km(self.position, pickups[pk]), pk))
+        self.request('confirm_order', data={'order_id': order_id})
+        self.simulation.stats.count('orders confirmed')
+
+
+class CustomerAgent(Agent):
+    """Books rides, and cancels them when no driver came in time or once the ride is over."""
+
+    def __init__(self, simulation: 'Simulation', user: CustomUser):
+        super().__init__(simulation, user)
+        self.car_id = user.customer.cars.values_list('id', flat=True).first()
+        self.booked_at: Optional[int] = None
+        self.assigned_at: Optional[int] = None
+        self.ride_ticks = 0
+
+    def step(self, tick: int) -> None:
+        settings = self.simulation.settings
+        if self.booked_at is None:
+            if self.random.random() < settings.booking_rate:
+                self.book(tick)
+            return
+
+        order = self.active_order()
+        if order is None:
+            # Ended elsewhere
+            self.booked_at = self.assigned_at = None
+        elif order['status'] == 'assigned':
+            if self.assigned_at is None:
+                self.assigned_at = tick
+            elif tick - self.assigned_at >= self.ride_ticks:
+                self.end(tick, 'rides ended')
+        elif tick - self.booked_at >= settings.patience:
+            self.end(tick, 'orders given up')
+
+    def book(self, tick: int) -> None:
+        settings = self.simulation.settings
+        departure, arrival = self.random_point(), self.random_point()
+        pickup_time = timezone.now()
+        if self.random.random() < settings.scheduled_rate:
+            pickup_time += timedelta(hours=self.random.uniform(1, 3))
+        # As the booking map sends them, longitude first.
+        response = self.request('call_driver', data={
+            'departure': f'{departure[1]},{departure[0]}',
+            'arrival': f'{arrival[1]},{arrival[0]}',
+            'time': pickup_time.isoformat(),
+            'car': self.car_id,
+        })
+        # The view redirects once the order is saved; any other answer booked nothing.
+        if response.status_code != 302:
+            self.simulation.stats.count('bookings refused')
+            return
+        self.simulation.stats.count('orders booked')
+        self.booked_at, self.assigned_at = tick, None
+        speed_km_per_tick = settings.speed_kmh * settings.tick / 3600
+        self.ride_ticks = math.ceil(distance_km(departure, arrival) / speed_km_per_tick) + 1
+
+    def end(self, tick: int, event: str) -> None:
+        self.request('cancel_order')
+        self.simulation.stats.count(event)
+        self.booked_at = self.assigned_at = None
+
+
+class Report(NamedTuple):
+    seconds: float
+    requests: int
+    # view -> (requests, errors, p50, p90, p99 seconds)
+    views: Dict[str, Tuple[int, int, float, float, float]]
+    events: Dict[str, int]
+    violations: Dict[str, int]
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.seconds if self.seconds else 0.0
+
+    @property
+    def errors(self) -> int:
+        return sum(view[1] for view in self.views.values())
+
+
+class Simulation:
+    """
+    Args:
+        settings: The size, length and behaviour of the simulation.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.stats = Stats()
+        self.agents: List[Agent] = []
+
+    @property
+    def prefix(self) -> str:
+        return f'sim{self.settings.seed}-'
+
+    def set_up(self) -> None:
+        """Create (or reuse) the simulated users, and end the orders left over by a previous run."""
+        for order in Order.objects.filter(customer__user__username__startswith=self.prefix, completed=False):
+            order.cancel()
+        for i in range(self.settings.drivers):
+            user, _ = CustomUser.objects.get_or_create(username=f'{self.prefix}driver{i}')
+            driver, _ = Driver.objects.get_or_create(user=user)
+            driver.is_available = True
+            self.agents.append(DriverAgent(self, user))
+            driver.latitude, driver.longitude = self.agents[-1].position
+            driver.save()
+        for i in range(self.settings.customers):
+            user, _ = CustomUser.objects.get_or_create(username=f'{self.prefix}customer{i}')
+            customer, _ = Customer.objects.get_or_create(user=user)
+            if not customer.cars.exists():
+                Car.objects.create(customer=customer, make='Toyota', model='Prius', year=2020)
+            self.agents.append(CustomerAgent(self, user))
+
+    def clean_up(self) -> int:
+        """Delete the simulated users and their orders, and return how many users were deleted."""
+        deleted = CustomUser.objects.filter(username__startswith=self.prefix).delete()[1]
+        return deleted.get(CustomUser._meta.label, 0)
+
+    def step(self, agent: Agent, tick: int) -> None:
+        try:
+            agent.step(tick)
+        except Exception:
+            # A client-side failure, such as an unexpected response body
+            self.stats.count('agent failures')
+
+    def run(self, concurrency: int = 1) -> Report:
+        """
+        Set up and run the simulation.
+
+        Args:
+            concurrency: The number of threads stepping the agents. With 1, they step
+                in the calling thread, one after the other.
+        """
+        self.set_up()
+        started = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency) as pool:
+                for tick in range(self.settings.ticks):
+                    list(pool.map(self.step, self.agents, [tick] * len(self.agents)))
+                # Each thread opened its own database connection; the barrier
+                # makes every thread close its own.
+                barrier = threading.Barrier(concurrency)
+
+                def close_connection(_):
+                    barrier.wait()
+                    connection.close()
+
+                list(pool.map(close_connection, range(concurrency)))
+        else:
+            for tick in range(self.settings.ticks):
+                for agent in self.agents:
+                    self.step(agent, tick)
+        return self.report(time.perf_counter() - started)
+
+    def violations(self) -> Dict[str, int]:
+        """Count the orders of the simulated users breaking the rules the views should enforce."""
+        orders = Order.objects.filter(customer__user__username__startswith=self.prefix)
+        open_orders = orders.filter(completed=False)
+        return {
+            'drivers with several orders':
+                open_orders.exclude(driver=None).values('driver').annotate(n=Count('id')).filter(n__gt=1).count(),
+            'customers with several orders':
+                open_orders.values('customer').annotate(n=Count('id')).filter(n__gt=1).count(),
+            'held orders with a driver': open_orders.filter(released=False).exclude(driver=None).count(),
+            'assigned orders without an ETA': orders.exclude(driver=None).filter(eta=None).count(),
+            # Customers only book inside the area; anything else was stored wrong.
+            'orders picking up outside the area': sum(
+                distance_km(self.settings.center, pickup) > self.settings.radius_km * 1.01
+                for pickup in orders.values_list('pickup_latitude', 'pickup_longitude')
+            ),
+        }
+
+    def report(self, seconds: float) -> Report:
+        views = {}
+        for view, latencies in sorted(self.stats.latencies.items()):
+            ordered = sorted(latencies)
+            views[view] = (len(ordered), self.stats.errors[view],
+                           percentile(ordered, 0.5), percentile(ordered, 0.9), percentile(ordered, 0.99))
+        return Report(seconds, self.stats.requests, views, dict(self.stats.events), self.violations())
@@ -0,0 +1,190 @@
+"""
+Shared, pre-encoded snapshots of the driver feed.
+
+However many clients poll the feed, the available drivers are queried and
+encoded at most once per `DAIKOU_SNAPSHOT_INTERVAL` seconds. Each process keeps
+the latest snapshot in memory and shares it with other processes through the
+cache backend; concurrent misses wait for (or skip past) a single rebuild
+instead of all rebuilding at once.
+
+The snapshot holds no per-user data. Whether a driver is assigned to the
+requesting user is laid over the pre-encoded bytes when serving, see
+`render_json` and `render_binary`.
+"""
+import gzip
+import hashlib
+import json
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import feed, fleet, wire
+
+# Seconds a snapshot stays in the cache backend, and the longest a rebuild
+# may hold the cross-process rebuild lock.
+CACHE_TIMEOUT = 60
+LOCK_TIMEOUT = 10
+
+
+class FleetSnapshot(NamedTuple):
+    """The available drivers, encoded once for every client."""
+    version: int
+    built_at: float
+    # driver id -> position in `features` and in the binary records
+    index: Dict[int, int]
+    features: List[bytes]
+    json_body: bytes
+    json_gzip: bytes
+    json_etag: str
+    binary_body: bytes
+    binary_gzip: bytes
+    binary_etag: str
+
+
+def encode_feature(driver_id: int, latitude: float, longitude: float, name: str, is_assigned: bool) -> bytes:
+    return json.dumps({
+        'type': 'Feature',
+        'id': driver_id,
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {'name': name, 'is_assigned': is_assigned},
+    }, cls=DjangoJSONEncoder).encode()
+
+
+def _json_body(version: int, features: List[bytes]) -> bytes:
+    return b'{"type": "FeatureCollection", "version": %d, "features": [%s]}' % (version, b', '.join(features))
+
+
+def build_fleet_snapshot(zone: str = '') -> FleetSnapshot:
+    """Encode the available drivers, of one zone or all of them, from the fleet state."""
+    # Read the version first: anything changing while the state is read is
+    # sent again to clients asking for changes since this version.
+    version = feed.current_version()
+    drivers = fleet.current().rows(zone)
+    rows = list(zip(drivers.ids.tolist(), drivers.latitudes.tolist(), drivers.longitudes.tolist(), drivers.names))
+    features = [encode_feature(pk, lat, lon, name, False) for pk, lat, lon, name in rows]
+    json_body = _json_body(version, features)
+    binary_body = wire.pack_frame([(pk, wire.to_fixed(lat), wire.to_fixed(lon)) for pk, lat, lon, _ in rows], version)
+    return FleetSnapshot(
+        version=version,
+        built_at=time.time(),
+        index={row[0]: i for i, row in enumerate(rows)},
+        features=features,
+        json_body=json_body,
+        json_gzip=gzip.compress(json_body),
+        json_etag=hashlib.md5(json_body).hexdigest(),
+        binary_body=binary_body,
+        binary_gzip=gzip.compress(binary_body),
+        binary_etag=hashlib.md5(binary_body).hexdigest(),
+    )
+
+
+def render_json(snapshot: FleetSnapshot, assigned: Optional[int]) -> Tuple[bytes, bool]:
+    """
+    Return the JSON body for a user, and whether it is the shared one (and so
+    may be sent pre-compressed).
+    """
+    if assigned not in snapshot.index:
+        return snapshot.json_body, True
+    i = snapshot.index[assigned]
+    feature = json.loads(snapshot.features[i])
+    feature['properties']['is_assigned'] = True
+    features = snapshot.features[:i] + [json.dumps(feature, cls=DjangoJSONEncoder).encode()] + snapshot.features[i + 1:]
+    return _json_body(snapshot.version, features), False
+
+
+def render_binary(snapshot: FleetSnapshot, assigned: Optional[int]) -> Tuple[bytes, bool]:
+    """Like `render_json`, for the binary frame."""
+    if assigned is None:
+        return snapshot.binary_body, True
+    body = bytearray(snapshot.binary_body)
+    header = list(wire.HEADER.unpack_from(body))
+    header[4] = assigned
+    wire.HEADER.pack_into(body, 0, *header)
+    if assigned in snapshot.index:
+        body[wire.HEADER.size + snapshot.index[assigned] * wire.RECORD.size + wire.RECORD.size - 1] |= wire.FLAG_ASSIGNED
+    return bytes(body), False
+
+
+class SnapshotPublisher:
+    """
+    Rebuilds a snapshot at most once per interval and hands the same instance to
+    every caller in between.
+
+    Args:
+        name: Names the snapshot in the cache backend.
+        build: Builds a fresh snapshot. Its result needs a `built_at` timestamp.
+    """
+
+    def __init__(self, name: str, build: Callable[[], FleetSnapshot]):
+        self.name = name
+        self.build = build
+        self._lock = threading.Lock()
+        self._snapshot: Optional[FleetSnapshot] = None
+
+    @property
+    def cache_key(self) -> str:
+        return f'snapshot:{self.name}'
+
+    def interval(self) -> float:
+        return getattr(settings, 'DAIKOU_SNAPSHOT_INTERVAL', 1.0)
+
+    def is_fresh(self, snapshot: Optional[FleetSnapshot]) -> bool:
+        return snapshot is not None and time.time() - snapshot.built_at < self.interval()
+
+    def latest(self) -> Optional[FleetSnapshot]:
+        """The newest snapshot at hand, however old, without rebuilding it."""
+        return self._snapshot or cache.get(self.cache_key)
+
+    def get(self) -> FleetSnapshot:
+        """Return a snapshot no older than the interval, rebuilding it if needed."""
+        snapshot = self._snapshot
+        if self.is_fresh(snapshot):
+            return snapshot
+        # With a previous snapshot to fall back on, don't queue up behind a
+        # rebuild that is already running in another thread.
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self._snapshot
+            if self.is_fresh(snapshot):
+                return snapshot
+            shared = cache.get(self.cache_key)
+            if self.is_fresh(shared):
+                snapshot = shared
+            elif cache.add(f'{self.cache_key}:lock', True, LOCK_TIMEOUT):
+                try:
+                    snapshot = self.build()
+                    cache.set(self.cache_key, snapshot, CACHE_TIMEOUT)
+                finally:
+                    cache.delete(f'{self.cache_key}:lock')
+            elif shared is not None or snapshot is not None:
+                # Another process is rebuilding; serve the newest copy we have.
+                candidates = [s for s in (shared, snapshot) if s is not None]
+                snapshot = max(candidates, key=lambda s: s.built_at)
+            else:
+                snapshot = self.build()
+            self._snapshot = snapshot
+            return snapshot
+        finally:
+            self._lock.release()
+
+
+fleet_publisher = SnapshotPublisher('fleet', build_fleet_snapshot)
+_zone_publishers: Dict[str, SnapshotPublisher] = {'': fleet_publisher}
+_zone_publishers_lock = threading.Lock()
+
+
+def publisher_for(zone: str) -> SnapshotPublisher:
+    """The publisher of a zone's fleet snapshot, or of the whole fleet for ''."""
+    publisher = _zone_publishers.get(zone)
+    if publisher is None:
+        with _zone_publishers_lock:
+            publisher = _zone_publishers.setdefault(
+                zone, SnapshotPublisher(f'fleet:{zone}', partial(build_fleet_snapshot, zone))
+            )
+    return publisher
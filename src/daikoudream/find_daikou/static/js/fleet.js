@@ -0,0 +1,108 @@
+// Decoder for the binary driver feed served by the available_drivers view.
+// The frame layout is documented in find_daikou/wire.py.
+var DaikouFleet = (function() {
+    var CONTENT_TYPE = 'application/x-daikou-fleet';
+    var HEADER_SIZE = 33;
+    var RECORD_SIZE = 13;
+    var SCALE = 1000000;
+
+    // Versions are 64 bit on the wire but always below 2**52.
+    function getUint64(view, offset) {
+        return view.getUint32(offset + 4, true) * 4294967296 + view.getUint32(offset, true);
+    }
+
+    function decode(buffer) {
+        var view = new DataView(buffer);
+        var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+        if (magic !== 'DKF1') {
+            throw new Error('Not a fleet frame');
+        }
+        var frame = {
+            type: view.getUint8(4) === 1 ? 'delta' : 'full',
+            version: getUint64(view, 5),
+            base: getUint64(view, 13),
+            assigned: view.getUint32(21, true) || null,
+            drivers: [],
+            removed: []
+        };
+        var count = view.getUint32(25, true);
+        var removedCount = view.getUint32(29, true);
+        var offset = HEADER_SIZE;
+        for (var i = 0; i < count; i++, offset += RECORD_SIZE) {
+            frame.drivers.push({
+                id: view.getUint32(offset, true),
+                latitude: view.getInt32(offset + 4, true) / SCALE,
+                longitude: view.getInt32(offset + 8, true) / SCALE,
+                flags: view.getUint8(offset + 12)
+            });
+        }
+        for (var j = 0; j < removedCount; j++, offset += 4) {
+            frame.removed.push(view.getUint32(offset, true));
+        }
+        return frame;
+    }
+
+    // Poll the feed every `interval` milliseconds, keeping `source` (an
+    // ol.source.Vector) in sync. Features are keyed by driver id and carry an
+    // `is_assigned` property, like the GeoJSON feed.
+    function poll(url, source, interval) {
+        var version = null;
+        var assigned = null;
+        var delay = interval;
+
+        function applyFrame(frame) {
+            if (frame.type === 'full') {
+                source.clear();
+            }
+            frame.removed.forEach(function(id) {
+                var feature = source.getFeatureById(id);
+                if (feature) {
+                    source.removeFeature(feature);
+                }
+            });
+            frame.drivers.forEach(function(driver) {
+                var geometry = new ol.geom.Point(ol.proj.fromLonLat([driver.longitude, driver.latitude]));
+                var feature = source.getFeatureById(driver.id);
+                if (feature) {
+                    feature.setGeometry(geometry);
+                } else {
+                    feature = new ol.Feature({geometry: geometry});
+                    feature.setId(driver.id);
+                    source.addFeature(feature);
+                }
+            });
+            if (frame.assigned !== assigned) {
+                assigned = frame.assigned;
+                source.forEachFeature(function(feature) {
+                    feature.set('is_assigned', feature.getId() === assigned);
+                });
+            } else if (assigned !== null && source.getFeatureById(assigned)) {
+                source.getFeatureById(assigned).set('is_assigned', true);
+            }
+            version = frame.version;
+        }
+
+        function refresh() {
+            fetch(version === null ? url : url + (url.indexOf('?') < 0 ? '?' : '&') + 'since=' + version, {
+                headers: {'Accept': CONTENT_TYPE},
+                credentials: 'same-origin'
+            }).then(function(response) {
+                // The server asks for slower polling while it is under load.
+                var hint = parseInt(response.headers.get('X-Poll-Interval'), 10);
+                delay = hint > 0 ? Math.max(interval, hint * 1000) : interval;
+                if (!response.ok) {
+                    throw new Error('Fleet feed unavailable');
+                }
+                return response.arrayBuffer();
+            }).then(function(buffer) {
+                applyFrame(decode(buffer));
+            }).finally(function() {
+                setTimeout(refresh, delay);
+            });
+        }
+
+        refresh();
+    }
+
+    return {CONTENT_TYPE: CONTENT_TYPE, decode: decode, poll: poll};
+})();
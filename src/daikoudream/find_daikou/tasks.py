@@ -0,0 +1,80 @@
+"""
+Background jobs of the app, registered with find_daikou.jobs. Imported from
+`FindDaikouConfig.ready`, so that every process can run them.
+"""
+import time
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import heatmap, jobs, rollups, scheduler
+from .models import Order, release_time
+
+
+# Recurring jobs: name -> (setting of the seconds between runs, default)
+RECURRING = {
+    'rollup_orders': ('DAIKOU_ROLLUP_INTERVAL', 300),
+    'prune_heatmap': ('DAIKOU_HEATMAP_PRUNE_INTERVAL', 3600),
+}
+
+
+def schedule(name: str) -> None:
+    """Queue a run of a recurring job at the next multiple of its interval, once."""
+    interval = getattr(settings, *RECURRING[name])
+    now = time.time()
+    slot = int(now // interval) + 1
+    jobs.enqueue(name, idempotency_key=f'{name}:{interval}:{slot}', delay=slot * interval - now)
+
+
+def schedule_recurring() -> None:
+    """
+    Start the recurring jobs; `run_jobs` does on start.
+
+    Each run queues the next one. A run that fails for good ends its chain, until
+    this is called again.
+    """
+    for name in RECURRING:
+        schedule(name)
+
+
+@jobs.job('rollup_orders', max_attempts=5, backoff=30)
+def rollup_orders() -> None:
+    """Bring the order rollups up to date with the orders saved since the last run."""
+    schedule('rollup_orders')
+    rollups.run()
+
+
+@jobs.job('prune_heatmap', max_attempts=5, backoff=30)
+def prune_heatmap() -> None:
+    """Delete the heatmap cells that count nothing anymore."""
+    schedule('prune_heatmap')
+    heatmap.prune()
+
+
+def enqueue_releases(orders: Iterable[Order]) -> None:
+    """Queue the release of held orders to the board, each at its release time."""
+    now = timezone.now()
+    jobs.enqueue_many('release_orders', [
+        ({'order_id': order.id}, max((release_time(order.pickup_time) - now).total_seconds(), 0))
+        for order in orders
+    ])
+
+
+@jobs.job('release_orders', priority=5, batch_size=100)
+def release_orders(payloads: List[Dict]) -> None:
+    """
+    Put held orders on the board once they are due.
+
+    An order whose pickup was postponed since is queued again for its new
+    release time; one already released or completed is left alone.
+    """
+    order_ids = {payload['order_id'] for payload in payloads}
+    now = timezone.now()
+    later = []
+    for order in Order.objects.filter(id__in=order_ids, released=False, completed=False).only('id', 'pickup_time'):
+        if release_time(order.pickup_time) <= now:
+            scheduler.release(order.id)
+        else:
+            later.append(order)
+    enqueue_releases(later)
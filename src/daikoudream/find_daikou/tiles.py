@@ -0,0 +1,230 @@
+"""
+Mapbox Vector Tile encoding of the open orders layer.
+
+Tiles are addressed with the usual web mercator z/x/y scheme and encoded
+straight to protobuf bytes, so no external tile server is needed. Encoded
+tiles are kept in the cache backend and dropped whenever an order inside
+them changes (see `invalidate_points`).
+
+Drivers are not tiled: the map follows them through the driver feed (see
+find_daikou.feed), which sends only the drivers that moved.
+"""
+import hashlib
+import math
+import struct
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Order
+
+EXTENT = 4096
+BUFFER = 64
+MAX_LATITUDE = 85.0511287798
+
+# (feature id, longitude, latitude, properties)
+TileFeature = Tuple[int, float, float, Dict[str, object]]
+BBox = Tuple[float, float, float, float]
+
+
+def tile_min_zoom() -> int:
+    return getattr(settings, 'DAIKOU_TILE_MIN_ZOOM', 0)
+
+
+def tile_max_zoom() -> int:
+    return getattr(settings, 'DAIKOU_TILE_MAX_ZOOM', 16)
+
+
+def lonlat_to_tile_fraction(lon: float, lat: float, z: int) -> Tuple[float, float]:
+    """
+    Project a WGS84 coordinate onto the tile grid of zoom level `z`.
+
+    Returns:
+        The fractional (x, y) tile coordinates. The integer parts are the tile
+        containing the point, the fractional parts its position inside it.
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 2 ** z
+    x = (lon + 180.0) / 360.0 * n
+    lat_rad = math.radians(lat)
+    y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n
+    return x, y
+
+
+def tile_for_point(lon: float, lat: float, z: int) -> Tuple[int, int]:
+    """Return the (x, y) of the tile at zoom `z` containing the point."""
+    n = 2 ** z
+    x, y = lonlat_to_tile_fraction(lon, lat, z)
+    return min(max(int(x), 0), n - 1), min(max(int(y), 0), n - 1)
+
+
+def tile_bounds(z: int, x: int, y: int, buffer: int = BUFFER) -> BBox:
+    """
+    Return the (min_lon, min_lat, max_lon, max_lat) covered by a tile, grown by
+    `buffer` tile pixels on every side so symbols on tile edges are not clipped.
+    """
+    n = 2 ** z
+    pad = buffer / EXTENT
+
+    def lon(tx: float) -> float:
+        return tx / n * 360.0 - 180.0
+
+    def lat(ty: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return lon(x - pad), lat(y + 1 + pad), lon(x + 1 + pad), lat(y - pad)
+
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _length_delimited(field: int, payload: bytes) -> bytes:
+    return _key(field, 2) + _varint(len(payload)) + payload
+
+
+def _packed(field: int, values: Iterable[int]) -> bytes:
+    return _length_delimited(field, b''.join(_varint(v) for v in values))
+
+
+def _encode_value(value: object) -> bytes:
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        return _key(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _length_delimited(1, str(value).encode('utf-8'))
+
+
+def encode_layer(name: str, features: Iterable[TileFeature], z: int, x: int, y: int) -> bytes:
+    """
+    Encode point features as a single MVT layer of the tile z/x/y.
+
+    Args:
+        name: The layer name.
+        features: (id, lon, lat, properties) tuples.
+        z, x, y: The tile address.
+
+    Returns:
+        The protobuf encoded layer, ready to be embedded in a tile.
+    """
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, object], int] = {}
+    encoded_features = []
+    for feature_id, lon, lat, properties in features:
+        fx, fy = lonlat_to_tile_fraction(lon, lat, z)
+        px = int(round((fx - x) * EXTENT))
+        py = int(round((fy - y) * EXTENT))
+        tags: List[int] = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = _key(1, 0) + _varint(feature_id)
+        if tags:
+            feature += _packed(2, tags)
+        # Geometry type 1 is POINT, encoded as a single MoveTo command.
+        feature += _key(3, 0) + _varint(1)
+        feature += _packed(4, [(1 & 0x7) | (1 << 3), _zigzag(px), _zigzag(py)])
+        encoded_features.append(_length_delimited(2, feature))
+
+    layer = _key(15, 0) + _varint(2)
+    layer += _length_delimited(1, name.encode('utf-8'))
+    layer += b''.join(encoded_features)
+    layer += b''.join(_length_delimited(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_length_delimited(4, _encode_value(value)) for _, value in values)
+    layer += _key(5, 0) + _varint(EXTENT)
+    return layer
+
+
+def encode_tile(layers: Dict[str, Iterable[TileFeature]], z: int, x: int, y: int) -> bytes:
+    """Encode a complete tile from a mapping of layer name to features."""
+    return b''.join(
+        _length_delimited(3, encode_layer(name, features, z, x, y))
+        for name, features in layers.items()
+    )
+
+
+def order_features(bbox: BBox) -> List[TileFeature]:
+    """Pickup and dropoff points of open orders inside the bounding box."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    open_orders = Order.objects.open()
+    pickups = open_orders.filter(
+        pickup_longitude__gte=min_lon, pickup_longitude__lte=max_lon,
+        pickup_latitude__gte=min_lat, pickup_latitude__lte=max_lat,
+    ).values_list('id', 'pickup_longitude', 'pickup_latitude')
+    dropoffs = open_orders.filter(
+        dropoff_longitude__gte=min_lon, dropoff_longitude__lte=max_lon,
+        dropoff_latitude__gte=min_lat, dropoff_latitude__lte=max_lat,
+    ).values_list('id', 'dropoff_longitude', 'dropoff_latitude')
+    # Feature ids must be unique within a layer, so pickups get even ids and
+    # dropoffs odd ones; the order id itself is kept as a property.
+    features = [(pk * 2, lon, lat, {'id': pk, 'type': 'pickup'}) for pk, lon, lat in pickups]
+    features += [(pk * 2 + 1, lon, lat, {'id': pk, 'type': 'dropoff'}) for pk, lon, lat in dropoffs]
+    return features
+
+
+LAYERS: Dict[str, Callable[[BBox], List[TileFeature]]] = {
+    'orders': order_features,
+}
+
+
+def _cache_key(layer: str, z: int, x: int, y: int) -> str:
+    return f'mvt:{layer}:{z}:{x}:{y}'
+
+
+def get_tile(layer: str, z: int, x: int, y: int) -> Tuple[bytes, str]:
+    """
+    Return the encoded tile and its ETag, building and caching it if needed.
+
+    Raises:
+        KeyError: If `layer` is not a known layer.
+    """
+    build = LAYERS[layer]
+    key = _cache_key(layer, z, x, y)
+    cached: Optional[Tuple[bytes, str]] = cache.get(key)
+    if cached is None:
+        data = encode_tile({layer: build(tile_bounds(z, x, y))}, z, x, y)
+        cached = (data, hashlib.md5(data).hexdigest())
+        cache.set(key, cached, getattr(settings, 'DAIKOU_TILE_CACHE_TIMEOUT', 60))
+    return cached
+
+
+def invalidate_points(layer: str, points: Iterable[Tuple[float, float]]) -> None:
+    """
+    Drop every cached tile of `layer` that may contain one of the given
+    (lon, lat) points, at every served zoom level.
+    """
+    keys = set()
+    pad = BUFFER / EXTENT
+    for lon, lat in points:
+        for z in range(tile_min_zoom(), tile_max_zoom() + 1):
+            n = 2 ** z
+            fx, fy = lonlat_to_tile_fraction(lon, lat, z)
+            # A point close to a tile edge is also drawn in the neighbouring
+            # tile's buffer, so that tile has to go as well.
+            for tx in {math.floor(fx - pad), math.floor(fx), math.floor(fx + pad)}:
+                for ty in {math.floor(fy - pad), math.floor(fy), math.floor(fy + pad)}:
+                    if 0 <= tx < n and 0 <= ty < n:
+                        keys.add(_cache_key(layer, z, tx, ty))
+    if keys:
+        cache.delete_many(list(keys))
@@ -1,32 +1,72 @@
-from typing import List, Dict, Any, Union, Optional
+import gzip
+import hashlib
+import json
+import math
+from typing import List, Dict, Any, Union, Optional, Sequence, Tuple, NamedTuple
 
 from datetime import datetime, timedelta
 
-from django.http import JsonResponse, HttpResponseBadRequest, HttpRequest, HttpResponse, HttpResponseRedirect
+from django.http import JsonResponse, HttpResponseBadRequest, HttpRequest, HttpResponse, HttpResponseRedirect, HttpResponseNotModified, Http404, FileResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.contrib.gis.geos import Point
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.db import transaction
 from django.urls import reverse
+from django.db.models import BooleanField, ExpressionWrapper, Q
 from django.db.models.query import QuerySet
-
-from find_daikou.models import Driver, Order, Car
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from find_daikou.models import Driver, Order, Car, customer_cars, customer_owns_car, order_features_cache_key
 from .forms import DriverForm, RegistrationForm, CarForm, CustomerForm
 from .models import Driver, Customer
+from . import distances, feed, fleet, heatmap, middleware, nearby, positions, profiling, routes, snapshot, tiles, wire, zones
+
 
-def available_drivers(request) -> JsonResponse:
+def available_drivers(request) -> HttpResponse:
     """
     Returns a JSON response containing a list of available drivers as GeoJSON points.
 
+    Full snapshots are built at most once per DAIKOU_SNAPSHOT_INTERVAL and shared by
+    every client (see find_daikou.snapshot), so they may lag the database by that long.
+
+    The FeatureCollection carries the feed `version`. A client passing it back as
+    `since=<version>` only gets the drivers that moved or became available since, plus
+    the ids of the ones that were `removed`; if that version has fallen out of the
+    change log (see find_daikou.feed) it gets a full snapshot again.
+
+    Clients sending `Accept: application/x-daikou-fleet` get the same data as a packed
+    binary frame instead (see find_daikou.wire).
+
+    Under load (see find_daikou.middleware) the last snapshot at hand is served as is,
+    without the assigned driver highlight and without touching the database.
+
+    `zone=<name>` restricts the feed to the drivers of one zone (see find_daikou.zones).
+
     Args:
         request (HttpRequest): The HTTP request object.
 
     Returns:
-        JsonResponse: A JSON response containing a list of available drivers as GeoJSON points.
+        HttpResponse: A JSON response containing a list of available drivers as GeoJSON points,
+        or a binary fleet frame.
     """
 
-    # Check if the user is authenticated
-    if request.user.is_authenticated:
+    zone = request.GET.get('zone', '')
+    publisher = snapshot.publisher_for(zone)
+    if getattr(request, 'load_level', middleware.NORMAL) != middleware.NORMAL:
+        stale = publisher.latest()
+        if stale is not None:
+            return fleet_snapshot_response(request, stale, None)
+
+    # Check if the user is an authenticated customer
+    if request.user.is_authenticated and hasattr(request.user, 'customer'):
         # Attempt to retrieve the current order and assigned driver, if any
         try:
             order = Order.objects.get(customer=request.user.customer, completed=False)
@@ -36,26 +76,232 @@ def available_drivers(request) -> JsonResponse:
     else:
         assigned_driver = None
 
-    # Retrieve all drivers that are currently available
-    drivers = Driver.objects.filter(is_available=True)
+    assigned = assigned_driver.id if assigned_driver else None
+    since = request.GET.get('since', '')
+    changes = feed.changes_since(int(since)) if since.isdigit() else None
+    if changes is None:
+        # A full snapshot, shared with every other client polling right now
+        return fleet_snapshot_response(request, publisher.get(), assigned)
+
+    # Only the drivers that changed; those no longer available were removed
+    version, changed_ids = changes
+    drivers = fleet.current().rows(zone, ids=changed_ids)
+    rows = list(zip(drivers.ids.tolist(), drivers.latitudes.tolist(), drivers.longitudes.tolist(), drivers.names))
+
+    if wire.accepts_binary(request):
+        records = [(pk, wire.to_fixed(lat), wire.to_fixed(lon)) for pk, lat, lon, _ in rows]
+        removed = changed_ids - {pk for pk, _, _ in records}
+        data = wire.pack_frame(records, version, int(since), removed, assigned=assigned)
+        response = HttpResponse(data, content_type=wire.CONTENT_TYPE)
+        patch_vary_headers(response, ['Accept'])
+        return response
 
     # Create a GeoJSON FeatureCollection of driver points
     driver_points = [
         {
             'type': 'Feature',
-            'geometry': {'type': 'Point', 'coordinates': [d.latitude, d.longitude]},
-            'properties': {'name': d.user.username, 'is_assigned': d == assigned_driver }
-        } for d in drivers
+            'id': pk,
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'name': name, 'is_assigned': pk == assigned}
+        } for pk, lat, lon, name in rows
     ]
 
     # Create a dictionary containing the GeoJSON FeatureCollection
     data = {
         'type': 'FeatureCollection',
-        'features': driver_points
+        'version': version,
+        'since': int(since),
+        'features': driver_points,
+        'removed': sorted(changed_ids - {feature['id'] for feature in driver_points}),
+        'assigned': assigned,
     }
 
     # Return the response as a JSON object
-    return JsonResponse(data)
+    response = JsonResponse(data)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+def fleet_snapshot_response(request: HttpRequest, fleet: snapshot.FleetSnapshot, assigned: Optional[int]) -> HttpResponse:
+    """
+    Serve a pre-encoded fleet snapshot, as JSON or as a binary frame.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        fleet (FleetSnapshot): The snapshot to serve.
+        assigned (int): The id of the driver assigned to the requesting user, if any.
+
+    Returns:
+        HttpResponse: The snapshot, gzip compressed if the client accepts it and the body
+        is the shared one, or a 304 if the client's copy is still current.
+    """
+    if wire.accepts_binary(request):
+        body, shared = snapshot.render_binary(fleet, assigned)
+        compressed, etag, content_type = fleet.binary_gzip, fleet.binary_etag, wire.CONTENT_TYPE
+    else:
+        body, shared = snapshot.render_json(fleet, assigned)
+        compressed, etag, content_type = fleet.json_gzip, fleet.json_etag, 'application/json'
+    etag = f'"{etag}-{assigned or 0}"'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    elif shared and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(compressed, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(body, content_type=content_type)
+    response['ETag'] = etag
+    patch_vary_headers(response, ['Accept', 'Accept-Encoding'])
+    return response
+
+def vector_tile(request: HttpRequest, layer: str, z: int, x: int, y: int) -> HttpResponse:
+    """
+    Serves a Mapbox Vector Tile of the open orders layer.
+
+    Tiles are encoded once and served from the cache until an order inside them
+    changes, and carry an ETag so clients can revalidate them cheaply.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        layer (str): The layer to render, 'orders'.
+        z, x, y (int): The tile address.
+
+    Returns:
+        HttpResponse: The encoded tile, or a 304 if the client's copy is still current.
+    """
+    n = 2 ** z
+    if layer not in tiles.LAYERS or not tiles.tile_min_zoom() <= z <= tiles.tile_max_zoom() \
+            or not (0 <= x < n and 0 <= y < n):
+        raise Http404('No such tile.')
+    # Open orders are only shown to drivers, as on the index page.
+    if not (request.user.is_authenticated and hasattr(request.user, 'driver')):
+        raise Http404('No such tile.')
+
+    data, etag = tiles.get_tile(layer, z, x, y)
+    etag = f'"{etag}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type='application/vnd.mapbox-vector-tile')
+    response['ETag'] = etag
+    patch_cache_control(
+        response,
+        max_age=getattr(settings, 'DAIKOU_TILE_MAX_AGE', 5),
+        private=True,
+    )
+    return response
+
+def order_features(request: HttpRequest) -> HttpResponse:
+    """
+    Serves the pickup and dropoff points of the open orders around the driver, as GeoJSON.
+
+    Those are the orders of the driver's zone and of the zones next to the driver
+    (see zones.board_zones), or of every zone while the driver has no position.
+
+    Only drivers see open orders, as on the index page.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: The FeatureCollection, gzip compressed if the client accepts it, or a 304
+        if the client's copy is still current.
+    """
+    if not (request.user.is_authenticated and hasattr(request.user, 'driver')):
+        raise Http404('No open orders here.')
+
+    driver = request.user.driver
+    body, compressed, etag = get_board(zones.board_zones(driver.latitude, driver.longitude))
+    etag = f'"{etag}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(compressed, content_type='application/geo+json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(body, content_type='application/geo+json')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'DAIKOU_ORDER_FEATURES_MAX_AGE', 5))
+    patch_vary_headers(response, ['Accept-Encoding', 'Cookie'])
+    return response
+
+def heatmap_cells(request: HttpRequest) -> HttpResponse:
+    """
+    Serves the demand and supply heatmap cells inside a view, as GeoJSON squares.
+
+    Args:
+        request (HttpRequest): The HTTP request object, with the view as
+            `bbox=min_lon,min_lat,max_lon,max_lat` and optionally the pickup `window`
+            (an ISO datetime inside it, the current window by default).
+
+    Returns:
+        HttpResponse: The FeatureCollection of cells with demand or supply, each with
+        `demand` and `supply` properties.
+    """
+    if not (request.user.is_authenticated and (hasattr(request.user, 'driver') or request.user.is_staff)):
+        raise Http404('No heatmap here.')
+
+    try:
+        bbox = tuple(float(value) for value in request.GET.get('bbox', '').split(','))
+        # Corners on Earth; float() also reads nan and inf, which no cell holds.
+        if len(bbox) != 4 or not (positions.is_valid(bbox[1], bbox[0]) and positions.is_valid(bbox[3], bbox[2])):
+            raise ValueError
+    except ValueError:
+        return HttpResponseBadRequest('Expected bbox=min_lon,min_lat,max_lon,max_lat.')
+    window = timezone.now()
+    if request.GET.get('window'):
+        try:
+            window = parse_datetime(request.GET['window'])
+        except ValueError:
+            window = None
+        if window is None:
+            return HttpResponseBadRequest('Invalid window.')
+    try:
+        cells = heatmap.cells_in_view(bbox, window)
+    except heatmap.ViewTooLarge as e:
+        return HttpResponseBadRequest(str(e))
+    response = JsonResponse(heatmap.as_geojson(cells), content_type='application/geo+json')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def order_route(request: HttpRequest, order_id: int) -> HttpResponse:
+    """
+    Serves the route driven for an order, as a GeoJSON LineString simplified for a zoom level.
+
+    Only the customer and the driver of the order, and staff, see it.
+
+    Args:
+        request (HttpRequest): The HTTP request object, optionally with the `zoom` the
+            route is shown at, kept within the tile zooms (the most detailed by default).
+        order_id (int): The order.
+
+    Returns:
+        HttpResponse: The route as a GeoJSON Feature, with the number of points it was
+        simplified from as the `points` property.
+    """
+    user = request.user
+    if not user.is_authenticated:
+        raise Http404('No such order.')
+    order = get_object_or_404(Order.objects.only('route', 'customer', 'driver'), id=order_id)
+    customer, driver = getattr(user, 'customer', None), getattr(user, 'driver', None)
+    if not (user.is_staff or customer is not None and order.customer_id == customer.id
+            or driver is not None and order.driver_id == driver.id):
+        raise Http404('No such order.')
+    try:
+        zoom = int(request.GET.get('zoom', tiles.tile_max_zoom()))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid zoom.')
+    # Further out, the tolerance would overflow (or divide by zero) for no visible change.
+    zoom = min(max(zoom, tiles.tile_min_zoom()), tiles.tile_max_zoom())
+
+    points = routes.decode(order.route)
+    simplified = routes.simplify(points, routes.tolerance_for_zoom(zoom))
+    response = JsonResponse({
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat, lon in simplified]},
+        'properties': {'id': order.id, 'points': len(points)},
+    }, content_type='application/geo+json')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 def register(request: HttpRequest) -> Union[HttpResponse, HttpResponseRedirect]:
     """
@@ -81,10 +327,14 @@ def register(request: HttpRequest) -> Union[HttpResponse, HttpResponseRedirect]:
         form = RegistrationForm()
     return render(request, 'register.html', {'form': form})
 
+@ensure_csrf_cookie
 def index(request: HttpRequest) -> HttpResponse:
     """
     The center of the Find Daikou experiential extravaganza.
 
+    The map script only depends on the role of the user (see get_map_role) and is
+    cached per role. Open orders are loaded by the page from order_features.
+
     Args:
         request (HttpRequest): An HTTP request object representing the incoming request.
 
@@ -95,8 +345,6 @@ def index(request: HttpRequest) -> HttpResponse:
     is_driver = False
     has_active_order = False
     is_available = False
-    orders = []
-    features = []
     cars =[]
     eta = None
 
@@ -104,15 +352,12 @@ def index(request: HttpRequest) -> HttpResponse:
         user_type = get_user_type(request.user)
         if user_type == 'customer':
             is_customer = True
-            cars = Car.objects.filter(customer=request.user.customer)
+            cars = customer_cars(request.user.customer.id)
         elif user_type == 'driver':
             is_driver = True
             if request.user.driver.is_available:
                 is_available = True
 
-            orders = Order.objects.filter(driver=None, completed=False)
-            features = create_order_features(orders)
-
         # Set button labels and URLs
 
         # Set active order details
@@ -134,13 +379,34 @@ def index(request: HttpRequest) -> HttpResponse:
         "has_active_order": has_active_order,
         "is_driver": is_driver,
         "is_available": is_available,
-        "orders": orders,
-        "features": features,
+        "map_role": get_map_role(is_customer, has_active_order, is_driver, is_available),
+        "fragment_timeout": getattr(settings, 'DAIKOU_INDEX_FRAGMENT_TIMEOUT', 300),
         "cars": cars,
         "now": datetime.now().strftime('%Y-%m-%dT%H:%M'),
         "eta": eta,
+        "tile_max_zoom": tiles.tile_max_zoom(),
+        "poll_interval": getattr(settings, 'DAIKOU_FEED_POLL_INTERVAL', 5) * 1000,
     })
 
+def get_map_role(is_customer: bool, has_active_order: bool, is_driver: bool, is_available: bool) -> str:
+    """
+    Name the variant of the index map a user gets, which the map is cached under.
+
+    Args:
+    - is_customer: Whether the user is a customer.
+    - has_active_order: Whether the customer has an active order.
+    - is_driver: Whether the user is a driver.
+    - is_available: Whether the driver is available.
+
+    Returns:
+    - One of 'customer-active', 'customer', 'driver-available', 'driver' or 'anonymous'.
+    """
+    if is_customer:
+        return 'customer-active' if has_active_order else 'customer'
+    if is_driver:
+        return 'driver-available' if is_available else 'driver'
+    return 'anonymous'
+
 def get_user_type(user: Any) -> str:
     """
     Determine the user type based on the user object.
@@ -158,6 +424,66 @@ def get_user_type(user: Any) -> str:
     else:
         return 'anonymous'
 
+def get_open_orders(zone: str = '') -> List[Order]:
+    """
+    Return the orders waiting for a driver, in one zone or in all of them.
+
+    Args:
+    - zone: The zone whose board to return, or '' for every zone.
+
+    Returns:
+    - A list of open orders.
+    """
+    return list(Order.objects.in_zone(zone).open())
+
+def get_order_features(zone: str = '') -> Tuple[bytes, bytes, str]:
+    """
+    Return the open orders of a zone as an encoded GeoJSON FeatureCollection.
+
+    The encoded board is kept in the cache until an order of the zone changes (see
+    find_daikou.signals), or for DAIKOU_ORDER_FEATURES_CACHE_TIMEOUT seconds, since
+    changes made in other processes are not seen by a per-process cache.
+
+    Args:
+    - zone: The zone whose orders to return, or '' for every zone.
+
+    Returns:
+    - The JSON body, its gzip compressed copy and its ETag.
+    """
+    key = order_features_cache_key(zone)
+    encoded = cache.get(key)
+    if encoded is None:
+        body = json.dumps({
+            'type': 'FeatureCollection',
+            'features': create_order_features(get_open_orders(zone=zone)),
+        }, cls=DjangoJSONEncoder).encode()
+        encoded = (body, gzip.compress(body), hashlib.md5(body).hexdigest())
+        cache.set(key, encoded, getattr(settings, 'DAIKOU_ORDER_FEATURES_CACHE_TIMEOUT', 60))
+    return encoded
+
+def get_board(board_zones: Sequence[str]) -> Tuple[bytes, bytes, str]:
+    """
+    Return the open orders of several zones as one encoded GeoJSON FeatureCollection.
+
+    The board of each zone is cached on its own (see get_order_features), so that
+    changes to one zone's orders only invalidate that board. A single board is
+    served as is; several are joined.
+
+    Args:
+    - board_zones: The zones whose orders to return; '' stands for every zone.
+
+    Returns:
+    - The JSON body, its gzip compressed copy and its ETag.
+    """
+    boards = [get_order_features(zone) for zone in board_zones]
+    if len(boards) == 1:
+        return boards[0]
+    body = json.dumps({
+        'type': 'FeatureCollection',
+        'features': [feature for board, _, _ in boards for feature in json.loads(board)['features']],
+    }).encode()
+    return body, gzip.compress(body), hashlib.md5(body).hexdigest()
+
 def get_active_order(orders: QuerySet) -> Optional[Order]:
     """
     Return the first active order in the given query set of orders.
@@ -174,6 +500,14 @@ def get_active_order(orders: QuerySet) -> Optional[Order]:
         return active_orders.first()
     return None
 
+class PlainPoint(NamedTuple):
+    """
+    A point for building features, in place of a GEOS Point: nothing here needs more
+    than its coordinates, and GEOS would have to be loaded to create one.
+    """
+    x: float
+    y: float
+
 def create_order_features(orders: QuerySet) -> List[Dict[str, Union[str, Dict[str, Union[str, List[float]]]]]]:
     """
     Create a list of features for all orders in the given query set.
@@ -186,7 +520,7 @@ def create_order_features(orders: QuerySet) -> List[Dict[str, Union[str, Dict[st
       - 'type': A string indicating the type of the feature, which is 'Feature' in this case.
       - 'geometry': A dictionary representing the geometry of the feature, which has the following keys:
         - 'type': A string indicating the type of the geometry, which is 'Point' in this case.
-        - 'coordinates': A list of two floating point numbers representing the coordinates of the feature.
+        - 'coordinates': The longitude and latitude of the point.
       - 'properties': A dictionary containing additional properties of the feature, which has the following keys:
         - 'id': An integer indicating the ID of the order.
         - 'type': A string indicating the type of the order, which is either 'pickup' or 'dropoff'.
@@ -194,11 +528,11 @@ def create_order_features(orders: QuerySet) -> List[Dict[str, Union[str, Dict[st
     """
     features = []
     for order in orders:
-        pickup_location = Point(order.pickup_latitude, order.pickup_longitude)
+        pickup_location = PlainPoint(order.pickup_longitude, order.pickup_latitude)
         pickup_feature = create_point_feature(pickup_location, order.id, 'pickup')
         features.append(pickup_feature)
 
-        dropoff_location = Point(order.dropoff_latitude, order.dropoff_longitude)
+        dropoff_location = PlainPoint(order.dropoff_longitude, order.dropoff_latitude)
         dropoff_feature = create_point_feature(dropoff_location, order.id, 'dropoff')
         features.append(dropoff_feature)
     return features
@@ -297,6 +631,21 @@ def create_buttons(user_type: str, user: object, has_active_order: bool) -> List
         )
     return buttons
 
+def parse_map_point(value: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    Read a point picked on the booking map.
+
+    The map sends points as OpenLayers gives them (`ol.proj.toLonLat`), longitude first.
+
+    Returns:
+    - The (latitude, longitude) of the point, or None if it is not a valid "longitude,latitude" pair.
+    """
+    try:
+        longitude, latitude = (float(part) for part in (value or '').split(','))
+    except ValueError:
+        return None
+    return (latitude, longitude) if positions.is_valid(latitude, longitude) else None
+
 @login_required
 @transaction.atomic
 def call_driver(request: HttpRequest) -> HttpResponse:
@@ -304,28 +653,33 @@ def call_driver(request: HttpRequest) -> HttpResponse:
     View function that handles a customer's request to book a ride with a driver.
 
     Args:
-    - request: The HTTP request object.
+    - request: The HTTP request object, with the `departure` and `arrival` points as sent by the
+      booking map, "longitude,latitude" (see parse_map_point).
 
     Returns:
     - An HTTP response object that redirects the user to the homepage upon successful booking of a ride.
     """
     pickup_time_str = request.GET.get('time')
-    departure = request.GET.get('departure')
-    arrival = request.GET.get('arrival')
+    departure = parse_map_point(request.GET.get('departure'))
+    arrival = parse_map_point(request.GET.get('arrival'))
     car_id = request.GET.get('car')
+    if departure is None or arrival is None:
+        return HttpResponseBadRequest('Invalid departure or arrival.')
 
     pickup_time = datetime.fromisoformat(pickup_time_str)
-    # Get the car object based on the car id
-    car_obj = get_object_or_404(Car, id=car_id)
+    # Check the car against the customer's cached cars, which Order.save checks again
+    customer = request.user.customer
+    if not customer_owns_car(customer.id, car_id):
+        raise Http404('No such car.')
 
     # Create a new order instance with the received data
-    order = Order(customer=request.user.customer,
+    order = Order(customer=customer,
                   pickup_time=pickup_time,
-                  pickup_latitude=departure.split(',')[0],
-                  pickup_longitude=departure.split(',')[1],
-                  dropoff_latitude=arrival.split(',')[0],
-                  dropoff_longitude=arrival.split(',')[1],
-                  car=car_obj)
+                  pickup_latitude=departure[0],
+                  pickup_longitude=departure[1],
+                  dropoff_latitude=arrival[0],
+                  dropoff_longitude=arrival[1],
+                  car_id=int(car_id))
 
     # Save the order instance to the database
     order.save()
@@ -353,9 +707,14 @@ def history(request: HttpRequest) -> HttpResponse:
         # If the user is not a Customer or a Driver, return an error message
         return render(request, 'error.html', {'error': 'You must be a Customer or a Driver to view previous orders.'})
 
+    # Routes are fetched by the page when shown, not loaded for every order here.
+    orders = orders.defer('route').annotate(
+        has_route=ExpressionWrapper(~Q(route=''), output_field=BooleanField()),
+    )
     order_info = []
     for order in orders:
         info = {
+            'route_url': reverse('order_route', args=[order.id]) if order.has_route else None,
             'start_location': f"{order.pickup_latitude}, {order.pickup_longitude}",
             'end_location': f"{order.dropoff_latitude}, {order.dropoff_longitude}",
             'car_make': order.car.make,
@@ -382,9 +741,7 @@ def set_driver_available(request: HttpRequest) -> HttpResponse:
     Returns:
     - An HTTP response object that redirects the user to the homepage.
     """
-    driver = request.user.driver
-    driver.is_available = True
-    driver.save()
+    request.user.driver.set_available(True)
     return redirect('index')
 
 @login_required
@@ -398,33 +755,121 @@ def set_driver_unavailable(request: HttpRequest) -> HttpResponse:
     Returns:
     - An HTTP response object that redirects the user to the homepage.
     """
-    driver = request.user.driver
-    driver.is_available = False
-    driver.save()
+    request.user.driver.set_available(False)
     return redirect('index')
 
 @login_required
-@transaction.atomic
+@require_POST
+def update_position(request: HttpRequest) -> HttpResponse:
+    """
+    View function that records the current position of a logged-in driver.
+
+    The position is buffered and written to the database in batches (see
+    find_daikou.positions), but shows up in the driver feed right away.
+
+    Args:
+    - request: The HTTP request object, with `latitude` and `longitude` in its POST data.
+
+    Returns:
+    - A JSON response confirming the update.
+    """
+    if not hasattr(request.user, 'driver'):
+        return HttpResponseBadRequest('User is not a driver.')
+    try:
+        latitude = float(request.POST['latitude'])
+        longitude = float(request.POST['longitude'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('Invalid position.')
+    if not positions.is_valid(latitude, longitude):
+        return HttpResponseBadRequest('Invalid position.')
+    positions.buffer.update(request.user.driver, latitude, longitude)
+    return JsonResponse({'success': True})
+
+@login_required
 def confirm_order(request: HttpRequest) -> HttpResponse:
     """
     View function that confirms a driver's acceptance of an order and assigns the driver to the order.
 
+    The assignment holds the dispatch lock of the order's zone until it is committed, so
+    two drivers cannot take the same order, while orders in other zones go on unhindered.
+
     Args:
-    - request: The HTTP request object.
+    - request: The HTTP request object, with the `order_id` and the driver's `time_to_pickup` in minutes,
+      which defaults to the suggested one (see suggested_minutes).
 
     Returns:
-    - An HTTP response object that redirects the user to the homepage upon successful confirmation of an order.
+    - An HTTP response object that redirects the user to the homepage upon successful confirmation of an order,
+      or a 503 response if the zone is too busy to take the order right now.
     """
     order_id = request.GET['order_id']
-    time_to_pickup = int(request.GET['time_to_pickup'])
+    time_to_pickup = request.GET.get('time_to_pickup')
     order = Order.objects.get(id=order_id)
     if hasattr(request.user, 'driver'):
         driver = request.user.driver
-        order.assign_driver(driver)
-        order.eta = datetime.now() + timedelta(minutes=time_to_pickup)
-        order.save()
+        if time_to_pickup:
+            time_to_pickup = int(time_to_pickup)
+        else:
+            time_to_pickup = suggested_minutes(driver, order)
+        try:
+            with zones.zone_lock(order.zone), transaction.atomic():
+                # Only taken if nobody else took it meanwhile; the update also locks the row
+                # against dispatch workers, which may not share our cache. Orders booked for
+                # later can't be taken before they are on the board.
+                order.assign_driver(driver, datetime.now() + timedelta(minutes=time_to_pickup))
+        except zones.ZoneLockTimeout:
+            response = HttpResponse('The service is busy, please try again shortly.', status=503)
+            response['Retry-After'] = '1'
+            return response
     return redirect('index')
 
+def suggested_minutes(driver: Driver, order: Order) -> int:
+    """The minutes a driver would need to reach the pickup of an order, rounded up."""
+    return math.ceil(distances.suggested_eta(driver, order).minutes)
+
+@login_required
+def eta_suggestion(request: HttpRequest) -> JsonResponse:
+    """
+    Suggests the driver how long they would take to reach the pickup of an order.
+
+    Args:
+    - request: The HTTP request object, with the `order_id`.
+
+    Returns:
+    - A JSON response with the suggested `minutes` and the distance in `km`.
+    """
+    if not hasattr(request.user, 'driver'):
+        raise Http404('Only drivers get ETA suggestions.')
+    order = get_object_or_404(Order, id=request.GET.get('order_id'))
+    estimate = distances.suggested_eta(request.user.driver, order)
+    return JsonResponse({'minutes': math.ceil(estimate.minutes), 'km': round(estimate.km, 2)})
+
+@login_required
+def nearby_drivers(request: HttpRequest) -> HttpResponse:
+    """
+    Tells a customer how many free drivers are near a departure point, and how long
+    the nearest would take to get there.
+
+    Args:
+    - request: The HTTP request object, with the departure `latitude` and `longitude`.
+
+    Returns:
+    - A JSON response with the number of free drivers within each radius in km, and the
+      `eta_minutes` of the nearest (None if there is none within the largest radius).
+    """
+    try:
+        latitude, longitude = float(request.GET['latitude']), float(request.GET['longitude'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('Expected a latitude and a longitude.')
+    if not positions.is_valid(latitude, longitude):
+        return HttpResponseBadRequest('Expected a latitude and a longitude.')
+    found = nearby.nearby(latitude, longitude)
+    response = JsonResponse({
+        'drivers': [{'km': km, 'count': count} for km, count in found.counts],
+        'eta_minutes': math.ceil(found.eta_minutes) if found.eta_minutes is not None else None,
+    })
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 @login_required
 @transaction.atomic
 def cancel_order(request: HttpRequest) -> HttpResponse:
@@ -461,7 +906,7 @@ def cancel_order(request: HttpRequest) -> HttpResponse:
             # the customer doesn't have an active order
             return HttpResponseBadRequest('No active order found.')
 
-        order.complete_order()
+        order.cancel()
 
         return redirect('index')
 
@@ -541,17 +986,51 @@ def update_eta(request: HttpRequest) -> Union[HttpResponse, HttpResponseRedirect
     order = get_object_or_404(Order, driver=user.driver, completed=False)
 
     if request.method == 'POST':
-        # Get the minutes input from the form
-        minutes = int(request.POST.get('minutes'))
+        # Get the minutes input from the form, or suggest them
+        minutes = request.POST.get('minutes')
+        minutes = int(minutes) if minutes else suggested_minutes(user.driver, order)
 
         # Calculate the new ETA
         eta = datetime.now() + timedelta(minutes=minutes)
 
-        # Update the Order object with the new ETA
-        order.eta = eta
-        order.save()
+        # Update the ETA, unless the order was completed or unassigned meanwhile
+        order.set_eta(eta)
 
         # Redirect to the order detail page
         return redirect('index')
 
-    return render(request, 'update_eta.html', {'order': order})
+    return render(request, 'update_eta.html', {'order': order, 'suggested_minutes': suggested_minutes(user.driver, order)})
+
+@staff_member_required
+def profile_list(request: HttpRequest) -> HttpResponse:
+    """
+    Admin page listing the saved request profiles, newest first.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: The rendered list of profiles.
+    """
+    return render(request, 'admin_profiles.html', {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': profiling.list_profiles(),
+    })
+
+@staff_member_required
+def profile_download(request: HttpRequest, name: str) -> FileResponse:
+    """
+    Download a file of a saved request profile.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        name (str): The file name, as listed by profile_list.
+
+    Returns:
+        FileResponse: The file, as an attachment.
+    """
+    path = profiling.profile_file(name)
+    if path is None:
+        raise Http404('No such profile.')
+    return FileResponse(path.open('rb'), as_attachment=True, filename=name)
@@ -0,0 +1,103 @@
+"""
+Compact binary encoding of the driver feed.
+
+A frame is a fixed header followed by packed driver records and, for delta
+frames, the ids of drivers that disappeared since the base version:
+
+    header   '<4sBQQIII'  magic, frame type, version, base version,
+                          assigned driver id (0 for none), record count,
+                          removed count
+    record   '<IiiB'      driver id, latitude and longitude in millionths
+                          of a degree, flags
+    removed  '<I'         driver id
+
+All integers are little-endian. Records are sorted by driver id.
+"""
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.http import HttpRequest
+
+CONTENT_TYPE = 'application/x-daikou-fleet'
+MAGIC = b'DKF1'
+FULL = 0
+DELTA = 1
+SCALE = 1000000
+
+FLAG_ASSIGNED = 1
+
+HEADER = struct.Struct('<4sBQQIII')
+RECORD = struct.Struct('<IiiB')
+REMOVED = struct.Struct('<I')
+
+# (driver id, fixed point latitude, fixed point longitude)
+Position = Tuple[int, int, int]
+
+
+def to_fixed(degrees: float) -> int:
+    """Convert degrees to the fixed point representation used on the wire."""
+    return int(round(float(degrees) * SCALE))
+
+
+def from_fixed(value: int) -> float:
+    """Convert a fixed point wire value back to degrees."""
+    return value / SCALE
+
+
+def accepts_binary(request: HttpRequest) -> bool:
+    """Whether the client asked for the binary feed in its Accept header."""
+    return CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def pack_frame(positions: Iterable[Position], version: int, base: int = 0,
+               removed: Iterable[int] = (), assigned: Optional[int] = None) -> bytes:
+    """
+    Encode a feed frame.
+
+    Args:
+        positions: The drivers to send, as (id, fixed latitude, fixed longitude).
+        version: The feed version the frame brings the client to.
+        base: The version a delta frame applies to, 0 for a full frame.
+        removed: Ids of drivers to drop, only meaningful for delta frames.
+        assigned: The id of the driver assigned to the requesting user, if any.
+
+    Returns:
+        The encoded frame.
+    """
+    positions = sorted(positions)
+    removed = sorted(removed)
+    body = bytearray(HEADER.pack(
+        MAGIC, DELTA if base else FULL, version, base, assigned or 0, len(positions), len(removed)
+    ))
+    for driver_id, lat, lon in positions:
+        body += RECORD.pack(driver_id, lat, lon, FLAG_ASSIGNED if driver_id == assigned else 0)
+    for driver_id in removed:
+        body += REMOVED.pack(driver_id)
+    return bytes(body)
+
+
+def unpack_frame(data: bytes) -> Dict[str, object]:
+    """
+    Decode a feed frame; the Python counterpart of static/js/fleet.js.
+
+    Raises:
+        ValueError: If the data is not a feed frame.
+    """
+    magic, frame_type, version, base, assigned, count, removed_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a fleet frame.')
+    offset = HEADER.size
+    drivers: List[Dict[str, object]] = []
+    for _ in range(count):
+        driver_id, lat, lon, flags = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        drivers.append({'id': driver_id, 'latitude': from_fixed(lat), 'longitude': from_fixed(lon), 'flags': flags})
+    removed = [REMOVED.unpack_from(data, offset + i * REMOVED.size)[0] for i in range(removed_count)]
+    return {
+        'type': 'delta' if frame_type == DELTA else 'full',
+        'version': version,
+        'base': base,
+        'assigned': assigned or None,
+        'drivers': drivers,
+        'removed': removed,
+    }
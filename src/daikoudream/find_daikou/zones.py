@@ -0,0 +1,119 @@
+"""
+Geographic zones.
+
+Drivers and orders are assigned to a zone from their coordinates, so that the
+work for one city - feeds, order boards, dispatch - never scans or waits on
+another city's rows. Zones are the bounding boxes named in `DAIKOU_ZONES`;
+points outside all of them fall in a grid cell of `DAIKOU_ZONE_GRID_SIZE`
+degrees, which acts as a zone of its own.
+"""
+import math
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+# (min_lon, min_lat, max_lon, max_lat)
+BBox = Tuple[float, float, float, float]
+
+# Kilometres in a degree of latitude.
+KM_PER_DEGREE = 111.32
+
+
+class ZoneLockTimeout(Exception):
+    """Raised when a zone's dispatch lock could not be taken in time."""
+
+
+def configured_zones() -> Dict[str, BBox]:
+    return getattr(settings, 'DAIKOU_ZONES', {})
+
+
+def zone_for(latitude, longitude) -> str:
+    """
+    Return the zone containing a point.
+
+    Args:
+        latitude: The latitude of the point.
+        longitude: The longitude of the point.
+
+    Returns:
+        The name of the first configured zone containing the point, or the name of
+        its grid cell if there is none.
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    for name, (min_lon, min_lat, max_lon, max_lat) in configured_zones().items():
+        if min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat:
+            return name
+    size = getattr(settings, 'DAIKOU_ZONE_GRID_SIZE', 1.0)
+    return f'grid:{math.floor(latitude / size)}:{math.floor(longitude / size)}'
+
+
+def board_zones(latitude, longitude) -> List[str]:
+    """
+    Return the zones whose open orders a driver at a point is shown.
+
+    That is the zone of the point and those of the corners and sides of a box
+    `DAIKOU_BOARD_MARGIN_KM` around it, so that a driver near the edge of a zone
+    also sees the pickups just across it.
+
+    Args:
+        latitude: The latitude of the driver.
+        longitude: The longitude of the driver.
+
+    Returns:
+        The zones, or [''] (every zone) for a driver that has not reported a
+        position yet, which is still at the default of 0, 0.
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    if latitude == 0 and longitude == 0:
+        return ['']
+    margin_lat = getattr(settings, 'DAIKOU_BOARD_MARGIN_KM', 2) / KM_PER_DEGREE
+    margin_lon = margin_lat / max(math.cos(math.radians(latitude)), 0.01)
+    found = set()
+    for dlat in (-margin_lat, 0, margin_lat):
+        for dlon in (-margin_lon, 0, margin_lon):
+            found.add(zone_for(min(max(latitude + dlat, -90), 90), (longitude + dlon + 180) % 360 - 180))
+    return sorted(found)
+
+
+@contextmanager
+def zone_lock(zone: str, timeout: Optional[float] = None) -> Iterator[None]:
+    """
+    Serialize dispatch within a zone, among the processes sharing the cache.
+
+    Held while the orders of a zone are matched with drivers, so that passes over
+    the same zone queue up instead of contending for the same rows. Dispatch in
+    other zones goes on unhindered. The lock only reduces contention: with a
+    per-process cache, such as the default `LocMemCache`, other processes do not
+    see it, and it expires after `DAIKOU_ZONE_LOCK_TIMEOUT` seconds. What keeps an
+    order or a driver from being handed out twice are the row locks of dispatch
+    and the guarded update of `Order.assign_driver`.
+
+    Args:
+        zone: The zone to lock.
+        timeout: Seconds to wait for the lock, `DAIKOU_ZONE_LOCK_WAIT` by default.
+
+    Raises:
+        ZoneLockTimeout: If the lock could not be taken within `timeout` seconds.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'DAIKOU_ZONE_LOCK_WAIT', 5)
+    key = f'zone-lock:{zone}'
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    # The lock expires on its own should its holder die.
+    while not cache.add(key, token, getattr(settings, 'DAIKOU_ZONE_LOCK_TIMEOUT', 30)):
+        if time.monotonic() > deadline:
+            raise ZoneLockTimeout(f'Could not lock zone {zone}.')
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        # A holder that outlived the timeout must not release the lock of the next
+        # one. The cache API has no compare-and-delete, so this narrows rather than
+        # closes that window.
+        if cache.get(key) == token:
+            cache.delete(key)